@@ -0,0 +1,161 @@
+# Benchmark of the article HTML transform: parse, collect and rewrite time per KB for each parser
+#
+# Usage:
+#   python benchmarks/html_transform_benchmark.py
+#   python benchmarks/html_transform_benchmark.py --articles ./data/freshdesk_articles_20240101000000.jsonl
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import time
+from bs4 import BeautifulSoup, FeatureNotFound
+
+# Run from anywhere: the migration script lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Imported by main, from a temporary working directory
+migration = None
+
+PARSERS = ["html.parser", "lxml", "html5lib"]
+
+
+# Build a synthetic article body with roughly the given number of KB
+def generate_article_html(size_kb, images_per_kb=0.2, links_per_kb=0.5, seed=0):
+    rng = random.Random(seed)
+    words = ["account", "billing", "password", "reset", "invoice", "customer", "portal", "settings",
+             "click", "select", "the", "and", "to", "your", "from", "menu", "report", "export"]
+    parts = []
+    image_index = 0
+    link_index = 0
+
+    while sum(len(part) for part in parts) < size_kb * 1024:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(12, 30)))
+        parts.append(f"<p>{sentence.capitalize()}.</p>")
+
+        if rng.random() < images_per_kb / 2:
+            parts.append(
+                f'<p><img src="https://s3.amazonaws.com/cdn.freshdesk.com/data/helpdesk/attachments/production/'
+                f'{seed}{image_index}/original/screenshot.png?X-Amz-Signature={rng.getrandbits(64):x}" '
+                f'alt="Screenshot {image_index}" style="width: 600px;"></p>')
+            image_index += 1
+
+        if rng.random() < links_per_kb / 2:
+            parts.append(
+                f'<p>See <a href="https://helpdesk.yourcompany.com/support/solutions/articles/{rng.randint(1000, 9999)}-related">'
+                f'related article {link_index}</a> and <a href="https://example.com/page/{link_index}">this page</a>.</p>')
+            link_index += 1
+
+        if rng.random() < 0.05:
+            rows = "".join(f"<tr><td>{rng.choice(words)}</td><td>{rng.randint(1, 100)}</td></tr>"
+                           for _ in range(5))
+            parts.append(f"<table><tbody>{rows}</tbody></table>")
+
+    return "".join(parts)
+
+
+# Load article bodies from a spool written by download_freshdesk_articles (or an older JSON dump)
+def load_article_html(articles_path):
+    with open(articles_path) as articles_file:
+        if articles_path.endswith(".jsonl"):
+            articles = [json.loads(line) for line in articles_file if line.strip()]
+        else:
+            articles = json.load(articles_file)
+    return [article["description"] for article in articles if article.get("description")]
+
+
+# Fake uploaded images for every img of a document, as get_images_and_internal_references returns them
+def get_fake_images(html_document):
+    return {f"image_{index}": {"aws_url": img.get("src"),
+                               "dynamics_image_url": f"https://yourorg.crm3.dynamics.com/WebResources/image_{index}"}
+            for index, img in enumerate(html_document["img_tags"])}
+
+
+# One pass: parse once, collect the images and links, rewrite from a lookup dict, render
+def transform_single_pass(html_content, parser):
+    html_document = migration.parse_article_html(html_content, parser)
+    migration.get_internal_references(html_document)
+    migration.replace_image_urls(html_document, get_fake_images(html_document))
+    return migration.render_article_html(html_document)
+
+
+# The previous transform: parse to collect, parse again, and search the tree once per image
+def transform_two_pass(html_content, parser):
+    soup = BeautifulSoup(html_content, parser)
+    [a_tag["href"] for a_tag in soup.find_all("a")
+     if a_tag.has_attr("href") and "helpdesk.yourcompany.com" in a_tag["href"]]
+    img_urls = [img["src"] for img in soup.find_all("img")]
+
+    soup = BeautifulSoup(html_content, parser)
+    for index, img_url in enumerate(img_urls):
+        for img in soup.find_all("img", src=img_url):
+            img["src"] = f"https://yourorg.crm3.dynamics.com/WebResources/image_{index}"
+    return f"{soup}"
+
+
+# Time a transform over every document
+def time_transform(transform, documents, parser, repeat):
+    """
+    Returns:
+        Dict with the total seconds, the KB processed and the milliseconds per KB
+    """
+    total_kb = sum(len(document.encode("utf-8")) for document in documents) / 1024 * repeat
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for document in documents:
+            transform(document, parser)
+    elapsed_seconds = time.perf_counter() - start_time
+
+    return {
+        "seconds": elapsed_seconds,
+        "kb": total_kb,
+        "ms_per_kb": elapsed_seconds * 1000 / total_kb if total_kb else 0.0
+    }
+
+
+def main():
+    global migration
+
+    parser = argparse.ArgumentParser(description="Benchmark the article HTML transform for each parser.")
+    parser.add_argument("--articles", help="freshdesk_articles_*.jsonl file to use instead of synthetic articles")
+    parser.add_argument("--sizes", default="2,20,200", help="Synthetic article sizes in KB (default: 2,20,200)")
+    parser.add_argument("--count", type=int, default=20, help="Synthetic articles per size (default: 20)")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the documents (default: 3)")
+    args = parser.parse_args()
+
+    # The migration writes its log to the working directory
+    articles_path = os.path.abspath(args.articles) if args.articles else None
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="html_transform_benchmark_") as work_dir:
+        os.chdir(work_dir)
+        import knowledge_article_migration as migration
+
+        if articles_path:
+            document_sets = {os.path.basename(articles_path): load_article_html(articles_path)}
+        else:
+            document_sets = {f"{size_kb} KB": [generate_article_html(int(size_kb), seed=seed) for seed in range(args.count)]
+                             for size_kb in args.sizes.split(",")}
+
+        print(f"{'documents':<14}{'parser':<14}{'transform':<12}{'ms/KB':>10}{'total s':>10}")
+        for set_name, documents in document_sets.items():
+            for html_parser in PARSERS:
+                try:
+                    BeautifulSoup("", html_parser)
+                except FeatureNotFound:
+                    print(f"{set_name:<14}{html_parser:<14}{'-':<12}{'not installed':>20}")
+                    continue
+
+                for transform_name, transform in [("single", transform_single_pass), ("two-pass", transform_two_pass)]:
+                    result = time_transform(transform, documents, html_parser, args.repeat)
+                    print(f"{set_name:<14}{html_parser:<14}{transform_name:<12}"
+                          f"{result['ms_per_kb']:>10.3f}{result['seconds']:>10.2f}")
+
+        migration.logging.shutdown()
+        os.chdir(original_dir)
+
+
+if __name__ == "__main__":
+    main()
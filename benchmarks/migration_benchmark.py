@@ -0,0 +1,380 @@
+# Offline benchmark of the whole migration against local Freshdesk, image CDN and Dataverse stand-ins
+#
+# Runs the real crawl, image pipeline, article creation and link rewrite of
+# knowledge_article_migration.py over a synthetic knowledge base, then
+# reports articles per minute, HTTP requests per article and step latencies.
+# With injected faults, it also reports the time each recovery path adds.
+#
+# Usage:
+#   python benchmarks/migration_benchmark.py
+#   python benchmarks/migration_benchmark.py --articles-per-folder 50 --dataverse-latency-ms 80 --workers 8
+#   python benchmarks/migration_benchmark.py --fault-429 0.02 --fault-5xx 0.01 --fault-401 0.005 --baseline
+#   python benchmarks/migration_benchmark.py --fault-slow-number 0.05 --trace traces.jsonl
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import functools
+import threading
+import contextlib
+import subprocess
+import requests
+from requests.auth import HTTPBasicAuth
+
+# Run from anywhere: the migration script lives one directory up
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "stubs"))
+
+import migration_stand_ins
+
+# Migration functions timed per call, in pipeline order
+TIMED_STEPS = [
+    "freshdesk_request",
+    "download_freshdesk_articles",
+    "get_images_and_internal_references",
+    "get_image_web_resource",
+    "prepare_article_content",
+    "migrate_article",
+    "migrate_french_translation",
+    "execute_batch",
+    "migrate_to_dynamics",
+    "update_internal_links"
+]
+
+# Fault rates settable from the command line, as named in migration_stand_ins.DEFAULT_FAULTS
+FAULT_ARGUMENTS = ["401", "429", "5xx", "timeout", "drop", "slow_number"]
+
+step_timings = {}
+step_timings_lock = threading.Lock()
+
+
+# Wrap a migration function so every call's duration is recorded under its name
+def time_step(migration, step_name):
+    step_function = getattr(migration, step_name)
+
+    @functools.wraps(step_function)
+    def timed_step(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return step_function(*args, **kwargs)
+        finally:
+            elapsed_seconds = time.perf_counter() - start_time
+            with step_timings_lock:
+                step_timings.setdefault(step_name, []).append(elapsed_seconds)
+
+    setattr(migration, step_name, timed_step)
+
+
+# Nearest-rank percentile of a list of durations
+def get_percentile(durations, percentile):
+    ordered_durations = sorted(durations)
+    index = max(0, int(round(percentile / 100 * len(ordered_durations) + 0.5)) - 1)
+    return ordered_durations[min(index, len(ordered_durations) - 1)]
+
+
+# Get an access token from the Dataverse stand-in instead of Entra ID (called with token_lock held)
+def request_stand_in_token(migration, token_url):
+    token_response = requests.post(token_url, timeout=30).json()
+    migration.token_state["access_token"] = token_response["access_token"]
+    migration.token_state["refresh_token"] = token_response["refresh_token"]
+    migration.token_state["expires_at"] = time.monotonic() + int(token_response["expires_in"])
+    return migration.token_state["access_token"]
+
+
+# Point the migration at the stand-ins and open its stores in the working directory
+def prepare_migration(migration, servers, knowledge_base, use_batch):
+    migration.freshdesk_url = f"{servers['freshdesk'].stand_in['base_url']}/api/v2/"
+    migration.dynamics_url = f"{servers['dataverse'].stand_in['base_url']}/"
+    migration.env = "benchmark"
+    migration.freshdesk_session.auth = HTTPBasicAuth("benchmark", "")
+
+    # The token manager refreshes from the stand-in, including after an injected 401
+    migration.request_new_access_token = functools.partial(
+        request_stand_in_token, migration, f"{servers['dataverse'].stand_in['base_url']}/oauth2/v2.0/token")
+
+    migration.imported_categories = {folder_id: {"categoryid": str(uuid.uuid4())}
+                                     for folder_id in knowledge_base["folders"]}
+    migration.language_dict = {"French - France": str(uuid.uuid4())}
+
+    migration.open_journal()
+    migration.open_state_log()
+    migration.open_image_cache()
+    migration.open_content_store()
+
+    if not use_batch:
+        migration.migrate_to_dynamics = functools.partial(migration.migrate_to_dynamics, use_batch=False)
+
+    for step_name in TIMED_STEPS:
+        time_step(migration, step_name)
+
+
+# Run the crawl and migration of every category, as main does
+def run_migration(migration, chunk_size, max_workers):
+    """
+    Returns:
+        Number of articles downloaded
+    """
+    article_count = 0
+
+    for category in migration.get_freshdesk_categories():
+        migration.download_freshdesk_articles(migration.crawl_freshdesk_folders(category))
+        article_count += len(migration.articles)
+        migration.process_articles_in_chunks(
+            migration.articles, chunk_size=chunk_size, max_workers=max_workers,
+            spool_path=migration.articles_spool_path)
+
+    migration.flush_journal()
+    migration.flush_saved_images()
+    migration.save_state_log()
+    migration.write_article_traces()
+
+    return article_count
+
+
+# Count what the run left behind in the Dataverse stand-in
+def check_dataverse_records(servers, knowledge_base):
+    records = servers["dataverse"].stand_in["records"].values()
+    portal_link = f"https://{knowledge_base['portal_domain']}/support/solutions/articles/"
+
+    return {
+        "english_articles": sum(1 for record in records if record["_parentarticlecontentid_value"] is None),
+        "french_articles": sum(1 for record in records if record["_parentarticlecontentid_value"] is not None),
+        "articles_with_freshdesk_links": sum(1 for record in records if portal_link in (record["content"] or "")),
+        "web_resources": len(servers["dataverse"].stand_in["web_resources"])
+    }
+
+
+# Print the throughput, request counts and step latencies of a run
+def print_report(article_count, elapsed_seconds, servers, dataverse_check):
+    print(f"Migrated {article_count} articles in {elapsed_seconds:.1f} seconds "
+          f"({article_count / elapsed_seconds * 60:.0f} articles/minute)")
+    print(f"Dataverse: {dataverse_check['english_articles']} English and {dataverse_check['french_articles']} "
+          f"French articles, {dataverse_check['web_resources']} web resources, "
+          f"{dataverse_check['articles_with_freshdesk_links']} articles still linking to Freshdesk")
+
+    print()
+    print(f"{'server':<12}{'route':<44}{'requests':>10}{'per article':>14}")
+    for server_name, server in servers.items():
+        request_counts = server.stand_in["request_counts"]
+        for route, count in sorted(request_counts.items()):
+            print(f"{server_name:<12}{route:<44}{count:>10}{count / max(article_count, 1):>14.2f}")
+        http_requests = sum(count for route, count in request_counts.items() if not route.startswith("$batch "))
+        print(f"{server_name:<12}{'HTTP requests':<44}{http_requests:>10}{http_requests / max(article_count, 1):>14.2f}")
+
+    print()
+    print(f"{'step':<40}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}")
+    for step_name in TIMED_STEPS:
+        durations = step_timings.get(step_name)
+        if not durations:
+            continue
+        print(f"{step_name:<40}{len(durations):>8}{get_percentile(durations, 50) * 1000:>10.1f}"
+              f"{get_percentile(durations, 95) * 1000:>10.1f}{sum(durations):>10.2f}")
+
+
+# Print the time spent on each retry, throttling and delay path
+def print_recovery_report(article_count, elapsed_seconds, wait_totals, baseline=None):
+    """
+    Wait seconds are summed over the workers, so paths that run in parallel
+    can add up to more than the wall-clock time. The baseline run, without
+    faults, gives the wall-clock time the faults added.
+    """
+    per_thousand = 1000 / max(article_count, 1)
+
+    print()
+    print(f"{'wait reason':<40}{'count':>8}{'seconds':>10}{'s/1000 articles':>18}")
+    for wait_reason, reason_totals in sorted(wait_totals.items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{wait_reason:<40}{reason_totals['count']:>8}{reason_totals['seconds']:>10.1f}"
+              f"{reason_totals['seconds'] * per_thousand:>18.1f}")
+
+    if baseline:
+        added_seconds = elapsed_seconds - baseline["seconds"] * article_count / max(baseline["articles"], 1)
+        print()
+        print(f"Baseline without faults: {baseline['seconds']:.1f} seconds for {baseline['articles']} articles")
+        print(f"Wall-clock time added by the faults: {added_seconds:.1f} seconds "
+              f"({added_seconds * per_thousand:.1f} seconds per 1000 articles)")
+
+
+# Print the slowest article traces and the longest leaf span (an HTTP call, sleep or HTML step) of each
+def print_slowest_traces(trace_path, count=5):
+    """
+    Articles are ranked by the time spent in their own segments (the
+    children of the root span), since the time between segments, such as
+    until the relink at the end of the chunk, is spent on other articles.
+    """
+    spans = []
+    with open(trace_path) as trace_file:
+        for line in trace_file:
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    spans.extend(scope_spans["spans"])
+
+    parent_span_ids = {span.get("parentSpanId") for span in spans}
+    spans_by_trace = {}
+    for span in spans:
+        span["seconds"] = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+        spans_by_trace.setdefault(span["traceId"], []).append(span)
+
+    article_traces = []
+    for trace_id, trace_spans in spans_by_trace.items():
+        root_span = next((span for span in trace_spans if "parentSpanId" not in span), None)
+        if root_span is None:
+            continue
+        active_seconds = sum(span["seconds"] for span in trace_spans
+                             if span.get("parentSpanId") == root_span["spanId"])
+        # The extent covers every span, including those written after the root
+        extent_seconds = (max(int(span["endTimeUnixNano"]) for span in trace_spans) -
+                          min(int(span["startTimeUnixNano"]) for span in trace_spans)) / 1e9
+        leaf_spans = [span for span in trace_spans if span["spanId"] not in parent_span_ids]
+        longest_span = max(leaf_spans, key=lambda span: span["seconds"])
+        article_traces.append((active_seconds, extent_seconds, root_span["name"], trace_id, longest_span))
+
+    print()
+    print(f"{'slowest traces':<20}{'active s':>10}{'extent s':>10}  {'trace ID':<34}{'longest step':<36}{'seconds':>10}")
+    for active_seconds, extent_seconds, name, trace_id, longest_span in sorted(
+            article_traces, key=lambda item: -item[0])[:count]:
+        print(f"{name:<20}{active_seconds:>10.2f}{extent_seconds:>10.2f}  {trace_id:<34}"
+              f"{longest_span['name'][:34]:<36}{longest_span['seconds']:>10.2f}")
+
+
+# Run the same benchmark without faults in a fresh process, for the recovery report
+def run_baseline():
+    """
+    Returns:
+        The JSON results of the baseline run
+    """
+    with tempfile.TemporaryDirectory(prefix="migration_benchmark_baseline_") as baseline_dir:
+        baseline_json_path = os.path.join(baseline_dir, "baseline.json")
+        arguments = [argument for argument in sys.argv[1:] if argument != "--baseline"]
+        if "--trace" in arguments:
+            # Only the measured run writes traces
+            trace_index = arguments.index("--trace")
+            del arguments[trace_index:trace_index + 2]
+        for fault_name in FAULT_ARGUMENTS:
+            arguments.extend([f"--fault-{fault_name.replace('_', '-')}", "0"])
+
+        subprocess.run([sys.executable, os.path.abspath(__file__)] + arguments + ["--json", baseline_json_path],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(baseline_json_path) as baseline_file:
+            return json.load(baseline_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the migration end to end against local stand-in servers.")
+    parser.add_argument("--categories", type=int, default=2, help="Freshdesk categories (default: 2)")
+    parser.add_argument("--folders-per-category", type=int, default=3, help="Top-level folders per category (default: 3)")
+    parser.add_argument("--subfolders-per-folder", type=int, default=1, help="Subfolders per top-level folder (default: 1)")
+    parser.add_argument("--articles-per-folder", type=int, default=10, help="Articles per folder (default: 10)")
+    parser.add_argument("--images-per-article", type=int, default=2, help="Images per article (default: 2)")
+    parser.add_argument("--shared-image-ratio", type=float, default=0.2, help="Share of images reused across articles (default: 0.2)")
+    parser.add_argument("--link-density", type=int, default=2, help="Internal links per article (default: 2)")
+    parser.add_argument("--fr-ratio", type=float, default=0.5, help="Share of articles with a French translation (default: 0.5)")
+    parser.add_argument("--article-kb", type=int, default=8, help="Article body size in KB (default: 8)")
+    parser.add_argument("--image-kb", type=int, default=32, help="Image size in KB (default: 32)")
+    parser.add_argument("--freshdesk-latency-ms", type=float, default=50, help="Freshdesk API latency (default: 50)")
+    parser.add_argument("--cdn-latency-ms", type=float, default=20, help="Image CDN latency (default: 20)")
+    parser.add_argument("--dataverse-latency-ms", type=float, default=80, help="Dataverse request latency (default: 80)")
+    parser.add_argument("--batch-operation-ms", type=float, default=5, help="Extra Dataverse latency per $batch operation (default: 5)")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="Random latency added or removed (default: 10)")
+    parser.add_argument("--article-number-delay", type=float, default=0,
+                        help="Seconds before Dataverse generates an article number (default: 0)")
+    parser.add_argument("--chunk-size", type=int, default=50, help="Articles per chunk (default: 50)")
+    parser.add_argument("--workers", type=int, help="Concurrent articles or $batch requests (default: MAX_WORKERS)")
+    parser.add_argument("--fault-401", type=float, default=0, help="Share of Dataverse requests whose token expires (default: 0)")
+    parser.add_argument("--fault-429", type=float, default=0, help="Share of requests throttled with Retry-After (default: 0)")
+    parser.add_argument("--fault-5xx", type=float, default=0, help="Share of requests failed with a 5xx (default: 0)")
+    parser.add_argument("--fault-timeout", type=float, default=0,
+                        help="Share of requests held unanswered until the migration's read timeout (default: 0)")
+    parser.add_argument("--fault-drop", type=float, default=0, help="Share of requests closed unanswered (default: 0)")
+    parser.add_argument("--fault-slow-number", type=float, default=0,
+                        help="Share of Dataverse articles whose number is generated late (default: 0)")
+    parser.add_argument("--retry-after", type=float, default=2, help="Retry-After of injected 429s in seconds (default: 2)")
+    parser.add_argument("--timeout-seconds", type=float, default=30, help="How long injected timeouts hold a request (default: 30)")
+    parser.add_argument("--request-timeout", type=float, default=10,
+                        help="Read timeout of the migration's requests, shorter than --timeout-seconds (default: 10)")
+    parser.add_argument("--slow-number-seconds", type=float, default=30, help="Delay of late article numbers (default: 30)")
+    parser.add_argument("--fault-servers", default="freshdesk,cdn,dataverse",
+                        help="Servers that inject faults (default: freshdesk,cdn,dataverse)")
+    parser.add_argument("--baseline", action="store_true",
+                        help="Also run without faults, to report the wall-clock time the faults added")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="Migrate one article at a time instead of with $batch (waits out its fixed sleeps)")
+    parser.add_argument("--verbose", action="store_true", help="Show the migration's own output")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--trace", help="Write one trace per article to this OTLP JSON file and list the slowest")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    knowledge_base = migration_stand_ins.generate_knowledge_base(
+        categories=args.categories, folders_per_category=args.folders_per_category,
+        subfolders_per_folder=args.subfolders_per_folder, articles_per_folder=args.articles_per_folder,
+        images_per_article=args.images_per_article, shared_image_ratio=args.shared_image_ratio,
+        link_density=args.link_density, fr_ratio=args.fr_ratio, article_kb=args.article_kb,
+        image_kb=args.image_kb, seed=args.seed)
+    faults = {fault_name: getattr(args, f"fault_{fault_name}") for fault_name in FAULT_ARGUMENTS}
+    faults.update(retry_after_seconds=args.retry_after, timeout_seconds=args.timeout_seconds,
+                  slow_number_seconds=args.slow_number_seconds)
+    servers = migration_stand_ins.start_stand_in_servers(
+        knowledge_base, freshdesk_latency_ms=args.freshdesk_latency_ms, cdn_latency_ms=args.cdn_latency_ms,
+        dataverse_latency_ms=args.dataverse_latency_ms, batch_operation_ms=args.batch_operation_ms,
+        article_number_delay_seconds=args.article_number_delay, jitter_ms=args.jitter_ms,
+        faults=faults, fault_servers=args.fault_servers.split(","))
+
+    # The migration writes its log, journal and data files to the working directory
+    json_path = os.path.abspath(args.json) if args.json else None
+    trace_path = os.path.abspath(args.trace) if args.trace else None
+    with tempfile.TemporaryDirectory(prefix="migration_benchmark_") as work_dir:
+        os.chdir(work_dir)
+        import knowledge_article_migration as migration
+
+        prepare_migration(migration, servers, knowledge_base, use_batch=not args.no_batch)
+        migration.REQUEST_TIMEOUT_SECONDS = (migration.REQUEST_TIMEOUT_SECONDS[0], args.request_timeout)
+        if trace_path:
+            migration.TRACE_ARTICLES = True
+            migration.TRACE_PATH = trace_path
+        max_workers = args.workers or migration.MAX_WORKERS
+
+        start_time = time.perf_counter()
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            article_count = run_migration(migration, args.chunk_size, max_workers)
+        elapsed_seconds = time.perf_counter() - start_time
+
+        migration.logging.shutdown()
+        os.chdir(REPO_DIR)
+
+    migration_stand_ins.stop_stand_in_servers(servers)
+    dataverse_check = check_dataverse_records(servers, knowledge_base)
+    wait_totals = migration.get_wait_totals()
+    print_report(article_count, elapsed_seconds, servers, dataverse_check)
+
+    baseline = run_baseline() if args.baseline else None
+    print_recovery_report(article_count, elapsed_seconds, wait_totals, baseline)
+    if trace_path:
+        print_slowest_traces(trace_path)
+
+    if json_path:
+        with open(json_path, "w") as json_file:
+            json.dump({
+                "settings": vars(args),
+                "articles": article_count,
+                "seconds": elapsed_seconds,
+                "articles_per_minute": article_count / elapsed_seconds * 60,
+                "dataverse": dataverse_check,
+                "waits": wait_totals,
+                "request_counts": {server_name: server.stand_in["request_counts"]
+                                   for server_name, server in servers.items()},
+                "steps": {step_name: {"calls": len(durations),
+                                      "p50_ms": get_percentile(durations, 50) * 1000,
+                                      "p95_ms": get_percentile(durations, 95) * 1000,
+                                      "total_seconds": sum(durations)}
+                          for step_name, durations in step_timings.items()}
+            }, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
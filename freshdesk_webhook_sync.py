@@ -0,0 +1,444 @@
+# Near-real-time sync of Freshdesk article webhooks to Dynamics
+#
+# Runs alongside the batch migration during cutover: Freshdesk article
+# create/update/delete webhooks are received on a local HTTP endpoint,
+# coalesced per article, and applied with the steps of the migration script.
+#
+# Usage:
+#   python freshdesk_webhook_sync.py --env d
+#   python freshdesk_webhook_sync.py --dry-run    # log the coalesced events without calling Freshdesk or Dynamics
+#
+# Webhook body (set in the Freshdesk webhook):
+#   {"event": "article_updated", "article_id": 123}
+# with event one of article_created, article_updated or article_deleted
+
+import os
+import json
+import hmac
+import argparse
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import knowledge_article_migration as migration
+
+logger = migration.logger
+
+# Webhook endpoint settings
+WEBHOOK_HOST = "127.0.0.1"  # Put a reverse proxy in front to receive webhooks from Freshdesk
+WEBHOOK_PORT = 8765
+WEBHOOK_PATH = "/freshdesk/webhook"
+WEBHOOK_MAX_BODY_BYTES = 64 * 1024  # Larger bodies are rejected with a 413
+
+# Event queue settings
+WEBHOOK_MAX_PENDING_ARTICLES = 1000  # Articles waiting to sync before the endpoint pushes back
+WEBHOOK_ENQUEUE_TIMEOUT_SECONDS = 5  # Longest a webhook waits for room in the queue before getting a 503
+WEBHOOK_MAX_WAITING_REQUESTS = 32  # Webhooks held waiting for room; more get a 503 straight away
+WEBHOOK_RETRY_AFTER_SECONDS = 30  # Retry-After sent with a 503
+WEBHOOK_COALESCE_SECONDS = 2  # Quiet time after an article's last event before it syncs
+WEBHOOK_MAX_COALESCE_SECONDS = 30  # Longest an article waits for a burst of events to end
+WEBHOOK_SYNC_WORKERS = migration.MAX_WORKERS  # Articles synced at the same time
+WEBHOOK_RELINK_SECONDS = 60  # Wait between relink passes while articles are being synced
+
+# Webhook events and the sync action they lead to
+WEBHOOK_EVENTS = {
+    "article_created": "update",
+    "article_updated": "update",
+    "article_deleted": "delete"
+}
+
+# Dynamics state of articles deleted in Freshdesk (Archived)
+ARCHIVED_STATECODE = 5
+ARCHIVED_STATUSCODE = 12
+
+# Shared secret expected in the X-Webhook-Token header (set from parameters.json by load_webhook_token)
+webhook_token = None
+
+# Coalesced events waiting to sync, keyed by Freshdesk article ID in order of arrival
+event_condition = threading.Condition()
+pending_events = OrderedDict()
+in_flight_articles = set()
+stop_event = threading.Event()
+
+# Request threads allowed to wait for room in the queue
+waiting_requests = threading.BoundedSemaphore(WEBHOOK_MAX_WAITING_REQUESTS)
+
+# Set when synced articles may have links for the relink pass
+relink_needed = threading.Event()
+
+# Freshdesk folders of webhook articles, keyed by folder ID
+folder_cache = {}
+folder_cache_lock = threading.Lock()
+
+
+# Get the webhook shared secret, if one is configured
+def load_webhook_token(parameters_path="./parameters.json"):
+    global webhook_token
+
+    if not os.path.exists(parameters_path):
+        return
+
+    with open(parameters_path) as parameters_file:
+        webhook_token = json.load(parameters_file).get("freshdesk_webhook_token")
+
+
+# Queue a webhook event, merging it with the events already waiting for the same article
+def queue_webhook_event(article_id, action, timeout=WEBHOOK_ENQUEUE_TIMEOUT_SECONDS):
+    """
+    The latest event of an article wins: the sync reads the current article
+    from Freshdesk, so a burst of updates syncs once.
+
+    Returns:
+        True if the event was queued, False if the queue stayed full for timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+
+    with event_condition:
+        # Events for an article already waiting are merged, so they never need room
+        while article_id not in pending_events and len(pending_events) >= WEBHOOK_MAX_PENDING_ARTICLES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            event_condition.wait(remaining)
+
+        received_at = time.monotonic()
+        pending_event = pending_events.get(article_id)
+        if pending_event is None:
+            pending_events[article_id] = {
+                "action": action,
+                "first_received": received_at,
+                "last_received": received_at,
+                "event_count": 1
+            }
+        else:
+            pending_event["action"] = action
+            pending_event["last_received"] = received_at
+            pending_event["event_count"] += 1
+
+        event_condition.notify_all()
+
+    return True
+
+
+# Take the next article whose burst of events is over, waiting until there is one
+def take_ready_event():
+    """
+    An article is ready once no event has arrived for WEBHOOK_COALESCE_SECONDS,
+    or WEBHOOK_MAX_COALESCE_SECONDS after its first event. Articles being
+    synced are skipped, so new events for them sync afterwards.
+
+    Returns:
+        Tuple of (Freshdesk article ID, event), or None once the service stops
+    """
+    with event_condition:
+        while not stop_event.is_set():
+            now = time.monotonic()
+            next_ready_at = None
+
+            for article_id, pending_event in pending_events.items():
+                if article_id in in_flight_articles:
+                    continue
+
+                ready_at = min(pending_event["last_received"] + WEBHOOK_COALESCE_SECONDS,
+                               pending_event["first_received"] + WEBHOOK_MAX_COALESCE_SECONDS)
+                if ready_at <= now:
+                    del pending_events[article_id]
+                    in_flight_articles.add(article_id)
+                    event_condition.notify_all()
+                    return article_id, pending_event
+
+                next_ready_at = ready_at if next_ready_at is None else min(next_ready_at, ready_at)
+
+            event_condition.wait(None if next_ready_at is None else next_ready_at - now)
+
+    return None
+
+
+# Release an article once its sync is over
+def finish_event(article_id):
+    with event_condition:
+        in_flight_articles.discard(article_id)
+        event_condition.notify_all()
+
+
+# Stop the sync workers, leaving any queued events unsynced
+def stop_sync():
+    stop_event.set()
+    with event_condition:
+        event_condition.notify_all()
+
+
+# Get a Freshdesk folder, from the cache if it was seen before
+def get_folder(folder_id):
+    with folder_cache_lock:
+        folder = folder_cache.get(folder_id)
+    if folder is not None:
+        return folder
+
+    folder = migration.freshdesk_get(f"{migration.freshdesk_url}solutions/folders/{folder_id}")
+    if folder is None:
+        raise Exception(f"Folder {folder_id} not found in Freshdesk")
+
+    with folder_cache_lock:
+        folder_cache[folder_id] = folder
+    return folder
+
+
+# Get the current version of a webhook article from Freshdesk, tagged like a crawled article
+def get_webhook_article(article_id):
+    """
+    Returns:
+        The article, or None if it no longer exists in Freshdesk
+    """
+    response = migration.freshdesk_request(f"{migration.freshdesk_url}solutions/articles/{article_id}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+
+    article = response.json()
+    return migration.tag_folder_article(article, get_folder(article["folder_id"]))
+
+
+# Archive the Dynamics article, and its French translation, of an article deleted in Freshdesk
+def archive_deleted_article(article_id, existing_article, api_session):
+    if existing_article is None:
+        logger.info(f"Deleted article {article_id} was never migrated to Dynamics")
+        print(f"Deleted article {article_id} was never migrated to Dynamics")
+        return
+
+    knowledgearticleids = [existing_article["knowledgearticleid"]]
+    translated_article_id = migration.find_french_translation(
+        api_session, existing_article["knowledgearticleid"])
+    if translated_article_id is not None:
+        knowledgearticleids.append(translated_article_id)
+
+    archive_data = {
+        "statecode": ARCHIVED_STATECODE,
+        "statuscode": ARCHIVED_STATUSCODE
+    }
+    for knowledgearticleid in knowledgearticleids:
+        migration.make_api_call(
+            api_session, f"{migration.dynamics_url}api/data/v9.2/knowledgearticles({knowledgearticleid})",
+            "PATCH", archive_data)
+
+    with migration.state_lock:
+        migration.migrated_articles.pop(article_id, None)
+    migration.mark_article_changed(article_id)
+
+    logger.info(f"Archived article {article_id} deleted in Freshdesk")
+    print(f"Archived article {article_id} deleted in Freshdesk")
+
+
+# Apply the coalesced event of one article to Dynamics
+def apply_webhook_event(article_id, action):
+    api_session = migration.get_worker_session()
+    existing_articles = migration.find_existing_articles(api_session, [article_id])
+    existing_article = existing_articles.get(article_id)
+
+    article = None if action == "delete" else get_webhook_article(article_id)
+    if article is None:
+        archive_deleted_article(article_id, existing_article, api_session)
+        return
+
+    # Created or updated: the same steps as a delta sync of one article
+    migration.load_link_targets(api_session, [article], existing_articles)
+    if not migration.sync_article_worker(article, existing_article):
+        raise Exception(f"Article {article_id} failed to sync")
+    relink_needed.set()
+
+
+# Sync coalesced events until the service stops (runs on each sync worker thread)
+def sync_events_forever(dry_run=False):
+    while True:
+        ready_event = take_ready_event()
+        if ready_event is None:
+            return
+
+        article_id, pending_event = ready_event
+        try:
+            if not dry_run:
+                apply_webhook_event(article_id, pending_event["action"])
+                migration.save_state_log()
+
+            lag_seconds = time.monotonic() - pending_event["first_received"]
+            logger.info(
+                f"Synced {pending_event['action']} of article {article_id} from {pending_event['event_count']} events, "
+                f"{lag_seconds:.1f} seconds after the first")
+            print(
+                f"Synced {pending_event['action']} of article {article_id} from {pending_event['event_count']} events, "
+                f"{lag_seconds:.1f} seconds after the first")
+
+        except Exception as err:
+            logger.error(
+                f"Failed to sync {pending_event['action']} of article {article_id}, left for the next delta sync: {err}")
+            print(
+                f"Failed to sync {pending_event['action']} of article {article_id}, left for the next delta sync: {err}")
+
+        finally:
+            finish_event(article_id)
+
+
+# Rewrite links that have become resolvable, every WEBHOOK_RELINK_SECONDS while articles sync (runs on the relinker thread)
+def relink_forever():
+    while not stop_event.wait(WEBHOOK_RELINK_SECONDS):
+        if not relink_needed.is_set():
+            continue
+        relink_needed.clear()
+
+        try:
+            migration.update_internal_links(migration.get_worker_session())
+            migration.flush_journal()
+        except Exception as err:
+            logger.error(f"Relink pass failed: {err}")
+            print(f"Relink pass failed: {err}")
+            relink_needed.set()
+
+
+# Handler for Freshdesk webhook requests
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # The webhook URL may carry a query string
+        if urlparse(self.path).path != WEBHOOK_PATH:
+            self.send_json(404, {"error": "not found"})
+            return
+
+        if webhook_token and not hmac.compare_digest(self.headers.get("X-Webhook-Token", ""), webhook_token):
+            self.send_json(401, {"error": "invalid webhook token"})
+            return
+
+        content_length = int(self.headers.get("Content-Length") or 0)
+        if content_length > WEBHOOK_MAX_BODY_BYTES:
+            self.send_json(413, {"error": "body too large"})
+            return
+
+        try:
+            payload = json.loads(self.rfile.read(content_length))
+            action = WEBHOOK_EVENTS[payload["event"]]
+            article_id = int(payload["article_id"])
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": f"expected {{\"event\": one of {sorted(WEBHOOK_EVENTS)}, \"article_id\": ...}}"})
+            return
+
+        # Backpressure: hold the request while the queue is full, then ask Freshdesk to retry later
+        if waiting_requests.acquire(blocking=False):
+            try:
+                queued = queue_webhook_event(article_id, action)
+            finally:
+                waiting_requests.release()
+        else:
+            queued = queue_webhook_event(article_id, action, timeout=0)
+
+        if not queued:
+            logger.warning(f"Webhook queue full, rejected {payload['event']} of article {article_id}")
+            self.send_json(503, {"error": "queue full"},
+                           {"Retry-After": str(WEBHOOK_RETRY_AFTER_SECONDS)})
+            return
+
+        self.send_json(202, {"queued": article_id})
+
+    def do_GET(self):
+        request_path = urlparse(self.path).path
+
+        if request_path == "/metrics":
+            migration.send_prometheus_metrics(self)
+            return
+
+        if request_path != "/health":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        with event_condition:
+            queue_status = {"pending": len(pending_events), "in_flight": len(in_flight_articles),
+                            "capacity": WEBHOOK_MAX_PENDING_ARTICLES}
+        self.send_json(200, queue_status)
+
+    def send_json(self, status_code, body, headers=None):
+        response_body = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+# Set up the migration state the sync steps use, as main does for a batch run
+def prepare_migration(environment_choice):
+    migration.configure_environment(environment_choice)
+    migration.open_state_log()
+    migration.load_client_secret()
+    migration.open_image_cache()
+    migration.open_content_store()
+    migration.load_freshdesk_api_key()
+
+    # Categories must already be imported by a batch run
+    migration.imported_categories = migration.get_dynamics_categories()
+    migration.language_dict = migration.get_languages()
+
+
+# Start the endpoint, the sync workers and the relinker
+def start_sync_service(host=WEBHOOK_HOST, port=WEBHOOK_PORT, sync_workers=WEBHOOK_SYNC_WORKERS, dry_run=False):
+    """
+    Returns:
+        The HTTP server, serving on a background thread
+    """
+    for worker_number in range(sync_workers):
+        threading.Thread(target=sync_events_forever, args=(dry_run,),
+                         name=f"webhook-sync-{worker_number}", daemon=True).start()
+    if not dry_run:
+        threading.Thread(target=relink_forever, name="webhook-relinker", daemon=True).start()
+
+    server = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+
+    logger.info(f"Listening for Freshdesk webhooks on http://{host}:{server.server_address[1]}{WEBHOOK_PATH}")
+    print(f"Listening for Freshdesk webhooks on http://{host}:{server.server_address[1]}{WEBHOOK_PATH}")
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync Freshdesk article webhooks to Dynamics 365.")
+    parser.add_argument("--env", choices=sorted(migration.DYNAMICS_ENVIRONMENTS),
+                        help='"d" for Dev, "e" for DevPortal, "s" for Staging or "p" for Production (prompted if omitted)')
+    parser.add_argument("--host", default=WEBHOOK_HOST, help=f"Address to listen on (default: {WEBHOOK_HOST})")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help=f"Port to listen on (default: {WEBHOOK_PORT})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Log the coalesced events without calling Freshdesk or Dynamics")
+    args = parser.parse_args()
+
+    load_webhook_token()
+    if not args.dry_run:
+        environment_choice = args.env or input(
+            'Please enter "d" for Dev, "e" for DevPortal, "s" for Staging, or "p" for Production environment: ').lower()
+        prepare_migration(environment_choice)
+
+    server = start_sync_service(args.host, args.port, dry_run=args.dry_run)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping webhook sync...")
+    finally:
+        server.shutdown()
+        stop_sync()
+        migration.flush_journal()
+        migration.flush_saved_images()
+
+        with event_condition:
+            unsynced_count = len(pending_events)
+        if unsynced_count:
+            logger.warning(f"{unsynced_count} articles left unsynced; run a delta sync to pick them up")
+            print(f"{unsynced_count} articles left unsynced; run a delta sync to pick them up")
+
+
+if __name__ == "__main__":
+    main()
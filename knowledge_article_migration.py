@@ -2,11 +2,27 @@
 
 import os
 import re
+import copy
+import argparse
 import logging
+import functools
+import contextlib
 import requests
 from requests.auth import HTTPBasicAuth
 import json
 import base64
+import hashlib
+import zlib
+import queue
+import uuid
+from email.utils import parsedate_to_datetime
+import threading
+import sqlite3
+from collections import deque
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 import variables
@@ -16,6 +32,12 @@ from datetime import datetime, timezone
 from icecream import ic
 import time
 
+# Optional faster JSON serializer for the state log
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Create and configure logger
 LOG_FORMAT = "%(levelname)s %(asctime)s - %(message)s"
 logging.basicConfig(filename="./knowledge_article_migration.log",
@@ -34,67 +56,173 @@ def get_utc_datetime():
 # Start timer
 overall_start_time = datetime.now()
 
-# Get Freshdesk API
-with open("./parameters.json") as file:
-    parameters = json.load(file)
-
-freshdesk_api_key = parameters["freshdesk_api"]
+# Freshdesk API (the key is loaded from parameters.json by load_freshdesk_api_key)
+freshdesk_api_key = None
 freshdesk_url = "https://yourcompany.freshdesk.com/api/v2/"
 
+# Helpdesk portal whose article links are rewritten (replace with your actual helpdesk domain)
+freshdesk_portal_domain = "helpdesk.yourcompany.com"
+FRESHDESK_ARTICLE_PATH = re.compile(r"/solutions/articles/(\d+)")
+LINK_HREF_PATTERN = re.compile(r"""<a\s[^>]*?href\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+
+# Link titles added to links that point at draft articles
+DRAFT_LINK_NOTES = {
+    "en": "Note: This article is currently in draft status",
+    "fr": "Remarque: Cet article est actuellement à l'état de brouillon"
+}
+
+# Dataverse $batch settings
+USE_BATCH_REQUESTS = True  # Pack the per-article Dataverse calls into $batch requests
+BATCH_MAX_ARTICLES = 25  # Articles per $batch request (Dataverse allows 1000 operations)
+
+# Concurrency settings
+MAX_WORKERS = 4  # Articles (or $batch requests) migrated at the same time
+MAX_CONNECTIONS_PER_HOST = 8  # Open connections allowed to any one host
+
+# Token settings
+TOKEN_REFRESH_MARGIN_SECONDS = 300  # Refresh the access token this long before it expires
+
+# Retry and Dataverse service protection settings
+RETRY_WAIT_SECONDS = 30  # Wait before retrying a failed step (throttling is waited out in make_api_call)
+REQUEST_TIMEOUT_SECONDS = (10, 120)  # Connect and read timeouts of every request, so a hung connection is retried instead of holding its pool slot
+DATAVERSE_MAX_THROTTLE_RETRIES = 10  # 429 responses waited out before make_api_call gives up
+DATAVERSE_REQUESTS_PER_WINDOW = 6000  # Service protection request limit per user
+DATAVERSE_WINDOW_SECONDS = 300  # Service protection sliding window
+DATAVERSE_BURST_RESERVE = 100  # Pace requests once fewer than this many remain in the window
+DATAVERSE_TIME_RESERVE_MS = 60000  # Pace requests once less execution time than this remains
+
+# Article number resolution settings
+ARTICLE_NUMBER_BATCH_SIZE = 50  # Article IDs per bulk articlepublicnumber query
+ARTICLE_NUMBER_POLL_SECONDS = 5  # Wait between bulk queries while numbers are still being generated
+ARTICLE_NUMBER_TIMEOUT_SECONDS = 300  # Longest wait for pending numbers at the end of a chunk
+
+# Freshdesk rate limit settings (calibrated from the X-RateLimit-Total header)
+FRESHDESK_RATE_LIMIT_PER_MINUTE = 100  # Starting budget until Freshdesk reports the plan's limit
+FRESHDESK_MAX_THROTTLE_RETRIES = 5  # 429 responses waited out before giving up on a request
+FRESHDESK_MAX_ERROR_RETRIES = 3  # 5xx responses, dropped connections and timeouts retried before giving up on a request
+
+# Freshdesk pagination
+FRESHDESK_PAGE_SIZE = 100  # Items per page for Freshdesk list endpoints (maximum 100)
+
+# Translations listed with each folder by the crawl, by Freshdesk language code
+# (the Dynamics steps migrate "fr"; other locales are saved with the articles)
+TRANSLATION_LOCALES = ["fr"]
+
+# Migration journal settings
+JOURNAL_PATH = "./data/migration_journal.sqlite"  # Completed steps per Freshdesk article, read by --resume
+JOURNAL_COMMIT_EVERY = 25  # Journal entries per commit (each commit is one fsync)
+JOURNAL_COMMIT_SECONDS = 5  # Longest time a journal entry waits for its commit
+
+# Migrated article state log settings
+STATE_LOG_PATH = "./data/migrated_articles_{env}.jsonl"  # Changed migrated_articles records, appended after every chunk
+STATE_LOG_COMPACT_RATIO = 3  # Compact the log once it holds this many lines per article
+STATE_LOG_COMPACT_MIN_LINES = 1000  # Smaller logs are never compacted
+
+# Image cache settings
+IMAGE_CACHE_PATH = "./data/image_cache.sqlite"  # Web resources by image hash, kept across runs
+
+# Article content store settings
+CONTENT_STORE_PATH = "./data/article_content.sqlite"  # HTML written to each Dynamics article, kept across runs
+
+# Delta sync settings
+SYNC_STATE_PATH = "./data/sync_state.sqlite"  # Latest Freshdesk updated_at synced per folder, kept across runs
+
+# Metrics settings
+METRICS_PATH = "./data/metrics_{env}.jsonl"  # Per-phase and per-host metrics, one summary appended after every chunk
+METRICS_PORT = None  # Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (or --metrics-port)
+METRICS_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]  # Phase duration histogram bounds in seconds
+
+# Trace settings
+TRACE_ARTICLES = False  # Record one trace per Freshdesk article (or --trace)
+TRACE_PATH = "./data/traces_{env}.jsonl"  # Article spans in the OTLP JSON format, appended after every chunk
+
+# Image pipeline settings
+IMAGE_DOWNLOAD_WORKERS = 8  # Images downloaded and uploaded at the same time
+IMAGE_MAX_BYTES = 10 * 1024 * 1024  # Larger images are skipped and keep their Freshdesk URL
+IMAGE_CHUNK_SIZE = 64 * 1024  # Bytes read from the connection at a time
+SAVE_IMAGES_TO_DISK = False  # Also write every downloaded image to ./data/images in the background
+IMAGE_WRITE_QUEUE_SIZE = 32  # Images waiting to be written before downloads wait for the disk
+IMAGE_UPLOAD_LOCK_COUNT = 64  # Locks shared out among image hashes to serialise their uploads
+
+# HTML parser used for article bodies: "html.parser", or "lxml" (faster) if it is installed
+HTML_PARSER = "html.parser"
+
+# Connection pool shared by every session, so the per-host limit holds across workers
+http_adapter = HTTPAdapter(pool_connections=10,
+                           pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+                           pool_block=True)
+
+# Session for image downloads
+image_session = requests.Session()
+image_session.mount("https://", http_adapter)
+image_session.mount("http://", http_adapter)
+
+
+# Dataverse environments: URL, refresh token variable and scope variable in variables.py
+DYNAMICS_ENVIRONMENTS = {
+    "d": ("https://yourorg-dev.crm3.dynamics.com/", "refresh_token_dev", "scope_dev"),  # Dev
+    "e": ("https://yourorg-devportal.crm3.dynamics.com/", "refresh_token_devportal", "scope_dev"),  # Dev Portal
+    "s": ("https://yourorg-staging.crm3.dynamics.com/", "refresh_token_staging", "scope_staging"),  # Staging
+    "p": ("https://yourorg-prod.crm3.dynamics.com/", "refresh_token_prod", "scope_prod")  # Production
+}
+
+# Dataverse API (set by configure_environment)
+dynamics_url = None
+static_refresh_token = None
+scope = None
+env = None
+
+# Client credentials (set by load_client_secret)
+secret = None
+client_id = None
+authority = None
+
+
+# Select the Dataverse environment
+def configure_environment(environment_choice):
+    global dynamics_url, static_refresh_token, scope, env
+
+    dynamics_url, refresh_token_name, scope_name = DYNAMICS_ENVIRONMENTS[environment_choice.lower()]
+    static_refresh_token = getattr(variables, refresh_token_name)
+    scope = getattr(variables, scope_name)
+
+    env = re.search(r"-(.*?).crm3", dynamics_url).group(1)
 
-# Dataverse API
-global dynamics_url
-
-# Prompt user for environment selection
-environment_prompt = input(
-    'Please enter "d" for Dev, "e" for DevPortal, "s" for Staging, or "p" for Production environment: ')
-if environment_prompt.lower() == "d":
-    # Dev
-    dynamics_url = "https://yourorg-dev.crm3.dynamics.com/"
-    static_refresh_token = variables.refresh_token_dev
-    scope = variables.scope_dev
-if environment_prompt.lower() == "e":
-    # Dev Portal
-    dynamics_url = "https://yourorg-devportal.crm3.dynamics.com/"
-    static_refresh_token = variables.refresh_token_devportal
-    scope = variables.scope_dev
-elif environment_prompt.lower() == "s":
-    # Staging
-    dynamics_url = "https://yourorg-staging.crm3.dynamics.com/"
-    static_refresh_token = variables.refresh_token_staging
-    scope = variables.scope_staging
-elif environment_prompt.lower() == "p":
-    # Production
-    dynamics_url = "https://yourorg-prod.crm3.dynamics.com/"
-    static_refresh_token = variables.refresh_token_prod
-    scope = variables.scope_prod
 
 # Get secret from keyvault
-key_vault_name = variables.KEY_VAULT_NAME
-secret_name = "your-secret-name"
-kv_uri = variables.KEY_VAULT_URI
+def load_client_secret():
+    global secret, client_id, authority
 
-credential = DefaultAzureCredential()
-client = SecretClient(vault_url=kv_uri, credential=credential)
+    key_vault_name = variables.KEY_VAULT_NAME
+    secret_name = "your-secret-name"
+    kv_uri = variables.KEY_VAULT_URI
 
-secret = client.get_secret(secret_name)
+    credential = DefaultAzureCredential()
+    client = SecretClient(vault_url=kv_uri, credential=credential)
 
-client_id = variables.client_id
-authority = variables.authority
+    secret = client.get_secret(secret_name)
 
-env = re.search(r"-(.*?).crm3", dynamics_url).group(1)
+    client_id = variables.client_id
+    authority = variables.authority
 
 
-# Get access token using refresh token
-def new_access_token():
-    global access_token, refresh_token
+# Token manager shared by every Dataverse session
+token_lock = threading.Lock()
+token_state = {
+    "access_token": None,
+    "refresh_token": None,
+    "expires_at": 0.0  # time.monotonic() at which the access token expires
+}
+token_refresher = None
 
+
+# Request a new access token using the refresh token (call with token_lock held)
+def request_new_access_token():
     tenant = variables.tenant_id
     client_secret = secret.value
 
-    # Check if refresh token is defined
-    current_refresh_token = refresh_token if ("refresh_token" in locals(
-    ) or "refresh_token" in globals()) else static_refresh_token
+    # Use the rotated refresh token once we have one
+    current_refresh_token = token_state["refresh_token"] or static_refresh_token
 
     redirect_uri = "https://login.microsoftonline.com/common/oauth2/nativeclient"
 
@@ -108,15 +236,17 @@ def new_access_token():
         "scope": scope
     }
 
-    response = requests.post(token_url, data=payload)
+    response = requests.post(token_url, data=payload, timeout=REQUEST_TIMEOUT_SECONDS)
     if response.status_code == 200:
         token_response = response.json()
-        access_token = token_response["access_token"]
-        refresh_token = token_response["refresh_token"]
+        token_state["access_token"] = token_response["access_token"]
+        token_state["refresh_token"] = token_response["refresh_token"]
+        token_state["expires_at"] = time.monotonic() + \
+            int(token_response.get("expires_in", 3600))
         logger.info("Access token refreshed!")
         print("Access token refreshed!")
 
-        return access_token
+        return token_state["access_token"]
     else:
         logger.error(f"Failed to obtain tokens: {response.status_code}")
         logger.error(response.json())
@@ -124,14 +254,79 @@ def new_access_token():
         print(response.json())
 
 
+# Get access token using refresh token
+def new_access_token(stale_token=None):
+    """
+    Force a token refresh.
+
+    Args:
+        stale_token: Token that was just rejected. If another worker has
+            already replaced it, its token is returned without a new refresh.
+    """
+    with token_lock:
+        if stale_token is not None and token_state["access_token"] not in (None, stale_token):
+            return token_state["access_token"]
+        return request_new_access_token()
+
+
+# Get a valid access token, refreshing it if it is about to expire
+def get_access_token():
+    with token_lock:
+        if (token_state["access_token"] is None
+                or time.monotonic() >= token_state["expires_at"] - TOKEN_REFRESH_MARGIN_SECONDS):
+            request_new_access_token()
+        access_token = token_state["access_token"]
+
+    start_token_refresher()
+    return access_token
+
+
+# Refresh the token ahead of expiry, forever (runs on the token-refresher thread)
+def refresh_token_ahead_of_expiry():
+    while True:
+        with token_lock:
+            wait_time = token_state["expires_at"] - \
+                TOKEN_REFRESH_MARGIN_SECONDS - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+            continue
+
+        with token_lock:
+            if time.monotonic() >= token_state["expires_at"] - TOKEN_REFRESH_MARGIN_SECONDS:
+                if request_new_access_token() is None:
+                    # Don't spin on a failing token endpoint
+                    token_state["expires_at"] = time.monotonic() + \
+                        TOKEN_REFRESH_MARGIN_SECONDS + RETRY_WAIT_SECONDS
+
+
+# Start the background token refresher if it isn't running
+def start_token_refresher():
+    global token_refresher
+
+    if token_refresher is not None and token_refresher.is_alive():
+        return
+
+    with token_lock:
+        if token_refresher is None or not token_refresher.is_alive():
+            token_refresher = threading.Thread(
+                target=refresh_token_ahead_of_expiry, name="token-refresher", daemon=True)
+            token_refresher.start()
+
+
+# Adds the current bearer token to every Dataverse request
+class BearerTokenAuth(requests.auth.AuthBase):
+    def __call__(self, request):
+        request.headers["Authorization"] = f"Bearer {get_access_token()}"
+        return request
+
+
 # Create and manage API session
 def create_api_session():
     """Create and configure a requests session for Dataverse API calls"""
-    global access_token
-
     session = requests.Session()
+    session.mount("https://", http_adapter)
+    session.auth = BearerTokenAuth()
     session.headers.update({
-        "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
         "Prefer": "return=representation",
         "OData-MaxVersion": "4.0",
@@ -142,21 +337,715 @@ def create_api_session():
     return session
 
 
-# Make an API call with automatic token refresh on 401 errors
-def make_api_call(session, url, method='GET', json_data=None, max_retries=3):
-    """Make an API call with automatic token refresh on 401 errors"""
-    global access_token
+# Thread-local Dataverse sessions for concurrent workers
+worker_sessions = threading.local()
 
-    for attempt in range(max_retries):
+
+def get_worker_session():
+    """Get this thread's Dataverse session"""
+    if getattr(worker_sessions, "session", None) is None:
+        worker_sessions.session = create_api_session()
+
+    return worker_sessions.session
+
+
+# Per-phase and per-host metrics. Phases are timed where they run; every
+# request and wait is counted against the innermost phase of its thread
+metrics_lock = threading.Lock()
+phase_metrics = {}
+host_metrics = {}
+metrics_context = threading.local()
+last_metrics_snapshot = None
+
+# Waits that pace requests or wait on Dataverse rather than retry a failure
+PACING_WAIT_REASONS = {"freshdesk_rate_limit", "category_delay", "fr_category_delay", "article_number_poll"}
+
+# Time lost to requests that timed out; the retry that follows is counted by its own wait
+TIMEOUT_WAIT_REASONS = {"dataverse_timeout", "freshdesk_timeout", "image_download_timeout"}
+
+
+def new_phase_metrics():
+    return {
+        "count": 0,
+        "errors": 0,  # Phase runs that raised
+        "seconds": 0.0,
+        "buckets": [0] * len(METRICS_LATENCY_BUCKETS),  # Runs per duration bucket (the rest took longer)
+        "requests": 0,
+        "failed_requests": 0,  # Connection errors, 401s, 429s and 5xx responses
+        "bytes_sent": 0,
+        "bytes_received": 0,
+        "retries": 0,
+        "wait_seconds": 0.0
+    }
+
+
+def new_host_metrics():
+    return {"requests": 0, "status_classes": {}, "bytes_sent": 0, "bytes_received": 0, "seconds": 0.0}
+
+
+# Get the innermost phase measured on this thread
+def get_current_phase(default_phase="other"):
+    phases = getattr(metrics_context, "phases", None)
+    if phases:
+        return phases[-1]
+    return getattr(metrics_context, "default_phase", None) or default_phase
+
+
+# Count the requests and waits of this thread against a phase while no phase is measured
+def set_default_phase(phase):
+    metrics_context.default_phase = phase
+
+
+# Time a phase of the migration and count the requests and waits made in it
+@contextlib.contextmanager
+def measure_phase(phase):
+    if getattr(metrics_context, "phases", None) is None:
+        metrics_context.phases = []
+    metrics_context.phases.append(phase)
+    started_at = time.monotonic()
+    failed = False
+
+    try:
+        with trace_span(phase):
+            yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        metrics_context.phases.pop()
+        seconds = time.monotonic() - started_at
+
+        with metrics_lock:
+            metrics = phase_metrics.setdefault(phase, new_phase_metrics())
+            metrics["count"] += 1
+            metrics["errors"] += failed
+            metrics["seconds"] += seconds
+            for bucket_index, bucket_bound in enumerate(METRICS_LATENCY_BUCKETS):
+                if seconds <= bucket_bound:
+                    metrics["buckets"][bucket_index] += 1
+                    break
+
+
+# Decorator that measures every call of a function as a phase
+def measured_phase(phase):
+    def decorator(function):
+        @functools.wraps(function)
+        def measured_function(*args, **kwargs):
+            with measure_phase(phase):
+                return function(*args, **kwargs)
+        return measured_function
+    return decorator
+
+
+# Size of a request body in bytes
+def get_body_size(body):
+    if body is None:
+        return 0
+    return len(body.encode("utf-8")) if isinstance(body, str) else len(body)
+
+
+# Count one HTTP request against the current phase and its host
+def record_request(url, seconds, response=None, default_phase="other", stream=False, method="GET"):
+    """
+    Args:
+        response: The response, or None if the request failed without one
+        default_phase: Phase of requests made outside any measured phase
+        stream: The body hasn't been read, so its size is taken from Content-Length
+        method: HTTP method, for requests that failed without a response
+    """
+    parsed_url = urlparse(url)
+    host = parsed_url.netloc
+    phase = get_current_phase(default_phase)
+
+    if response is None:
+        status_class = "error"
+        bytes_sent = bytes_received = 0
+        failed = True
+    else:
+        status_class = f"{response.status_code // 100}xx"
+        bytes_sent = get_body_size(response.request.body)
+        bytes_received = int(response.headers.get("Content-Length") or 0) if stream else len(response.content)
+        failed = response.status_code in (401, 429) or response.status_code >= 500
+
+    if get_trace_parent() is not None:
+        method = response.request.method if response is not None else method
+        span_attributes = {
+            "http.request.method": method,
+            "server.address": host,
+            "url.full": urlunparse(parsed_url._replace(query="")),  # Signed image URLs carry credentials in the query
+            "http.request.body.size": bytes_sent,
+            "http.response.body.size": bytes_received,
+            "migration.phase": phase
+        }
+        if response is None:
+            error = "no response"
+        else:
+            span_attributes["http.response.status_code"] = response.status_code
+            error = f"status code {response.status_code}" if response.status_code >= 400 else None
+        record_span(f"{method} {host}", seconds, span_attributes, SPAN_KIND_CLIENT, error)
+
+    with metrics_lock:
+        metrics = phase_metrics.setdefault(phase, new_phase_metrics())
+        metrics["requests"] += 1
+        metrics["failed_requests"] += failed
+        metrics["bytes_sent"] += bytes_sent
+        metrics["bytes_received"] += bytes_received
+
+        metrics = host_metrics.setdefault(host, new_host_metrics())
+        metrics["requests"] += 1
+        metrics["status_classes"][status_class] = metrics["status_classes"].get(status_class, 0) + 1
+        metrics["bytes_sent"] += bytes_sent
+        metrics["bytes_received"] += bytes_received
+        metrics["seconds"] += seconds
+
+
+# Copy of every metric, for the summaries and the /metrics endpoint
+def get_metrics_snapshot():
+    with metrics_lock:
+        snapshot = {"phases": copy.deepcopy(phase_metrics), "hosts": copy.deepcopy(host_metrics)}
+    snapshot["waits"] = get_wait_totals()
+    with state_lock:
+        snapshot["articles_created"] = article_count - 1
+    return snapshot
+
+
+# Difference between two metrics snapshots (numbers, lists of numbers and dicts of them)
+def subtract_metrics(current, previous):
+    if isinstance(current, dict):
+        previous = previous if isinstance(previous, dict) else {}
+        return {key: subtract_metrics(value, previous.get(key)) for key, value in current.items()}
+    if isinstance(current, list):
+        previous = previous or [0] * len(current)
+        return [current_value - previous_value for current_value, previous_value in zip(current, previous)]
+    return current - (previous or 0)
+
+
+# Append a metrics summary to the metrics file: the totals so far and the change since the last summary
+def write_metrics_summary(chunk_label):
+    global last_metrics_snapshot
+
+    snapshot = get_metrics_snapshot()
+    summary = {
+        "chunk": chunk_label,
+        "written_at": get_utc_datetime(),
+        "elapsed_seconds": (datetime.now() - overall_start_time).total_seconds(),
+        "chunk_metrics": subtract_metrics(snapshot, last_metrics_snapshot),
+        "total_metrics": snapshot
+    }
+    last_metrics_snapshot = snapshot
+
+    metrics_path = METRICS_PATH.format(env=env)
+    metrics_dir = os.path.dirname(metrics_path)
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+    with open(metrics_path, "ab") as metrics_file:
+        metrics_file.write(serialize_json_line(summary))
+
+
+# Render every metric in the Prometheus text format
+def render_prometheus_metrics():
+    snapshot = get_metrics_snapshot()
+    lines = []
+
+    def add_metric(name, metric_type, help_text, samples):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"])
+        for labels, value in samples:
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    phases = sorted(snapshot["phases"].items())
+    lines.extend(["# HELP migration_phase_seconds Duration of each migration phase",
+                  "# TYPE migration_phase_seconds histogram"])
+    for phase, metrics in phases:
+        cumulative_count = 0
+        for bucket_bound, bucket_count in zip(METRICS_LATENCY_BUCKETS, metrics["buckets"]):
+            cumulative_count += bucket_count
+            lines.append(f'migration_phase_seconds_bucket{{phase="{phase}",le="{bucket_bound}"}} {cumulative_count}')
+        lines.append(f'migration_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {metrics["count"]}')
+        lines.append(f'migration_phase_seconds_sum{{phase="{phase}"}} {metrics["seconds"]}')
+        lines.append(f'migration_phase_seconds_count{{phase="{phase}"}} {metrics["count"]}')
+
+    for key, help_text in [("errors", "Phase runs that raised"),
+                           ("requests", "HTTP requests made in each phase"),
+                           ("failed_requests", "Requests that failed with a connection error, 401, 429 or 5xx"),
+                           ("bytes_sent", "Request body bytes sent in each phase"),
+                           ("bytes_received", "Response body bytes received in each phase"),
+                           ("retries", "Waits before a failed request or step was tried again"),
+                           ("wait_seconds", "Seconds slept on retry, throttling and delay paths")]:
+        add_metric(f"migration_phase_{key}_total", "counter", help_text,
+                   [({"phase": phase}, metrics[key]) for phase, metrics in phases])
+
+    hosts = sorted(snapshot["hosts"].items())
+    add_metric("migration_host_requests_total", "counter", "HTTP requests per host and status class",
+               [({"host": host, "status_class": status_class}, count)
+                for host, metrics in hosts for status_class, count in sorted(metrics["status_classes"].items())])
+    for key, metric_name, help_text in [("bytes_sent", "bytes_sent", "Request body bytes sent per host"),
+                                        ("bytes_received", "bytes_received", "Response body bytes received per host"),
+                                        ("seconds", "request_seconds", "Seconds spent waiting on requests per host")]:
+        add_metric(f"migration_host_{metric_name}_total", "counter", help_text,
+                   [({"host": host}, metrics[key]) for host, metrics in hosts])
+
+    waits = sorted(snapshot["waits"].items())
+    add_metric("migration_waits_total", "counter", "Waits per reason",
+               [({"reason": wait_reason}, totals["count"]) for wait_reason, totals in waits])
+    add_metric("migration_wait_seconds_total", "counter", "Seconds waited per reason (summed over workers)",
+               [({"reason": wait_reason}, totals["seconds"]) for wait_reason, totals in waits])
+    add_metric("migration_articles_created_total", "counter", "Dynamics articles created",
+               [({}, snapshot["articles_created"])])
+
+    return "\n".join(lines) + "\n"
+
+
+# Answer a request with every metric in the Prometheus text format
+def send_prometheus_metrics(handler):
+    body = render_prometheus_metrics().encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+# Serves /metrics in the Prometheus text format
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+
+        send_prometheus_metrics(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics on a background thread
+def start_metrics_server(port, host="127.0.0.1"):
+    metrics_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever,
+                     name="metrics-server", daemon=True).start()
+
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return metrics_server
+
+
+# Per-article traces. Spans opened while a thread works on traced articles are
+# recorded in the trace of each of them, so a span shared by several articles
+# (a $batch request, a bulk number query) appears in every one of their traces
+trace_lock = threading.Lock()
+article_traces = {}  # Trace ID and root span ID keyed by Freshdesk article ID
+finished_spans = []  # (Freshdesk article ID, OTLP span) tuples waiting to be written
+trace_context = threading.local()
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+SPAN_STATUS_ERROR = 2
+
+
+# Random hex ID, 16 bytes for trace IDs and 8 bytes for span IDs
+def new_trace_id(byte_count=16):
+    return os.urandom(byte_count).hex()
+
+
+# Span attribute in the OTLP JSON format
+def format_span_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        # OTLP JSON writes 64-bit integers as strings
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+# Spans open on this thread, innermost last
+def get_open_spans():
+    if getattr(trace_context, "spans", None) is None:
+        trace_context.spans = []
+    return trace_context.spans
+
+
+# Get the innermost span open on this thread, or None if it isn't working on a traced article
+def get_trace_parent():
+    spans = getattr(trace_context, "spans", None)
+    return spans[-1] if spans else None
+
+
+# Queue a finished span for writing, once per article trace it belongs to
+def finish_span(span, end_ns, error=None):
+    attributes = [format_span_attribute(key, value)
+                  for key, value in span["attributes"].items()]
+
+    with trace_lock:
+        for freshdesk_article_id, trace_id, span_id, parent_span_id in span["traces"]:
+            otlp_span = {
+                "traceId": trace_id,
+                "spanId": span_id,
+                "parentSpanId": parent_span_id,
+                "name": span["name"],
+                "kind": span["kind"],
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(end_ns),
+                "attributes": attributes
+            }
+            if error is not None:
+                otlp_span["status"] = {"code": SPAN_STATUS_ERROR, "message": str(error)}
+            finished_spans.append((freshdesk_article_id, otlp_span))
+
+
+# Open a span under the given (article ID, trace ID, parent span ID) tuples
+@contextlib.contextmanager
+def open_span(name, parent_traces, attributes=None, kind=SPAN_KIND_INTERNAL):
+    span = {
+        "name": name,
+        "kind": kind,
+        "attributes": dict(attributes or {}),
+        "start_ns": time.time_ns(),
+        "traces": [(freshdesk_article_id, trace_id, new_trace_id(8), parent_span_id)
+                   for freshdesk_article_id, trace_id, parent_span_id in parent_traces]
+    }
+    spans = get_open_spans()
+    spans.append(span)
+    error = None
+
+    try:
+        yield span
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        spans.pop()
+        finish_span(span, time.time_ns(), error)
+
+
+# Trace part of the work on some articles, as a child of each article's root span
+@contextlib.contextmanager
+def trace_articles(freshdesk_article_ids, name, attributes=None):
+    if not TRACE_ARTICLES or not freshdesk_article_ids:
+        yield None
+        return
+
+    parent_traces = []
+    with trace_lock:
+        for freshdesk_article_id in dict.fromkeys(int(article_id) for article_id in freshdesk_article_ids):
+            article_trace = article_traces.setdefault(freshdesk_article_id, {
+                "trace_id": new_trace_id(16),
+                "root_span_id": new_trace_id(8),
+                "root_written": False
+            })
+            parent_traces.append(
+                (freshdesk_article_id, article_trace["trace_id"], article_trace["root_span_id"]))
+
+    with open_span(name, parent_traces, attributes) as span:
+        yield span
+
+
+# Trace a step as a child of the innermost open span; does nothing outside a traced article
+@contextlib.contextmanager
+def trace_span(name, attributes=None, kind=SPAN_KIND_INTERNAL, freshdesk_article_ids=None):
+    """
+    Args:
+        freshdesk_article_ids: Record the step only in the traces of these
+            articles, for per-article work inside a span shared by several
+    """
+    parent = get_trace_parent()
+    if parent is None:
+        yield None
+        return
+
+    if freshdesk_article_ids is not None:
+        freshdesk_article_ids = {int(article_id) for article_id in freshdesk_article_ids}
+    parent_traces = [(freshdesk_article_id, trace_id, span_id)
+                     for freshdesk_article_id, trace_id, span_id, _ in parent["traces"]
+                     if freshdesk_article_ids is None or freshdesk_article_id in freshdesk_article_ids]
+    with open_span(name, parent_traces, attributes, kind) as span:
+        yield span
+
+
+# Record a step that has just finished and took the given seconds, such as an HTTP request
+def record_span(name, seconds, attributes=None, kind=SPAN_KIND_INTERNAL, error=None):
+    parent = get_trace_parent()
+    if parent is None:
+        return
+
+    end_ns = time.time_ns()
+    span = {
+        "name": name,
+        "kind": kind,
+        "attributes": attributes or {},
+        "start_ns": end_ns - int(seconds * 1e9),
+        "traces": [(freshdesk_article_id, trace_id, new_trace_id(8), span_id)
+                   for freshdesk_article_id, trace_id, span_id, _ in parent["traces"]]
+    }
+    finish_span(span, end_ns, error)
+
+
+# Continue the traces of another thread's open span on this thread, such as on a pool worker
+@contextlib.contextmanager
+def continue_trace(parent):
+    if parent is None:
+        yield
+        return
+
+    spans = get_open_spans()
+    spans.append(parent)
+    try:
+        yield
+    finally:
+        spans.pop()
+
+
+# Append the finished spans to the trace file as one OTLP JSON export request
+def write_article_traces():
+    """
+    The root span of an article ("article <id>") is written with its first
+    spans and covers them; spans finished after that, such as a relink in a
+    later chunk, are still its children.
+
+    Returns:
+        Number of spans written
+    """
+    global finished_spans
+
+    with trace_lock:
+        spans_to_write = finished_spans
+        finished_spans = []
+
+        article_extents = {}
+        for freshdesk_article_id, otlp_span in spans_to_write:
+            start_ns, end_ns = article_extents.get(freshdesk_article_id, (None, None))
+            span_start_ns = int(otlp_span["startTimeUnixNano"])
+            span_end_ns = int(otlp_span["endTimeUnixNano"])
+            article_extents[freshdesk_article_id] = (
+                span_start_ns if start_ns is None else min(start_ns, span_start_ns),
+                span_end_ns if end_ns is None else max(end_ns, span_end_ns))
+
+        root_spans = []
+        for freshdesk_article_id, (start_ns, end_ns) in article_extents.items():
+            article_trace = article_traces[freshdesk_article_id]
+            if article_trace["root_written"]:
+                continue
+            article_trace["root_written"] = True
+            root_spans.append({
+                "traceId": article_trace["trace_id"],
+                "spanId": article_trace["root_span_id"],
+                "name": f"article {freshdesk_article_id}",
+                "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(end_ns),
+                "attributes": [format_span_attribute("freshdesk.article_id", freshdesk_article_id)]
+            })
+
+    if not spans_to_write:
+        return 0
+
+    export_request = {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                format_span_attribute("service.name", "knowledge-article-migration"),
+                format_span_attribute("deployment.environment", env)
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": "knowledge_article_migration"},
+                "spans": root_spans + [otlp_span for _, otlp_span in spans_to_write]
+            }]
+        }]
+    }
+
+    trace_path = TRACE_PATH.format(env=env)
+    trace_dir = os.path.dirname(trace_path)
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    with open(trace_path, "ab") as trace_file:
+        trace_file.write(serialize_json_line(export_request))
+
+    return len(root_spans) + len(spans_to_write)
+
+
+# Time spent on retry, throttling and fixed delay paths, by reason (summed over all workers)
+wait_totals_lock = threading.Lock()
+wait_totals = {}
+
+
+# Add time spent waiting to the totals of its reason and of the current phase
+def record_wait(wait_reason, seconds):
+    with wait_totals_lock:
+        reason_totals = wait_totals.setdefault(wait_reason, {"count": 0, "seconds": 0.0})
+        reason_totals["count"] += 1
+        reason_totals["seconds"] += seconds
+
+    phase = get_current_phase("freshdesk_crawl" if wait_reason.startswith("freshdesk_") else "other")
+    with metrics_lock:
+        metrics = phase_metrics.setdefault(phase, new_phase_metrics())
+        metrics["wait_seconds"] += seconds
+        if wait_reason not in PACING_WAIT_REASONS and wait_reason not in TIMEOUT_WAIT_REASONS:
+            metrics["retries"] += 1
+
+
+# Sleep, counting the time against a wait reason
+def recorded_sleep(wait_reason, seconds):
+    record_wait(wait_reason, seconds)
+    with trace_span(f"sleep {wait_reason}", {"wait.reason": wait_reason, "wait.seconds": float(seconds)}):
+        time.sleep(seconds)
+
+
+# Copy of the wait totals, for reports
+def get_wait_totals():
+    with wait_totals_lock:
+        return {wait_reason: dict(reason_totals) for wait_reason, reason_totals in wait_totals.items()}
+
+
+# Dataverse service protection state shared by every worker
+dataverse_throttle_lock = threading.Lock()
+dataverse_throttle_state = {
+    "resume_at": 0.0,  # time.monotonic() before which no request is sent
+    "burst_remaining": None,
+    "time_remaining_ms": None,
+    "throttled_count": 0,
+    "throttled_seconds": 0.0
+}
+
+
+# Parse a Retry-After header given in seconds or as an HTTP date
+def parse_retry_after(retry_after):
+    if not retry_after:
+        return None
+
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+# Parse an x-ms-ratelimit header value such as "5999" or "1,199,999.00"
+def parse_ratelimit_header(value):
+    if value is None:
+        return None
+
+    try:
+        return float(value.replace(",", ""))
+    except ValueError:
+        return None
+
+
+# Hold the calling thread until Dataverse is ready for the next request
+def wait_for_dataverse_throttle():
+    while True:
+        with dataverse_throttle_lock:
+            wait_time = dataverse_throttle_state["resume_at"] - time.monotonic()
+        if wait_time <= 0:
+            return
+        recorded_sleep("dataverse_throttle", wait_time)
+
+
+# Update the shared throttle state from a Dataverse response
+def record_dataverse_throttle(response):
+    """
+    Read the service protection headers of a Dataverse response.
+
+    A 429 (or a 503 with Retry-After) pauses every worker for exactly the time
+    the server asks for. While the x-ms-ratelimit headers show the remaining
+    request count or execution time is nearly used up, requests are spaced
+    out at the sustained service protection rate instead of being sent as
+    fast as the workers can go.
+
+    Returns:
+        True if the response was throttled and the request should be resent
+    """
+    burst_remaining = parse_ratelimit_header(
+        response.headers.get("x-ms-ratelimit-burst-remaining-xrm-requests"))
+    time_remaining_ms = parse_ratelimit_header(
+        response.headers.get("x-ms-ratelimit-time-remaining-xrm-requests"))
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    throttled = response.status_code == 429 or (
+        response.status_code == 503 and retry_after is not None)
+
+    with dataverse_throttle_lock:
+        now = time.monotonic()
+
+        if burst_remaining is not None:
+            dataverse_throttle_state["burst_remaining"] = burst_remaining
+        if time_remaining_ms is not None:
+            dataverse_throttle_state["time_remaining_ms"] = time_remaining_ms
+
+        if throttled:
+            # Dataverse always sends Retry-After with a 429; fall back to a
+            # short pause if it doesn't
+            pause = retry_after if retry_after is not None else RETRY_WAIT_SECONDS
+            dataverse_throttle_state["resume_at"] = max(
+                dataverse_throttle_state["resume_at"], now + pause)
+            dataverse_throttle_state["throttled_count"] += 1
+            dataverse_throttle_state["throttled_seconds"] += pause
+        elif ((burst_remaining is not None and burst_remaining < DATAVERSE_BURST_RESERVE)
+              or (time_remaining_ms is not None and time_remaining_ms < DATAVERSE_TIME_RESERVE_MS)):
+            # Nearly out of budget: space requests at the sustained rate
+            spacing = DATAVERSE_WINDOW_SECONDS / DATAVERSE_REQUESTS_PER_WINDOW
+            dataverse_throttle_state["resume_at"] = max(
+                dataverse_throttle_state["resume_at"], now + spacing)
+
+    if throttled:
+        logger.warning(
+            f"Dataverse throttled the request ({response.status_code}), pausing all requests for {pause:.1f} seconds")
+        print(
+            f"Dataverse throttled the request ({response.status_code}), pausing all requests for {pause:.1f} seconds")
+
+    return throttled
+
+
+# Send one Dataverse request, waiting out service protection throttling
+def send_dataverse_request(session, url, method, json_data=None, data=None, headers=None):
+    for throttle_attempt in range(DATAVERSE_MAX_THROTTLE_RETRIES + 1):
+        wait_for_dataverse_throttle()
+
+        requested_at = time.monotonic()
         try:
             if method.upper() == "GET":
-                response = session.get(url)
+                response = session.get(
+                    url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
             elif method.upper() == "POST":
-                response = session.post(url, json=json_data)
+                response = session.post(
+                    url, json=json_data, data=data, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
             elif method.upper() == "PATCH":
-                response = session.patch(url, json=json_data)
+                response = session.patch(
+                    url, json=json_data, data=data, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
             elif method.upper() == "PUT":
-                response = session.put(url, json=json_data)
+                response = session.put(
+                    url, json=json_data, data=data, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+            elif method.upper() == "DELETE":
+                response = session.delete(
+                    url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+        except requests.exceptions.RequestException as err:
+            request_seconds = time.monotonic() - requested_at
+            record_request(url, request_seconds, method=method.upper())
+            if isinstance(err, requests.exceptions.Timeout):
+                # make_api_call retries GET and PATCH requests after its error backoff
+                record_wait("dataverse_timeout", request_seconds)
+            raise
+        record_request(url, time.monotonic() - requested_at, response)
+
+        if not record_dataverse_throttle(response):
+            break
+
+    return response
+
+
+# Make an API call with automatic token refresh on 401 errors
+def make_api_call(session, url, method='GET', json_data=None, max_retries=3, data=None, headers=None):
+    """Make an API call with automatic token refresh on 401 errors"""
+    for attempt in range(max_retries):
+        try:
+            response = send_dataverse_request(
+                session, url, method, json_data, data, headers)
 
             response.raise_for_status()
             return response
@@ -165,19 +1054,19 @@ def make_api_call(session, url, method='GET', json_data=None, max_retries=3):
             status_code = err.response.status_code
             if status_code == 401 and attempt < max_retries - 1:
                 logger.warning(
-                    "Received 401 error. Refreshing token and creating new session...")
-                print("Received 401 error. Refreshing token and creating new session...")
-
-                # Refresh token
-                new_access_token()
-
-                # Create a completely new session with the new token
-                session = create_api_session()
-
-                # Wait before retry (use exponential backoff)
-                wait_time = 5 * (2 ** attempt)
-                print(f"Waiting {wait_time} seconds before retrying...")
-                time.sleep(wait_time)
+                    "Received 401 error. Refreshing token and retrying...")
+                print("Received 401 error. Refreshing token and retrying...")
+
+                # Refresh token unless another worker already has; the session
+                # picks up the new token on the next request
+                rejected_authorization = err.response.request.headers.get(
+                    "Authorization", "")
+                refresh_started_at = time.monotonic()
+                new_access_token(
+                    stale_token=rejected_authorization.replace("Bearer ", "", 1))
+                refresh_seconds = time.monotonic() - refresh_started_at
+                record_wait("token_refresh_401", refresh_seconds)
+                record_span("token_refresh_401", refresh_seconds)
             else:
                 # If it's not a 401 or we've exceeded retries, log and raise
                 logger.error(
@@ -188,1154 +1077,3667 @@ def make_api_call(session, url, method='GET', json_data=None, max_retries=3):
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
             print(f"Unexpected error: {str(e)}")
+            # A POST that failed without a response may have been committed, so
+            # the caller looks up what it created instead of it being sent again
+            if method.upper() not in ("GET", "PATCH"):
+                raise
             if attempt < max_retries - 1:
                 wait_time = 5 * (2 ** attempt)
                 print(f"Waiting {wait_time} seconds before retrying...")
-                time.sleep(wait_time)
+                recorded_sleep("dataverse_error_backoff", wait_time)
             else:
                 raise
 
 
-# Freshdesk GET function
-def freshdesk_get(url):
-    global freshdesk_get_response
-    headers = {
-        "content-type": "application/json"
-    }
-
-    freshdesk_get_response = requests.get(
-        url=url,
-        auth=HTTPBasicAuth(freshdesk_api_key, ""),
-        headers=headers
-    )
-
-    repo = freshdesk_get_response.json()
+# Whether a request failed without a response, so Dataverse may have committed it anyway
+def is_outcome_unknown(err):
+    return isinstance(err, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
 
-    if freshdesk_get_response.status_code == 200:
-        while "next" in freshdesk_get_response.links.keys():
-            freshdesk_get_response = requests.get(
-                freshdesk_get_response.links["next"]["url"],
-                auth=HTTPBasicAuth(freshdesk_api_key, ""),
-                headers=headers
-            )
-            repo.extend(freshdesk_get_response.json())
-            ic(f"{freshdesk_get_response.links}")
-        return repo
-    else:
-        logger.error(freshdesk_get_response.status_code)
-        ic(freshdesk_get_response.status_code)
 
+# Dataverse $batch helpers
+def group_batch_operations(operations):
+    """
+    Group batch operations into top-level $batch parts.
 
-# Function to get folders of articles from Freshdesk
-def get_freshdesk_folders(category):
-    global kb_folders
-    kb_folders = []
-    id = category["id"]
-    folders_url = f"{freshdesk_url}solutions/categories/{id}/folders"
-    folders = freshdesk_get(folders_url)
-
-    for folder in folders:
-        folder_data = {}
-        folder_data["id"] = folder["id"]
-        folder_data["name"] = folder["name"]
-        folder_data["description"] = folder["description"]
-        folder_data["articles_count"] = folder["articles_count"]
-        folder_data["sub_folders_count"] = folder["sub_folders_count"]
-        folder_data["parent_folder_id"] = folder["hierarchy"][0]["data"]["id"]
-        folder_data["is_parent_folder"] = True
-        folder_data["visibility"] = folder["visibility"]
+    Consecutive operations sharing the same "changeset" key are sent together in
+    one change set; operations without a "changeset" key are sent on their own.
+    """
+    groups = []
+    for operation in operations:
+        changeset = operation.get("changeset")
+        if changeset is not None and groups and groups[-1][0] == changeset:
+            groups[-1][1].append(operation)
+        else:
+            groups.append((changeset, [operation]))
 
-        print(folder_data)
+    return groups
 
-        kb_folders.append(folder_data)
 
-        if folder_data["sub_folders_count"] > 0:
-            folder_to_query = folder_data["id"]
-            subfolder_url = f"{freshdesk_url}solutions/folders/{folder_to_query}/subfolders"
-            subfolders = freshdesk_get(subfolder_url)
-            for subfolder in subfolders:
-                subfolder_data = {}
-                subfolder_data["id"] = subfolder["id"]
-                subfolder_data["name"] = subfolder["name"]
-                subfolder_data["description"] = subfolder["description"]
-                subfolder_data["articles_count"] = subfolder["articles_count"]
-                subfolder_data["sub_folders_count"] = subfolder["sub_folders_count"]
-                subfolder_data["parent_folder_id"] = subfolder["parent_folder_id"]
-                subfolder_data["is_parent_folder"] = False
-                subfolder_data["visibility"] = subfolder["visibility"]
-                print(subfolder_data)
+def format_batch_operation(operation):
+    """Format a single operation as an application/http $batch part"""
+    lines = [
+        "Content-Type: application/http",
+        "Content-Transfer-Encoding: binary"
+    ]
+    if operation.get("content_id") is not None:
+        lines.append(f"Content-ID: {operation['content_id']}")
+    lines.append("")
+    lines.append(f"{operation['method'].upper()} {operation['url']} HTTP/1.1")
 
-                kb_folders.append(subfolder_data)
+    operation_headers = {"Accept": "application/json"}
+    if operation.get("json") is not None:
+        operation_headers["Content-Type"] = "application/json; type=entry"
+    operation_headers.update(operation.get("headers") or {})
+    for header, value in operation_headers.items():
+        lines.append(f"{header}: {value}")
 
+    lines.append("")
+    if operation.get("json") is not None:
+        lines.append(json.dumps(operation["json"]))
 
-# Initialize global dictionaries
-if "internal_articles_refs_dict" not in globals():
-    internal_articles_refs_dict = {}
-if "migrated_articles" not in globals():
-    migrated_articles = {}
+    return lines
 
 
-# Save internal article references to JSON
-def save_internal_references_to_json(output_file_path="./data/internal_article_references.json"):
-    global internal_articles_refs_dict
+def build_batch_body(operations, batch_boundary):
     """
-    Save the internal article references dictionary to a JSON file
-    
+    Build the multipart/mixed body of a Dataverse $batch request
+
     Args:
-        output_file_path (str): Path to the output JSON file
+        operations: List of operation dicts with "method" and "url" keys and
+            optional "json", "headers", "content_id" and "changeset" keys.
+            Within a change set, later operations can use "$<content_id>" as
+            their URL to reference an entity created earlier in the same set.
+        batch_boundary: Boundary string of the outer batch
     """
+    lines = []
 
-    # Ensure the directory exists
-    output_dir = os.path.dirname(output_file_path)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    for changeset, group_operations in group_batch_operations(operations):
+        lines.append(f"--{batch_boundary}")
+        if changeset is None:
+            lines.extend(format_batch_operation(group_operations[0]))
+        else:
+            changeset_boundary = f"changeset_{uuid.uuid4().hex}"
+            lines.append(
+                f"Content-Type: multipart/mixed; boundary={changeset_boundary}")
+            lines.append("")
+            for operation in group_operations:
+                lines.append(f"--{changeset_boundary}")
+                lines.extend(format_batch_operation(operation))
+            lines.append(f"--{changeset_boundary}--")
 
-    # Add timestamp to filename to avoid overwriting
-    filename, extension = os.path.splitext(output_file_path)
-    timestamp = get_utc_datetime()
-    output_file_with_timestamp = f"{filename}_{timestamp}{extension}"
+    lines.append(f"--{batch_boundary}--")
+    lines.append("")
 
-    # Save the internal article references to a JSON file
-    with open(output_file_with_timestamp, 'w') as f:
-        json.dump(internal_articles_refs_dict, f, indent=4)
+    return "\r\n".join(lines).encode("utf-8")
 
-    logger.info(
-        f"Saved internal article references to {output_file_with_timestamp}")
-    print(f"Saved internal article references to {output_file_with_timestamp}")
 
+def get_multipart_boundary(content_type):
+    boundary_match = re.search(r'boundary="?([^";]+)"?', content_type)
+    return boundary_match.group(1) if boundary_match else None
 
-# Get images function (includes internal article references, even though the function is named get_images)
-def get_images_and_internal_references(article, api_session=None):
-    global dynamics_url, headers, images, img_dict, article_index, internal_articles_refs_dict
 
-    # If no session is provided, create one
-    if api_session is None:
-        if not "access_token" in globals() or not access_token:
-            new_access_token()
-        api_session = create_api_session()
+def parse_header_lines(header_lines):
+    headers = {}
+    for line in header_lines:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
 
-    # Get the current UTC datetime as string
-    utc_datetime_str = get_utc_datetime()
+    return headers
 
-    # Extract article ID and title
-    id = article["id"]
-    title = article["title"]
 
-    if "img_dict" not in globals():
-        img_dict = {}
+def parse_batch_http_response(text, content_id=None):
+    """Parse an application/http part of a $batch response"""
+    status_block, _, body = text.partition("\n\n")
+    status_line, *header_lines = status_block.split("\n")
+    body = body.strip()
 
-    html_content = article["description"]
-    soup = BeautifulSoup(html_content, "html.parser")
+    try:
+        body_json = json.loads(body) if body else None
+    except json.JSONDecodeError:
+        body_json = None
 
-    # Extract internal article references (URLs containing your helpdesk domain)
-    all_a_tags = soup.find_all("a")
-    internal_articles_refs = []
+    return {
+        "content_id": content_id,
+        "status_code": int(status_line.split(" ")[1]),
+        "headers": parse_header_lines(header_lines),
+        "json": body_json,
+        "text": body
+    }
 
-    for a_tag in all_a_tags:
-        if a_tag.has_attr("href"):
-            href = a_tag["href"]
-            # Replace with your actual helpdesk domain
-            if "helpdesk.yourcompany.com" in href:
-                internal_articles_refs.append(href)
 
-    # Store the internal article references
-    internal_articles_refs_dict[id] = internal_articles_refs
+def parse_batch_parts(text, boundary):
+    """
+    Parse a multipart/mixed $batch response body.
 
-    # Extract img src
-    img_tags = soup.find_all("img")
-    img_urls = [img["src"] for img in img_tags]
+    Returns one entry per top-level part: a response dict for a single
+    operation, or a list of response dicts for a change set.
+    """
+    results = []
 
-    article_index = 0
+    for part in text.split(f"--{boundary}")[1:]:
+        if part.startswith("--"):
+            break
 
-    for img in img_urls:
-        image_name = f"{id}_{utc_datetime_str}_{article_index}"
-        local_path = f"./data/images/{image_name}.png"
-        article_index += 1
+        part_headers, _, part_body = part.strip("\n").partition("\n\n")
+        headers = parse_header_lines(part_headers.split("\n"))
+        content_type = headers.get("content-type", "")
 
-        retries = 0
-        success = False
-        while not success and retries < 3:
-            try:
-                # Send a GET request to the URL
-                response = requests.get(img)
+        if content_type.startswith("multipart/mixed"):
+            results.append(parse_batch_parts(
+                part_body, get_multipart_boundary(content_type)))
+        else:
+            results.append(parse_batch_http_response(
+                part_body, headers.get("content-id")))
 
-                # Check if the request was successful
-                if response.status_code == 200:
-                    # Open a file in binary write mode
-                    with open(local_path, "wb") as file:
-                        # Write the content of the response (the image) to the file
-                        file.write(response.content)
-                    logger.info("Image successfully downloaded and saved!")
-                    print("Image successfully downloaded and saved!")
-                else:
-                    logger.warning(f"Failed to retrieve image {image_name}.")
-                    print(f"Failed to retrieve the image {image_name}.")
-                    raise Exception(
-                        f"Failed to download image: status code {response.status_code}")
+    return results
 
-                # Read the image file and encode it in base64
-                with open(local_path, "rb") as file:
-                    file_content = file.read()
-                    file_base64 = base64.b64encode(
-                        file_content).decode("utf-8")
-
-                retries = 0
-                success = False
-                while not success and retries < 3:
-                    try:
-                        # Create a web resource with the image
-                        web_resource_data = {
-                            "name": image_name,
-                            "displayname": image_name,
-                            "description": f"Image for {title}",
-                            "content": file_base64,
-                            "webresourcetype": 5  # Type 5 for PNG images
-                        }
-                        web_resource_url = f"{dynamics_url}api/data/v9.2/webresourceset"
 
-                        web_resource_response = make_api_call(
-                            api_session, web_resource_url, "POST", web_resource_data)
+def execute_batch(api_session, operations):
+    """
+    Send operations to the Dataverse $batch endpoint.
 
-                        logger.info(
-                            f"Web resource response status code: {web_resource_response.status_code}")
-                        print(
-                            f"Web resource response status code: {web_resource_response.status_code}")
+    Change sets are atomic: if one operation fails, the whole change set is
+    rolled back and a single error response is returned for it. Other change
+    sets keep going because the batch is sent with odata.continue-on-error.
 
-                        if web_resource_response.status_code in [201, 204]:
-                            logger.info("Web resource created successfully!")
-                            print("Web resource created successfully!")
-                            # This URL should not contain "api/data/v9.2/"
-                            public_url = f"{dynamics_url}WebResources/{image_name}"
-                            logger.info(
-                                f"Public URL for the image: {public_url}")
-                            print(f"Public URL for the image: {public_url}")
-
-                            img_dict = {
-                                "article_id": id,
-                                "aws_url": img,
-                                "article_title": title,
-                                "local_path": local_path,
-                                "dynamics_image_url": public_url
-                            }
-
-                            images[image_name] = img_dict
-                            success = True
-                        else:
-                            logger.warning(
-                                f"Failed to create web resource for image: {image_name}.")
-                            print(
-                                f"Failed to create web resource. Status code: {web_resource_response.status_code}")
-                            try:
-                                logger.error(web_resource_response.json())
-                                print(web_resource_response.json())
-                            except json.JSONDecodeError:
-                                logger.error("No JSON response body.")
-                                print("No JSON response body.")
-                            raise Exception(
-                                f"Failed to create web resource: {web_resource_response.status_code}")
+    Returns:
+        List of dicts with "changeset", "operations" and "responses" keys, in
+        the same order as the top-level parts of the request
+    """
+    batch_url = f"{dynamics_url}api/data/v9.2/$batch"
+    batch_boundary = f"batch_{uuid.uuid4().hex}"
+    batch_headers = {
+        "Content-Type": f"multipart/mixed; boundary={batch_boundary}",
+        "Prefer": "odata.continue-on-error"
+    }
 
-                    except requests.exceptions.RequestException as err:
-                        logger.warning(
-                            f"Failed to create web resource for image: {image_name}. Error: {err}")
-                        print(
-                            f"Failed to create web resource for image: {image_name}. Error: {err}")
-                        retries += 1
-                        if retries < 3:
-                            logger.warning(
-                                f"Retrying web resource creation for {image_name} after 6 minutes...")
-                            print(
-                                f"Retrying web resource creation for {image_name} after 6 minutes...")
-                            # Wait for 6 minutes before retrying
-                            time.sleep(360)
-
-                            # Refresh token and session before retry
-                            new_access_token()
-                            api_session = create_api_session()
-                    except Exception as err:
-                        logger.warning(
-                            f"Other error in web resource creation: {err}")
-                        print(f"Other error in web resource creation: {err}")
-                        retries += 1
-                        if retries < 3:
-                            logger.warning(
-                                f"Retrying web resource creation for {image_name} after 6 minutes...")
-                            print(
-                                f"Retrying web resource creation for {image_name} after 6 minutes...")
-                            # Wait for 6 minutes before retrying
-                            time.sleep(360)
+    batch_response = make_api_call(
+        api_session, batch_url, "POST",
+        data=build_batch_body(operations, batch_boundary), headers=batch_headers)
+
+    response_text = batch_response.content.decode(
+        "utf-8").replace("\r\n", "\n")
+    response_boundary = get_multipart_boundary(
+        batch_response.headers.get("Content-Type", ""))
+    parsed_parts = parse_batch_parts(response_text, response_boundary)
+
+    operation_groups = group_batch_operations(operations)
+    if len(parsed_parts) != len(operation_groups):
+        raise Exception(
+            f"$batch response has {len(parsed_parts)} parts, expected {len(operation_groups)}")
+
+    batch_results = []
+    for (changeset, group_operations), part in zip(operation_groups, parsed_parts):
+        responses = part if isinstance(part, list) else [part]
+        responses = sorted(responses, key=lambda r: int(r["content_id"] or 0))
+        batch_results.append({
+            "changeset": changeset,
+            "operations": group_operations,
+            "responses": responses
+        })
 
-                            # Refresh token and session before retry
-                            new_access_token()
-                            api_session = create_api_session()
+    logger.info(
+        f"$batch request completed with {len(operations)} operations in {len(batch_results)} parts")
 
-            except requests.exceptions.RequestException as err:
-                logger.warning(
-                    f"Failed to migrate image {image_name} for {title}. Error: {err}")
-                print(
-                    f"Failed to migrate image {image_name} for {title}. Error: {err}")
-                retries += 1
-                if retries < 3:
-                    logger.warning(
-                        f"Retrying {image_name} migration after 6 minutes...")
-                    print(
-                        f"Retrying {image_name} migration after 6 minutes...")
-                    time.sleep(360)  # Wait for 6 minutes before retrying
-            except Exception as err:
-                logger.warning(f"Other error in image migration: {err}")
-                print(f"Other error in image migration: {err}")
-                retries += 1
-                if retries < 3:
-                    logger.warning(
-                        f"Retrying {image_name} migration after 6 minutes...")
-                    print(
-                        f"Retrying {image_name} migration after 6 minutes...")
-                    time.sleep(360)  # Wait for 6 minutes before retrying
+    return batch_results
 
 
-# Add categories to Dynamics function
-def import_categories_to_dynamics(category_set):
-    global access_token, imported_categories, dynamics_url
+def batch_group_succeeded(batch_result):
+    """Check that every operation of a batch part returned a success status"""
+    return (len(batch_result["responses"]) == len(batch_result["operations"])
+            and all(r["status_code"] < 400 for r in batch_result["responses"]))
 
-    # Ensure we have a valid token
-    if not "access_token" in globals() or not access_token:
-        new_access_token()
 
-    # Create a session
-    api_session = create_api_session()
+# Pooled Freshdesk session
+freshdesk_session = requests.Session()
+freshdesk_session.mount("https://", http_adapter)
+freshdesk_session.headers.update({
+    "content-type": "application/json"
+})
 
-    for category in category_set:
-        category_name = category["name"]
-        category_description = category["description"]
-        freshdesk_category_id = category["id"]
 
-        # Top-level categories
-        if "is_top_level" in category and category["is_top_level"] == 1:
-            category_data = {
-                "title": category_name,
-                "description": category_description,
-                "revops_freshdeskcategoryid": freshdesk_category_id,
-                "revops_istoplevelcategory": True
-            }
+# Get Freshdesk API key
+def load_freshdesk_api_key(parameters_path="./parameters.json"):
+    global freshdesk_api_key
 
-        else:
-            # In FD, visibility == 1 is external; 2 is logged in users; 3 is internal
-            # In Dynamics, isinternal == 1 means it is internal; 0 means external
+    with open(parameters_path) as file:
+        parameters = json.load(file)
 
-            # Top-level folders
-            if category["is_parent_folder"] == True:
-                parent_category_id = category["parent_folder_id"]
-                isinternal = False if category["visibility"] == 1 else True
-                category_data = {
-                    "title": category_name,
-                    "description": category_description,
-                    "revops_freshdeskcategoryid": freshdesk_category_id,
-                    "revops_istoplevelcategory": False,
-                    "revops_isinternal": isinternal,
-                    "parentcategoryid@odata.bind": f'/categories({imported_categories[parent_category_id]["categoryid"]})'
-                }
+    freshdesk_api_key = parameters["freshdesk_api"]
+    freshdesk_session.auth = HTTPBasicAuth(freshdesk_api_key, "")
 
-            # Subfolders
-            elif category["is_parent_folder"] == False:
-                parent_category_id = category["parent_folder_id"]
-                isinternal = False if category["visibility"] == 1 else True
-                category_data = {
-                    "title": category_name,
-                    "description": category_description,
-                    "revops_freshdeskcategoryid": freshdesk_category_id,
-                    "revops_istoplevelcategory": False,
-                    "revops_isinternal": isinternal,
-                    "parentcategoryid@odata.bind": f'/categories({imported_categories[parent_category_id]["categoryid"]})'
-                }
 
-        categories_url = f"{dynamics_url}api/data/v9.2/categories"
+# Token bucket shared by all Freshdesk traffic
+freshdesk_rate_lock = threading.Lock()
+freshdesk_rate_state = {
+    "capacity": FRESHDESK_RATE_LIMIT_PER_MINUTE,
+    "tokens": float(FRESHDESK_RATE_LIMIT_PER_MINUTE),
+    "refilled_at": time.monotonic(),
+    "resume_at": 0.0,  # time.monotonic() before which no request is sent
+    "remaining": None,  # Last X-RateLimit-Remaining reported by Freshdesk
+    "request_times": deque()  # Send times of the requests in the last minute
+}
 
-        try:
-            categories_response = make_api_call(
-                api_session, categories_url, "POST", category_data)
 
-            if categories_response.status_code in [201, 204]:
-                print("Category added successfully!")
-                imported_category = {}
-                freshdesk_id = category["id"]
-                imported_category["categoryid"] = categories_response.json()[
-                    "categoryid"]
-                imported_category["title"] = categories_response.json()[
-                    "title"]
-                imported_categories.update({freshdesk_id: imported_category})
+# Take a token from the Freshdesk bucket, waiting until one is available
+def acquire_freshdesk_token():
+    while True:
+        with freshdesk_rate_lock:
+            now = time.monotonic()
+            capacity = freshdesk_rate_state["capacity"]
+            refill_rate = capacity / 60
+
+            freshdesk_rate_state["tokens"] = min(
+                capacity,
+                freshdesk_rate_state["tokens"] + (now - freshdesk_rate_state["refilled_at"]) * refill_rate)
+            freshdesk_rate_state["refilled_at"] = now
+
+            if freshdesk_rate_state["resume_at"] > now:
+                wait_time = freshdesk_rate_state["resume_at"] - now
+            elif freshdesk_rate_state["tokens"] >= 1:
+                freshdesk_rate_state["tokens"] -= 1
+                freshdesk_rate_state["request_times"].append(now)
+                return
             else:
-                logger.warning(f"Failed to create category {category_name}.")
-                print(
-                    f"Failed to create category. Status code: {categories_response.status_code}")
+                wait_time = (1 - freshdesk_rate_state["tokens"]) / refill_rate
 
+        recorded_sleep("freshdesk_rate_limit", wait_time)
+
+
+# Calibrate the Freshdesk bucket from the rate limit headers of a response
+def record_freshdesk_rate(response):
+    """
+    Returns:
+        True if the response was a 429 and the request should be resent
+    """
+    total = parse_ratelimit_header(response.headers.get("X-RateLimit-Total"))
+    remaining = parse_ratelimit_header(
+        response.headers.get("X-RateLimit-Remaining"))
+    throttled = response.status_code == 429
+
+    with freshdesk_rate_lock:
+        if total:
+            freshdesk_rate_state["capacity"] = total
+        if remaining is not None:
+            # Freshdesk's count wins if it is lower than ours, e.g. when other
+            # clients share the API key
+            freshdesk_rate_state["remaining"] = remaining
+            freshdesk_rate_state["tokens"] = min(
+                freshdesk_rate_state["tokens"], remaining)
+
+        if throttled:
+            pause = parse_retry_after(response.headers.get("Retry-After"))
+            if pause is None:
+                pause = 60 / freshdesk_rate_state["capacity"]
+            freshdesk_rate_state["resume_at"] = max(
+                freshdesk_rate_state["resume_at"], time.monotonic() + pause)
+            freshdesk_rate_state["tokens"] = 0.0
+
+    if throttled:
+        logger.warning(
+            f"Freshdesk rate limit reached, pausing Freshdesk requests for {pause:.1f} seconds")
+        print(
+            f"Freshdesk rate limit reached, pausing Freshdesk requests for {pause:.1f} seconds")
+
+    return throttled
+
+
+# Current Freshdesk API spend
+def get_freshdesk_rate_status():
+    """
+    Returns:
+        Dict with the requests sent in the last minute, the per-minute limit
+        and the remaining budget last reported by Freshdesk
+    """
+    with freshdesk_rate_lock:
+        now = time.monotonic()
+        request_times = freshdesk_rate_state["request_times"]
+        while request_times and request_times[0] < now - 60:
+            request_times.popleft()
+
+        return {
+            "requests_per_minute": len(request_times),
+            "limit_per_minute": freshdesk_rate_state["capacity"],
+            "remaining": freshdesk_rate_state["remaining"]
+        }
+
+
+# Check whether a URL is served by Freshdesk and counts against its API budget
+def is_freshdesk_host(url):
+    host = urlparse(url).hostname or ""
+    return host == urlparse(freshdesk_url).hostname or host.endswith(".freshdesk.com")
+
+
+# Send a GET request to Freshdesk through the shared rate limiter
+def freshdesk_request(url, params=None, session=None, stream=False):
+    session = session or freshdesk_session
+    throttle_attempt = 0
+    error_attempt = 0
+
+    while True:
+        acquire_freshdesk_token()
+        requested_at = time.monotonic()
+        try:
+            response = session.get(url, params=params, stream=stream,
+                                   timeout=REQUEST_TIMEOUT_SECONDS)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            request_seconds = time.monotonic() - requested_at
+            record_request(url, request_seconds, default_phase="freshdesk_crawl")
+            if isinstance(err, requests.exceptions.Timeout):
+                record_wait("freshdesk_timeout", request_seconds)
+            if error_attempt >= FRESHDESK_MAX_ERROR_RETRIES:
+                raise
+            error = err
+        else:
+            record_request(url, time.monotonic() - requested_at, response,
+                           default_phase="freshdesk_crawl", stream=stream)
+            throttled = record_freshdesk_rate(response)
+            if throttled and throttle_attempt < FRESHDESK_MAX_THROTTLE_RETRIES:
+                throttle_attempt += 1
+                # Release the connection of the throttled response before retrying
+                response.close()
+                continue
+            if throttled or response.status_code < 500 or error_attempt >= FRESHDESK_MAX_ERROR_RETRIES:
+                return response
+            error = f"status code {response.status_code}"
+            response.close()
+
+        wait_time = 5 * (2 ** error_attempt)
+        error_attempt += 1
+        logger.warning(
+            f"Freshdesk request to {url} failed ({error}), retrying in {wait_time} seconds...")
+        print(
+            f"Freshdesk request to {url} failed ({error}), retrying in {wait_time} seconds...")
+        recorded_sleep("freshdesk_error_backoff", wait_time)
+
+
+# Freshdesk GET function
+def freshdesk_get(url):
+    freshdesk_get_response = freshdesk_request(url)
+
+    repo = freshdesk_get_response.json()
+
+    if freshdesk_get_response.status_code == 200:
+        while "next" in freshdesk_get_response.links.keys():
+            freshdesk_get_response = freshdesk_request(
+                freshdesk_get_response.links["next"]["url"])
+            repo.extend(freshdesk_get_response.json())
+            ic(f"{freshdesk_get_response.links}")
+        return repo
+    else:
+        logger.error(freshdesk_get_response.status_code)
+        ic(freshdesk_get_response.status_code)
+
+
+# Get one page of a Freshdesk list endpoint
+def freshdesk_get_page(url, page, per_page=FRESHDESK_PAGE_SIZE):
+    response = freshdesk_request(
+        url, params={"page": page, "per_page": per_page})
+
+    if response.status_code != 200:
+        logger.error(
+            f"Failed to get page {page} of {url}: {response.status_code}")
+        ic(response.status_code)
+        response.raise_for_status()
+
+    return response.json(), response
+
+
+# Stream the items of a Freshdesk list endpoint, fetching pages concurrently
+def freshdesk_iter(url, expected_count=None, per_page=FRESHDESK_PAGE_SIZE, max_workers=MAX_WORKERS):
+    """
+    Yield the items of a paginated Freshdesk list endpoint in page order.
+
+    The first page is fetched on its own. If it is full and has a next link,
+    the remaining pages are fetched concurrently: all of them at once when
+    expected_count tells us how many there are, otherwise in windows of
+    max_workers pages until a page comes back short.
+
+    Args:
+        url: Freshdesk list endpoint
+        expected_count: Number of items expected, e.g. a folder's articles_count
+        per_page: Page size (Freshdesk allows up to 100)
+        max_workers: Number of pages fetched at the same time
+    """
+    first_page, first_response = freshdesk_get_page(url, 1, per_page)
+    yield from first_page
+
+    if len(first_page) < per_page or "next" not in first_response.links:
+        return
+
+    next_page = 2
+    if expected_count:
+        window_size = max(-(-expected_count // per_page) - 1, 1)
+    else:
+        window_size = max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            pages = range(next_page, next_page + window_size)
+            for page_items, _ in executor.map(
+                    lambda page: freshdesk_get_page(url, page, per_page), pages):
+                yield from page_items
+                if len(page_items) < per_page:
+                    return
+
+            # Every page was full, keep probing
+            next_page += window_size
+            window_size = 1 if expected_count else max_workers
+
+
+# Build the folder record of a Freshdesk folder or subfolder
+def get_folder_record(folder, is_parent_folder):
+    folder_data = {}
+    folder_data["id"] = folder["id"]
+    folder_data["name"] = folder["name"]
+    folder_data["description"] = folder["description"]
+    folder_data["articles_count"] = folder["articles_count"]
+    folder_data["sub_folders_count"] = folder["sub_folders_count"]
+    if is_parent_folder:
+        folder_data["parent_folder_id"] = folder["hierarchy"][0]["data"]["id"]
+    else:
+        folder_data["parent_folder_id"] = folder["parent_folder_id"]
+    folder_data["is_parent_folder"] = is_parent_folder
+    folder_data["visibility"] = folder["visibility"]
+
+    return folder_data
+
+
+# Crawl the folders of a category and their subfolders to any depth
+def crawl_freshdesk_folders(category, max_workers=MAX_WORKERS):
+    """
+    List the folders of a category, then the subfolders of every folder
+    found, with up to max_workers listings in flight.
+
+    Yields:
+        Folder records as they arrive, each after its parent folder
+    """
+    folders_url = f"{freshdesk_url}solutions/categories/{category['id']}/folders"
+    folder_count = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Listing future -> whether it lists top-level folders
+        pending_listings = {executor.submit(list, freshdesk_iter(folders_url)): True}
+
+        while pending_listings:
+            done_listings, _ = wait(
+                pending_listings, return_when=FIRST_COMPLETED)
+
+            for listing in done_listings:
+                is_parent_folder = pending_listings.pop(listing)
+
+                for folder in listing.result():
+                    folder_data = get_folder_record(folder, is_parent_folder)
+                    print(folder_data)
+                    folder_count += 1
+                    yield folder_data
+
+                    if folder_data["sub_folders_count"] > 0:
+                        subfolder_url = f"{freshdesk_url}solutions/folders/{folder_data['id']}/subfolders"
+                        pending_listings[executor.submit(list, freshdesk_iter(
+                            subfolder_url, expected_count=folder_data["sub_folders_count"]))] = False
+
+    logger.info(
+        f"Found {folder_count} folders in category {category['id']}")
+    print(f"Found {folder_count} folders in category")
+
+
+# Function to get folders of articles from Freshdesk
+def get_freshdesk_folders(category):
+    global kb_folders
+    kb_folders = list(crawl_freshdesk_folders(category))
+
+
+# Tag an article with its folder and the Dynamics category and visibility of the folder
+def tag_folder_article(article, folder):
+    freshdesk_category_id = folder["id"]
+    category_visibility = folder["visibility"]
+
+    article["freshdesk_folder_id"] = freshdesk_category_id
+    article["dynamics_category_id"] = imported_categories[freshdesk_category_id]["categoryid"]
+    # In FD, visibility == 1 is external; 2 is logged in users; 3 is internal
+    # In Dynamics, isinternal == 1 means it is internal; 0 means external
+    article["dynamics_isinternal"] = False if category_visibility == 1 else True
+
+    return article
+
+
+# List the translations of the articles of a folder in one locale
+def get_folder_translations(folder, locale):
+    """
+    Returns:
+        Dict of translated articles keyed by Freshdesk article ID, or None
+        if the listing failed and the translations must be looked up one by one
+    """
+    translations_url = f"{freshdesk_url}solutions/folders/{folder['id']}/articles/{locale}"
+
+    try:
+        return {int(translation["id"]): translation for translation in freshdesk_iter(translations_url)}
+
+    except requests.exceptions.HTTPError as err:
+        # A folder that isn't translated has no listing in that locale
+        if err.response is not None and err.response.status_code == 404:
+            return {}
+
+        logger.warning(
+            f"Failed to list the {locale} translations of folder {folder['id']}: {err}")
+        print(
+            f"Failed to list the {locale} translations of folder {folder['id']}: {err}")
+        return None
+
+
+# List the articles of a folder, tagged with its Dynamics category and with their translations
+def get_folder_articles(folder):
+    print(folder["name"])
+    freshdesk_category_id = folder["id"]
+
+    articles_in_folder_url = f"{freshdesk_url}solutions/folders/{freshdesk_category_id}/articles"
+    articles_in_folder = list(freshdesk_iter(
+        articles_in_folder_url, expected_count=folder.get("articles_count")))
+
+    # One listing per locale replaces a lookup per article, and tells which articles have no translation
+    folder_translations = {locale: get_folder_translations(folder, locale)
+                           for locale in TRANSLATION_LOCALES} if articles_in_folder else {}
+
+    for article in articles_in_folder:
+        tag_folder_article(article, folder)
+        article["translations"] = {locale: translations.get(int(article["id"]))
+                                   for locale, translations in folder_translations.items()
+                                   if translations is not None}
+
+    return articles_in_folder
+
+
+# Stream the articles of a stream of folders
+def crawl_freshdesk_articles(folders, max_workers=MAX_WORKERS):
+    """
+    List the articles of each folder as soon as the folder arrives, with up
+    to max_workers listings in flight.
+
+    Yields:
+        Articles as their folder listing completes
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending_listings = set()
+
+        for folder in folders:
+            pending_listings.add(executor.submit(get_folder_articles, folder))
+
+            # Hand over finished listings while the crawl goes on, and keep the backlog bounded
+            done_listings, pending_listings = wait(
+                pending_listings, timeout=0 if len(pending_listings) < max_workers else None,
+                return_when=FIRST_COMPLETED)
+            for listing in done_listings:
+                yield from listing.result()
+
+        for listing in as_completed(pending_listings):
+            yield from listing.result()
+
+
+# Initialize global dictionaries
+if "internal_articles_refs_dict" not in globals():
+    internal_articles_refs_dict = {}
+if "migrated_articles" not in globals():
+    migrated_articles = {}
+
+# Categories imported into Dynamics and Dynamics languages (loaded by main)
+imported_categories = {}
+language_dict = {}
+article_count = 1
+
+# Lock guarding migrated_articles, internal_articles_refs_dict and article_count
+state_lock = threading.RLock()
+
+
+# Get the next article count for progress messages
+def increment_article_count():
+    global article_count
+
+    with state_lock:
+        count = article_count
+        article_count += 1
+
+    return count
+
+
+# Migration journal of the completed steps of every Freshdesk article
+journal_lock = threading.Lock()
+journal_connection = None
+journal_pending_writes = 0
+journal_committed_at = 0.0
+
+# Completed steps loaded from the journal by --resume, keyed by Freshdesk article ID
+journal_steps = {}
+
+
+# Open the migration journal, moving the previous one aside unless resuming
+def open_journal(resume=False, journal_path=JOURNAL_PATH):
+    global journal_connection, journal_committed_at
+
+    journal_dir = os.path.dirname(journal_path)
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    if not resume and os.path.exists(journal_path):
+        archived_path = f"{os.path.splitext(journal_path)[0]}_{get_utc_datetime()}.sqlite"
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(journal_path + suffix):
+                os.replace(journal_path + suffix, archived_path + suffix)
+        logger.info(f"Previous migration journal moved to {archived_path}")
+        print(f"Previous migration journal moved to {archived_path}")
+
+    with journal_lock:
+        journal_connection = sqlite3.connect(
+            journal_path, check_same_thread=False)
+        journal_connection.execute("PRAGMA journal_mode=WAL")
+        journal_connection.execute("PRAGMA synchronous=FULL")
+        journal_connection.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                freshdesk_article_id INTEGER NOT NULL,
+                step TEXT NOT NULL,
+                data TEXT,
+                recorded_at TEXT NOT NULL
+            )""")
+        journal_connection.execute("""
+            CREATE TABLE IF NOT EXISTS run_settings (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            )""")
+        journal_connection.commit()
+        journal_committed_at = time.monotonic()
+
+
+# Commit the journal entries written since the last commit (call with journal_lock held)
+def commit_journal():
+    global journal_pending_writes, journal_committed_at
+
+    journal_connection.commit()
+    journal_pending_writes = 0
+    journal_committed_at = time.monotonic()
+
+
+# Record a completed step of a Freshdesk article
+def record_step(freshdesk_article_id, step, data=None, commit=False):
+    """
+    Append a step to the journal. Entries are committed in groups of
+    JOURNAL_COMMIT_EVERY, or at least every JOURNAL_COMMIT_SECONDS.
+
+    Args:
+        freshdesk_article_id: Freshdesk article ID
+        step: created, number, category, published, fr_created, fr_content,
+            fr_number, fr_category, fr_published, fr_missing or links
+        data: Fields of the migrated_articles record set by this step
+        commit: Commit straight away (used for steps that must not be repeated)
+    """
+    global journal_pending_writes
+
+    mark_article_changed(freshdesk_article_id)
+
+    with journal_lock:
+        if journal_connection is None:
+            return
+
+        journal_connection.execute(
+            "INSERT INTO journal (freshdesk_article_id, step, data, recorded_at) VALUES (?, ?, ?, ?)",
+            (int(freshdesk_article_id), step,
+             json.dumps(data) if data is not None else None, get_utc_datetime()))
+        journal_pending_writes += 1
+
+        if commit or journal_pending_writes >= JOURNAL_COMMIT_EVERY or \
+                time.monotonic() - journal_committed_at >= JOURNAL_COMMIT_SECONDS:
+            commit_journal()
+
+
+# Commit any journal entries still waiting for a commit
+def flush_journal():
+    with journal_lock:
+        if journal_connection is not None and journal_pending_writes:
+            commit_journal()
+
+
+# Load the completed steps of every article from the journal
+def load_journal():
+    """
+    Returns:
+        Dict keyed by Freshdesk article ID of dicts mapping each completed
+        step to the data recorded with it, in the order they were recorded
+    """
+    completed_steps = {}
+
+    with journal_lock:
+        rows = journal_connection.execute(
+            "SELECT freshdesk_article_id, step, data FROM journal ORDER BY id").fetchall()
+
+    for freshdesk_article_id, step, data in rows:
+        completed_steps.setdefault(freshdesk_article_id, {})[step] = json.loads(
+            data) if data is not None else None
+
+    return completed_steps
+
+
+# Get a setting saved by an earlier run, such as the answers to the prompts
+def get_run_setting(name):
+    with journal_lock:
+        row = journal_connection.execute(
+            "SELECT value FROM run_settings WHERE name = ?", (name,)).fetchone()
+
+    return row[0] if row else None
+
+
+# Save a setting so a resumed run answers the same way
+def save_run_setting(name, value):
+    with journal_lock:
+        journal_connection.execute(
+            "INSERT OR REPLACE INTO run_settings (name, value) VALUES (?, ?)", (name, value))
+        commit_journal()
+
+
+# Check whether the journal shows every step of an article as done
+def is_article_complete(completed_steps):
+    if not {"created", "category", "published"} <= set(completed_steps):
+        return False
+
+    return "fr_missing" in completed_steps or "fr_published" in completed_steps
+
+
+# Rebuild migrated_articles and the internal references from the journal
+def restore_from_journal(completed_steps_by_article):
+    global migrated_articles, internal_articles_refs_dict
+
+    with state_lock:
+        for freshdesk_article_id, completed_steps in completed_steps_by_article.items():
+            if "created" not in completed_steps:
+                continue
+
+            article_record = migrated_articles.setdefault(
+                freshdesk_article_id, {})
+            for data in completed_steps.values():
+                if data:
+                    article_record.update(data)
+
+            register_internal_references(
+                freshdesk_article_id, article_record.get("internal_references", []))
+
+    logger.info(
+        f"Restored {len(migrated_articles)} migrated articles from the journal")
+    print(f"Restored {len(migrated_articles)} migrated articles from the journal")
+
+
+# Append-only log of migrated_articles records: one JSON line per changed record,
+# replayed in order so the last line of an article wins
+state_log_lock = threading.Lock()
+state_log_path = None
+state_log_line_count = 0
+state_log_article_ids = set()
+
+# Freshdesk article IDs whose migrated_articles record changed since the last save (guarded by state_lock)
+changed_article_ids = set()
+
+
+# Serialise a record as one compact JSON line
+def serialize_json_line(record):
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+# Parse one JSON line
+def deserialize_json_line(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+# Replay a state log into migrated_articles records
+def read_state_log(log_path):
+    """
+    Returns:
+        Tuple of (dict of records keyed by Freshdesk article ID, number of log lines)
+    """
+    records = {}
+    line_count = 0
+
+    if not os.path.exists(log_path):
+        return records, line_count
+
+    with open(log_path, "rb") as log_file:
+        for line in log_file:
+            try:
+                entry = deserialize_json_line(line)
+            except ValueError:
+                # A line cut short when a run stopped mid-write
+                continue
+
+            line_count += 1
+            if entry.get("deleted"):
+                records.pop(entry["id"], None)
+            else:
+                records[entry["id"]] = entry["record"]
+
+    return records, line_count
+
+
+# Open the state log of the current environment, which is kept across runs
+def open_state_log(log_path=None):
+    global state_log_path, state_log_line_count, state_log_article_ids
+
+    log_path = (log_path or STATE_LOG_PATH).format(env=env)
+    log_dir = os.path.dirname(log_path)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    records, line_count = read_state_log(log_path)
+
+    # Cut off a line left unfinished by a run that stopped mid-write, so appends start on a new line
+    if os.path.exists(log_path):
+        with open(log_path, "rb+") as log_file:
+            log_contents = log_file.read()
+            if log_contents and not log_contents.endswith(b"\n"):
+                log_file.truncate(log_contents.rfind(b"\n") + 1)
+
+    with state_log_lock:
+        state_log_path = log_path
+        state_log_line_count = line_count
+        state_log_article_ids = set(records)
+
+
+# Note that the migrated_articles record of an article changed
+def mark_article_changed(freshdesk_article_id):
+    with state_lock:
+        changed_article_ids.add(int(freshdesk_article_id))
+
+
+# Rewrite the state log with one line per article (call with state_log_lock held)
+def compact_state_log():
+    global state_log_line_count, state_log_article_ids
+
+    records, line_count = read_state_log(state_log_path)
+
+    compacted_path = f"{state_log_path}.compacting"
+    with open(compacted_path, "wb") as compacted_file:
+        for freshdesk_article_id, record in records.items():
+            compacted_file.write(serialize_json_line(
+                {"id": freshdesk_article_id, "record": record}))
+        compacted_file.flush()
+        os.fsync(compacted_file.fileno())
+    os.replace(compacted_path, state_log_path)
+
+    logger.info(
+        f"Compacted the state log from {line_count} to {len(records)} lines")
+    state_log_line_count = len(records)
+    state_log_article_ids = set(records)
+
+
+# Append the migrated_articles records changed since the last save to the state log
+def save_state_log():
+    """
+    The cost grows with the records changed since the last save rather than
+    with the whole migration. The log is compacted once it holds more than
+    STATE_LOG_COMPACT_RATIO lines per article.
+
+    Returns:
+        Number of records appended
+    """
+    global state_log_line_count
+
+    with state_log_lock:
+        if state_log_path is None:
+            return 0
+
+        with state_lock:
+            entries = []
+            for freshdesk_article_id in changed_article_ids:
+                article_data = migrated_articles.get(freshdesk_article_id)
+                if article_data is None:
+                    # Removed from migrated_articles, such as an archived article
+                    if freshdesk_article_id in state_log_article_ids:
+                        entries.append({"id": freshdesk_article_id, "deleted": True})
+                elif not article_data.get("link_target_only"):
+                    entries.append({"id": freshdesk_article_id, "record": article_data})
+            changed_article_ids.clear()
+
+            # Serialised under the lock, since workers update the records in place
+            log_lines = b"".join(serialize_json_line(entry) for entry in entries)
+
+        if not entries:
+            return 0
+
+        with open(state_log_path, "ab") as log_file:
+            log_file.write(log_lines)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+        state_log_line_count += len(entries)
+        for entry in entries:
+            if entry.get("deleted"):
+                state_log_article_ids.discard(entry["id"])
+            else:
+                state_log_article_ids.add(entry["id"])
+
+        if state_log_line_count >= STATE_LOG_COMPACT_MIN_LINES and \
+                state_log_line_count > STATE_LOG_COMPACT_RATIO * max(len(state_log_article_ids), 1):
+            compact_state_log()
+
+    return len(entries)
+
+
+# Write a full, indented snapshot of every article in the state log
+def write_state_snapshot():
+    """
+    Returns:
+        Path of the snapshot
+    """
+    save_state_log()
+
+    with state_log_lock:
+        records, _ = read_state_log(state_log_path)
+
+    snapshot_path = f"./data/migrated_articles_{env}_{get_utc_datetime()}.json"
+    with open(snapshot_path, "w") as snapshot_file:
+        json.dump(records, snapshot_file, indent=4)
+
+    logger.info(f"Wrote a snapshot of {len(records)} migrated articles to {snapshot_path}")
+    print(f"Wrote a snapshot of {len(records)} migrated articles to {snapshot_path}")
+
+    return snapshot_path
+
+
+# Local store of the HTML written to each Dynamics article, compressed and keyed by knowledgearticleid
+content_store_lock = threading.Lock()
+content_store_connection = None
+
+
+# Open the article content store, which is kept across runs
+def open_content_store(content_store_path=CONTENT_STORE_PATH):
+    global content_store_connection
+
+    content_store_dir = os.path.dirname(content_store_path)
+    if not os.path.exists(content_store_dir):
+        os.makedirs(content_store_dir)
+
+    with content_store_lock:
+        content_store_connection = sqlite3.connect(
+            content_store_path, check_same_thread=False)
+        content_store_connection.execute("PRAGMA journal_mode=WAL")
+        content_store_connection.execute("""
+            CREATE TABLE IF NOT EXISTS article_content (
+                knowledgearticleid TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                sha256 TEXT NOT NULL,
+                etag TEXT,
+                stored_at TEXT NOT NULL
+            )""")
+        content_store_connection.commit()
+
+
+# Get the ETag of a Dataverse response, if it has one
+def get_response_etag(response):
+    try:
+        return response.json().get("@odata.etag") or response.headers.get("ETag")
+    except ValueError:
+        return response.headers.get("ETag")
+
+
+# Store the HTML written to a Dynamics article
+def store_article_content(knowledgearticleid, content, etag=None):
+    """
+    Args:
+        knowledgearticleid: Dynamics article or translation ID
+        content: HTML as written to Dynamics
+        etag: ETag of the article after the write, if the response had one.
+            Without it the server copy is re-read before the stored HTML is used
+    """
+    content_bytes = content.encode("utf-8")
+
+    with content_store_lock:
+        if content_store_connection is None:
+            return
+
+        content_store_connection.execute(
+            "INSERT OR REPLACE INTO article_content (knowledgearticleid, content, sha256, etag, stored_at) VALUES (?, ?, ?, ?, ?)",
+            (knowledgearticleid, zlib.compress(content_bytes), hashlib.sha256(content_bytes).hexdigest(),
+             etag, get_utc_datetime()))
+        content_store_connection.commit()
+
+
+# Update the ETag of a stored article after a write that didn't change its content
+def set_article_content_etag(knowledgearticleid, etag):
+    with content_store_lock:
+        if content_store_connection is None or not etag:
+            return
+
+        content_store_connection.execute(
+            "UPDATE article_content SET etag = ? WHERE knowledgearticleid = ?", (etag, knowledgearticleid))
+        content_store_connection.commit()
+
+
+# Get the stored HTML of a Dynamics article
+def get_stored_article_content(knowledgearticleid):
+    """
+    Returns:
+        Dict with content, sha256 and etag, or None if it isn't stored
+    """
+    with content_store_lock:
+        if content_store_connection is None:
+            return None
+
+        row = content_store_connection.execute(
+            "SELECT content, sha256, etag FROM article_content WHERE knowledgearticleid = ?",
+            (knowledgearticleid,)).fetchone()
+
+    if row is None:
+        return None
+
+    content = zlib.decompress(row[0]).decode("utf-8")
+    if hashlib.sha256(content.encode("utf-8")).hexdigest() != row[1]:
+        logger.warning(f"Stored content of {knowledgearticleid} is corrupt")
+        return None
+
+    return {"content": content, "sha256": row[1], "etag": row[2]}
+
+
+# Record the current ETags of articles whose last write didn't return one, with one query per ARTICLE_NUMBER_BATCH_SIZE IDs
+def refresh_stored_etags(api_session, knowledgearticleids):
+    knowledgearticleids = list(knowledgearticleids)
+
+    for i in range(0, len(knowledgearticleids), ARTICLE_NUMBER_BATCH_SIZE):
+        id_values = ",".join(
+            f"'{knowledgearticleid}'" for knowledgearticleid in knowledgearticleids[i:i + ARTICLE_NUMBER_BATCH_SIZE])
+        versions_url = (
+            f"{dynamics_url}api/data/v9.2/knowledgearticles?$select=knowledgearticleid,versionnumber"
+            f"&$filter=Microsoft.Dynamics.CRM.In(PropertyName='knowledgearticleid',PropertyValues=[{id_values}])")
+
+        try:
+            versions_response = make_api_call(
+                api_session, versions_url, "GET")
+        except Exception as err:
+            logger.warning(f"Failed to get article versions: {err}")
+            continue
+
+        for item in versions_response.json().get("value", []):
+            set_article_content_etag(
+                item["knowledgearticleid"], item.get("@odata.etag"))
+
+
+# Get the current HTML of a Dynamics article, from the content store unless the server copy changed
+def get_article_content(api_session, knowledgearticleid):
+    article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({knowledgearticleid})?$select=content"
+
+    stored_content = get_stored_article_content(knowledgearticleid)
+    headers = None
+    if stored_content and stored_content["etag"]:
+        headers = {"If-None-Match": stored_content["etag"]}
+
+    article_response = make_api_call(
+        api_session, article_url, "GET", headers=headers)
+
+    if article_response.status_code == 304:
+        logger.info(
+            f"Using stored content of {knowledgearticleid} (unchanged since it was written)")
+        return stored_content["content"]
+
+    content = article_response.json().get("content", "") or ""
+    store_article_content(knowledgearticleid, content,
+                          get_response_etag(article_response))
+    return content
+
+
+# High-water marks of the delta sync: the latest Freshdesk updated_at synced, per folder and Dataverse environment
+sync_state_lock = threading.Lock()
+sync_state_connection = None
+
+
+# Open the delta sync state, which is kept across runs
+def open_sync_state(sync_state_path=SYNC_STATE_PATH):
+    global sync_state_connection
+
+    sync_state_dir = os.path.dirname(sync_state_path)
+    if not os.path.exists(sync_state_dir):
+        os.makedirs(sync_state_dir)
+
+    with sync_state_lock:
+        sync_state_connection = sqlite3.connect(
+            sync_state_path, check_same_thread=False)
+        sync_state_connection.execute("PRAGMA journal_mode=WAL")
+        sync_state_connection.execute("""
+            CREATE TABLE IF NOT EXISTS folder_sync_marks (
+                environment TEXT NOT NULL,
+                freshdesk_folder_id INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                synced_at TEXT NOT NULL,
+                PRIMARY KEY (environment, freshdesk_folder_id)
+            )""")
+        sync_state_connection.commit()
+
+
+# Get the latest Freshdesk updated_at synced for every folder
+def get_sync_marks():
+    """
+    Returns:
+        Dict of Freshdesk updated_at strings keyed by Freshdesk folder ID
+    """
+    with sync_state_lock:
+        if sync_state_connection is None:
+            return {}
+
+        rows = sync_state_connection.execute(
+            "SELECT freshdesk_folder_id, updated_at FROM folder_sync_marks WHERE environment = ?", (env,)).fetchall()
+
+    return {freshdesk_folder_id: updated_at for freshdesk_folder_id, updated_at in rows}
+
+
+# Move the high-water marks of folders forward after their articles are synced
+def save_sync_marks(sync_marks):
+    with sync_state_lock:
+        if sync_state_connection is None or not sync_marks:
+            return
+
+        synced_at = get_utc_datetime()
+        sync_state_connection.executemany(
+            "INSERT OR REPLACE INTO folder_sync_marks (environment, freshdesk_folder_id, updated_at, synced_at) VALUES (?, ?, ?, ?)",
+            [(env, freshdesk_folder_id, updated_at, synced_at) for freshdesk_folder_id, updated_at in sync_marks.items()])
+        sync_state_connection.commit()
+
+
+# Get the latest Freshdesk updated_at of each folder, leaving out folders with articles that failed to sync
+def get_high_water_marks(articles, failed_article_ids=frozenset()):
+    """
+    Freshdesk timestamps are ISO 8601 UTC strings of the same form, so they
+    are compared as strings.
+
+    Returns:
+        Dict of Freshdesk updated_at strings keyed by Freshdesk folder ID
+    """
+    high_water_marks = {}
+    failed_folder_ids = set()
+
+    for article in articles:
+        freshdesk_folder_id = article["freshdesk_folder_id"]
+        if int(article["id"]) in failed_article_ids:
+            failed_folder_ids.add(freshdesk_folder_id)
+        if article["updated_at"] > high_water_marks.get(freshdesk_folder_id, ""):
+            high_water_marks[freshdesk_folder_id] = article["updated_at"]
+
+    return {freshdesk_folder_id: updated_at for freshdesk_folder_id, updated_at in high_water_marks.items()
+            if freshdesk_folder_id not in failed_folder_ids}
+
+
+# Save internal article references to JSON
+def save_internal_references_to_json(output_file_path="./data/internal_article_references.json"):
+    global internal_articles_refs_dict
+    """
+    Save the internal article references dictionary to a JSON file
+    
+    Args:
+        output_file_path (str): Path to the output JSON file
+    """
+
+    # Ensure the directory exists
+    output_dir = os.path.dirname(output_file_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Add timestamp to filename to avoid overwriting
+    filename, extension = os.path.splitext(output_file_path)
+    timestamp = get_utc_datetime()
+    output_file_with_timestamp = f"{filename}_{timestamp}{extension}"
+
+    # Save the internal article references to a JSON file
+    with open(output_file_with_timestamp, 'w') as f:
+        json.dump(internal_articles_refs_dict, f, indent=4)
+
+    logger.info(
+        f"Saved internal article references to {output_file_with_timestamp}")
+    print(f"Saved internal article references to {output_file_with_timestamp}")
+
+
+# Raised when an image is larger than IMAGE_MAX_BYTES
+class ImageTooLargeError(Exception):
+    pass
+
+
+# Content-addressed image cache: web resources by SHA-256 of the image bytes,
+# and image hashes by canonical source URL, per Dataverse environment
+image_cache_lock = threading.Lock()
+image_cache_connection = None
+
+# Fixed set of locks picked by image hash, so concurrent workers upload each
+# distinct image once without keeping a lock for every image ever seen
+image_upload_locks = [threading.Lock() for _ in range(IMAGE_UPLOAD_LOCK_COUNT)]
+
+# Query parameters that sign a Freshdesk/S3 URL without identifying the image
+SIGNED_URL_PARAMETERS = {
+    "x-amz-algorithm", "x-amz-credential", "x-amz-date", "x-amz-expires", "x-amz-signedheaders",
+    "x-amz-signature", "x-amz-security-token", "awsaccesskeyid", "signature", "expires"
+}
+
+
+# Open the image cache, which is kept across runs
+def open_image_cache(image_cache_path=IMAGE_CACHE_PATH):
+    global image_cache_connection
+
+    image_cache_dir = os.path.dirname(image_cache_path)
+    if not os.path.exists(image_cache_dir):
+        os.makedirs(image_cache_dir)
+
+    with image_cache_lock:
+        image_cache_connection = sqlite3.connect(
+            image_cache_path, check_same_thread=False)
+        image_cache_connection.execute("PRAGMA journal_mode=WAL")
+        image_cache_connection.execute("""
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                environment TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                web_resource_name TEXT NOT NULL,
+                dynamics_image_url TEXT NOT NULL,
+                PRIMARY KEY (environment, sha256)
+            )""")
+        image_cache_connection.execute("""
+            CREATE TABLE IF NOT EXISTS image_urls (
+                environment TEXT NOT NULL,
+                canonical_url TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (environment, canonical_url)
+            )""")
+        image_cache_connection.commit()
+
+
+# Strip the signature, expiry and response overrides from an image URL
+def canonicalize_image_url(url):
+    """
+    Signed Freshdesk/S3 URLs change on every article download, so the same
+    image is recognised by its canonical URL instead.
+    """
+    parsed_url = urlparse(url.strip())
+    query = [(name, value) for name, value in parse_qsl(parsed_url.query, keep_blank_values=True)
+             if name.lower() not in SIGNED_URL_PARAMETERS and not name.lower().startswith("response-")]
+
+    return urlunparse((parsed_url.scheme.lower(), parsed_url.netloc.lower(), parsed_url.path,
+                       parsed_url.params, urlencode(sorted(query)), ""))
+
+
+# Look up the web resource of an image by its canonical URL or by its hash
+def get_cached_image(canonical_url=None, sha256=None):
+    """
+    Returns:
+        Dict with sha256, web_resource_name and dynamics_image_url, or None
+    """
+    with image_cache_lock:
+        if image_cache_connection is None:
+            return None
+
+        if sha256 is None:
+            row = image_cache_connection.execute(
+                "SELECT sha256 FROM image_urls WHERE environment = ? AND canonical_url = ?",
+                (env, canonical_url)).fetchone()
+            if row is None:
+                return None
+            sha256 = row[0]
+
+        row = image_cache_connection.execute(
+            "SELECT web_resource_name, dynamics_image_url FROM image_hashes WHERE environment = ? AND sha256 = ?",
+            (env, sha256)).fetchone()
+
+    if row is None:
+        return None
+
+    return {"sha256": sha256, "web_resource_name": row[0], "dynamics_image_url": row[1]}
+
+
+# Remember the web resource of an image and the URL it was downloaded from
+def save_cached_image(canonical_url, sha256, web_resource_name=None, dynamics_image_url=None):
+    with image_cache_lock:
+        if image_cache_connection is None:
+            return
+
+        if web_resource_name is not None:
+            image_cache_connection.execute(
+                "INSERT OR REPLACE INTO image_hashes (environment, sha256, web_resource_name, dynamics_image_url) VALUES (?, ?, ?, ?)",
+                (env, sha256, web_resource_name, dynamics_image_url))
+        image_cache_connection.execute(
+            "INSERT OR REPLACE INTO image_urls (environment, canonical_url, sha256) VALUES (?, ?, ?)",
+            (env, canonical_url, sha256))
+        image_cache_connection.commit()
+
+
+# Get the lock that serialises the upload of one image hash
+def get_image_upload_lock(sha256):
+    return image_upload_locks[int(sha256[:8], 16) % IMAGE_UPLOAD_LOCK_COUNT]
+
+
+# Images waiting for the write-behind writer
+image_write_queue = queue.Queue(maxsize=IMAGE_WRITE_QUEUE_SIZE)
+image_writer = None
+
+# Shared pool for image downloads and uploads
+image_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_DOWNLOAD_WORKERS, thread_name_prefix="image")
+
+
+# Write queued images to disk, forever (runs on the image-writer thread)
+def write_queued_images():
+    while True:
+        local_path, image_content = image_write_queue.get()
+        try:
+            with open(local_path, "wb") as file:
+                file.write(image_content)
+        except OSError as err:
+            logger.warning(f"Failed to save image {local_path}: {err}")
+        finally:
+            image_write_queue.task_done()
+
+
+# Queue an image to be written to disk without holding up the migration
+def save_image_in_background(local_path, image_content):
+    global image_writer
+
+    with image_cache_lock:
+        if image_writer is None or not image_writer.is_alive():
+            image_writer = threading.Thread(
+                target=write_queued_images, name="image-writer", daemon=True)
+            image_writer.start()
+
+    # Blocks while IMAGE_WRITE_QUEUE_SIZE images are waiting, so a slow disk can't fill memory
+    image_write_queue.put((local_path, image_content))
+
+
+# Wait for the write-behind writer to save every queued image
+def flush_saved_images():
+    image_write_queue.join()
+
+
+# Download an image into memory, hashing it as it streams in
+@measured_phase("image_download")
+def download_image(img, image_name, local_path=None):
+    """
+    The image is read in IMAGE_CHUNK_SIZE pieces and given up once it is
+    larger than IMAGE_MAX_BYTES. With local_path, it is also written there
+    in the background.
+
+    Returns:
+        Tuple of (image bytes, SHA-256 hex digest)
+    """
+    retries = 0
+    while True:
+        try:
+            # Send a GET request to the URL
+            if is_freshdesk_host(img):
+                response = freshdesk_request(
+                    img, session=image_session, stream=True)
+            else:
+                requested_at = time.monotonic()
+                try:
+                    response = image_session.get(
+                        img, stream=True, timeout=REQUEST_TIMEOUT_SECONDS)
+                except requests.exceptions.RequestException as err:
+                    request_seconds = time.monotonic() - requested_at
+                    record_request(img, request_seconds)
+                    if isinstance(err, requests.exceptions.Timeout):
+                        record_wait("image_download_timeout", request_seconds)
+                    raise
+                record_request(img, time.monotonic() - requested_at, response, stream=True)
+
+            with response:
+                # Check if the request was successful
+                if response.status_code != 200:
+                    logger.warning(f"Failed to retrieve image {image_name}.")
+                    print(f"Failed to retrieve the image {image_name}.")
+                    raise Exception(
+                        f"Failed to download image: status code {response.status_code}")
+
+                content_length = int(response.headers.get("Content-Length") or 0)
+                if content_length > IMAGE_MAX_BYTES:
+                    raise ImageTooLargeError(
+                        f"Image {image_name} is {content_length} bytes (limit {IMAGE_MAX_BYTES})")
+
+                image_content = bytearray()
+                image_hash = hashlib.sha256()
+                for image_chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                    image_content.extend(image_chunk)
+                    image_hash.update(image_chunk)
+                    if len(image_content) > IMAGE_MAX_BYTES:
+                        raise ImageTooLargeError(
+                            f"Image {image_name} is larger than {IMAGE_MAX_BYTES} bytes")
+
+            image_content = bytes(image_content)
+            logger.info(f"Image {image_name} downloaded ({len(image_content)} bytes)")
+
+            if local_path:
+                save_image_in_background(local_path, image_content)
+
+            return image_content, image_hash.hexdigest()
+
+        except ImageTooLargeError:
+            raise
+        except Exception as err:
+            logger.warning(
+                f"Failed to download image {image_name}. Error: {err}")
+            print(f"Failed to download image {image_name}. Error: {err}")
+            retries += 1
+            if retries >= 3:
+                raise
+            logger.warning(
+                f"Retrying {image_name} download after {RETRY_WAIT_SECONDS} seconds...")
+            print(
+                f"Retrying {image_name} download after {RETRY_WAIT_SECONDS} seconds...")
+            recorded_sleep("image_download_retry", RETRY_WAIT_SECONDS)  # Wait before retrying
+
+
+# Look up the web resource with the given name
+def find_web_resource(api_session, image_name):
+    """
+    Returns:
+        webresourceid of the web resource, or None if there isn't one
+    """
+    escaped_name = image_name.replace("'", "''")
+    web_resource_url = (
+        f"{dynamics_url}api/data/v9.2/webresourceset?$select=webresourceid"
+        f"&$filter=name eq '{escaped_name}'")
+
+    web_resources = make_api_call(
+        api_session, web_resource_url, "GET").json().get("value", [])
+
+    return web_resources[0]["webresourceid"] if web_resources else None
+
+
+# Create a web resource with an image
+@measured_phase("web_resource_post")
+def upload_image_web_resource(api_session, image_name, title, image_content):
+    """
+    Returns:
+        Public URL of the web resource
+    """
+    file_base64 = base64.b64encode(image_content).decode("utf-8")
+
+    web_resource_data = {
+        "name": image_name,
+        "displayname": image_name,
+        "description": f"Image for {title}",
+        "content": file_base64,
+        "webresourcetype": 5  # Type 5 for PNG images
+    }
+    web_resource_url = f"{dynamics_url}api/data/v9.2/webresourceset"
+    # This URL should not contain "api/data/v9.2/"
+    public_url = f"{dynamics_url}WebResources/{image_name}"
+
+    retries = 0
+    while True:
+        try:
+            try:
+                web_resource_response = make_api_call(
+                    api_session, web_resource_url, "POST", web_resource_data)
+            except Exception as err:
+                # The web resource may have been created before the request failed
+                if not is_outcome_unknown(err) or find_web_resource(api_session, image_name) is None:
+                    raise
+                logger.info(
+                    f"Web resource {image_name} was created by the request that failed: {err}")
+                print(
+                    f"Web resource {image_name} was created by the request that failed: {err}")
+                return public_url
+
+            logger.info(
+                f"Web resource response status code: {web_resource_response.status_code}")
+            print(
+                f"Web resource response status code: {web_resource_response.status_code}")
+
+            if web_resource_response.status_code not in [201, 204]:
+                logger.warning(
+                    f"Failed to create web resource for image: {image_name}.")
+                print(
+                    f"Failed to create web resource. Status code: {web_resource_response.status_code}")
+                try:
+                    logger.error(web_resource_response.json())
+                    print(web_resource_response.json())
+                except json.JSONDecodeError:
+                    logger.error("No JSON response body.")
+                    print("No JSON response body.")
+                raise Exception(
+                    f"Failed to create web resource: {web_resource_response.status_code}")
+
+            logger.info("Web resource created successfully!")
+            print("Web resource created successfully!")
+            logger.info(f"Public URL for the image: {public_url}")
+            print(f"Public URL for the image: {public_url}")
+
+            return public_url
+
+        except Exception as err:
+            logger.warning(
+                f"Failed to create web resource for image: {image_name}. Error: {err}")
+            print(
+                f"Failed to create web resource for image: {image_name}. Error: {err}")
+            retries += 1
+            if retries >= 3:
+                raise
+            logger.warning(
+                f"Retrying web resource creation for {image_name} after {RETRY_WAIT_SECONDS} seconds...")
+            print(
+                f"Retrying web resource creation for {image_name} after {RETRY_WAIT_SECONDS} seconds...")
+            # Wait before retrying
+            recorded_sleep("web_resource_retry", RETRY_WAIT_SECONDS)
+
+
+# Get the web resource URL of an image, downloading and uploading it only if it isn't cached
+def get_image_web_resource(api_session, img, image_name, title, local_path=None):
+    """
+    Returns:
+        Dict with sha256, web_resource_name and dynamics_image_url
+    """
+    canonical_url = canonicalize_image_url(img)
+
+    cached_image = get_cached_image(canonical_url=canonical_url)
+    if cached_image:
+        logger.info(
+            f"Image {canonical_url} already uploaded as {cached_image['web_resource_name']}")
+        return cached_image
+
+    image_content, sha256 = download_image(img, image_name, local_path)
+
+    with get_image_upload_lock(sha256):
+        cached_image = get_cached_image(sha256=sha256)
+        if cached_image:
+            logger.info(
+                f"Image {image_name} matches web resource {cached_image['web_resource_name']}")
+            print(
+                f"Image {image_name} matches web resource {cached_image['web_resource_name']}")
+            save_cached_image(canonical_url, sha256)
+            return cached_image
+
+        public_url = upload_image_web_resource(
+            api_session, image_name, title, image_content)
+        save_cached_image(canonical_url, sha256, image_name, public_url)
+
+    return {"sha256": sha256, "web_resource_name": image_name, "dynamics_image_url": public_url}
+
+
+# Parse article HTML once, collecting the tags later steps read and rewrite
+def parse_article_html(html_content, parser=None):
+    """
+    Args:
+        html_content: Article body HTML
+        parser: BeautifulSoup parser, HTML_PARSER by default
+
+    Returns:
+        Dict with the soup, the parser, and the img and a tags in document order
+    """
+    parser = parser or HTML_PARSER
+
+    with trace_span("html_parse", {"html.parser": parser, "html.length": len(html_content or "")}):
+        soup = BeautifulSoup(html_content or "", parser)
+
+        img_tags = []
+        a_tags = []
+        for tag in soup.find_all(["img", "a"]):
+            if tag.name == "img":
+                img_tags.append(tag)
+            else:
+                a_tags.append(tag)
+
+    return {
+        "soup": soup,
+        "parser": parser,
+        "img_tags": img_tags,
+        "a_tags": a_tags
+    }
+
+
+# Get the internal article references (URLs containing your helpdesk domain) of a parsed article
+def get_internal_references(html_document):
+    return [a_tag["href"] for a_tag in html_document["a_tags"]
+            if a_tag.has_attr("href") and freshdesk_portal_domain in a_tag["href"]]
+
+
+# Serialise a parsed article back to an HTML fragment
+def render_article_html(html_document):
+    soup = html_document["soup"]
+
+    with trace_span("html_render"):
+        # lxml wraps fragments in <html><body>, which the article content must not have
+        if html_document["parser"] != "html.parser" and soup.body is not None:
+            return soup.body.decode_contents()
+
+        return f"{soup}"
+
+
+# Worker that migrates one image on the shared image pool, in the traces of the article that queued it
+def image_worker(img, image_name, title, local_path=None, trace_parent=None):
+    with continue_trace(trace_parent):
+        return get_image_web_resource(get_worker_session(), img, image_name, title, local_path)
+
+
+# Get images function (includes internal article references, even though the function is named get_images)
+def get_images_and_internal_references(article, html_document=None):
+    """
+    Upload the images of an article as web resources and record its internal
+    article references. Images already in the image cache are not downloaded
+    or uploaded again, and the rest are handled concurrently on the shared
+    image pool, which uses its own worker sessions.
+
+    Args:
+        article: Freshdesk article
+        html_document: The article already parsed by parse_article_html
+
+    Returns:
+        Dict of uploaded images keyed by web resource name
+    """
+    global internal_articles_refs_dict
+
+    # Get the current UTC datetime as string
+    utc_datetime_str = get_utc_datetime()
+
+    # Extract article ID and title
+    id = article["id"]
+    title = article["title"]
+
+    images = {}
+
+    if html_document is None:
+        html_document = parse_article_html(article["description"])
+
+    # Extract internal article references (URLs containing your helpdesk domain)
+    internal_articles_refs = get_internal_references(html_document)
+
+    # Store the internal article references
+    register_internal_references(id, internal_articles_refs)
+
+    # Extract img src, once per distinct URL
+    img_urls = list(dict.fromkeys(
+        img["src"] for img in html_document["img_tags"] if img.get("src")))
+
+    # Download and upload the images concurrently on the shared image pool
+    image_futures = []
+    trace_parent = get_trace_parent()
+    for image_index, img in enumerate(img_urls):
+        image_name = f"{id}_{utc_datetime_str}_{image_index}"
+        local_path = f"./data/images/{image_name}.png" if SAVE_IMAGES_TO_DISK else None
+        image_futures.append((img, image_name, local_path, image_executor.submit(
+            image_worker, img, image_name, title, local_path, trace_parent)))
+
+    for img, image_name, local_path, image_future in image_futures:
+        try:
+            web_resource = image_future.result()
+        except Exception as err:
+            logger.warning(
+                f"Failed to migrate image {image_name} for {title}. Error: {err}")
+            print(
+                f"Failed to migrate image {image_name} for {title}. Error: {err}")
+            continue
+
+        img_dict = {
+            "article_id": id,
+            "aws_url": img,
+            "article_title": title,
+            "local_path": local_path,
+            "sha256": web_resource["sha256"],
+            "dynamics_image_url": web_resource["dynamics_image_url"]
+        }
+
+        images[image_name] = img_dict
+
+    return images
+
+
+# Add categories to Dynamics function
+def import_categories_to_dynamics(category_set):
+    global imported_categories, dynamics_url
+
+    # Create a session
+    api_session = create_api_session()
+
+    for category in category_set:
+        category_name = category["name"]
+        category_description = category["description"]
+        freshdesk_category_id = category["id"]
+
+        # Top-level categories
+        if "is_top_level" in category and category["is_top_level"] == 1:
+            category_data = {
+                "title": category_name,
+                "description": category_description,
+                "revops_freshdeskcategoryid": freshdesk_category_id,
+                "revops_istoplevelcategory": True
+            }
+
+        else:
+            # In FD, visibility == 1 is external; 2 is logged in users; 3 is internal
+            # In Dynamics, isinternal == 1 means it is internal; 0 means external
+
+            # Top-level folders
+            if category["is_parent_folder"] == True:
+                parent_category_id = category["parent_folder_id"]
+                isinternal = False if category["visibility"] == 1 else True
+                category_data = {
+                    "title": category_name,
+                    "description": category_description,
+                    "revops_freshdeskcategoryid": freshdesk_category_id,
+                    "revops_istoplevelcategory": False,
+                    "revops_isinternal": isinternal,
+                    "parentcategoryid@odata.bind": f'/categories({imported_categories[parent_category_id]["categoryid"]})'
+                }
+
+            # Subfolders
+            elif category["is_parent_folder"] == False:
+                parent_category_id = category["parent_folder_id"]
+                isinternal = False if category["visibility"] == 1 else True
+                category_data = {
+                    "title": category_name,
+                    "description": category_description,
+                    "revops_freshdeskcategoryid": freshdesk_category_id,
+                    "revops_istoplevelcategory": False,
+                    "revops_isinternal": isinternal,
+                    "parentcategoryid@odata.bind": f'/categories({imported_categories[parent_category_id]["categoryid"]})'
+                }
+
+        categories_url = f"{dynamics_url}api/data/v9.2/categories"
+
+        try:
+            categories_response = make_api_call(
+                api_session, categories_url, "POST", category_data)
+
+            if categories_response.status_code in [201, 204]:
+                print("Category added successfully!")
+                imported_category = {}
+                freshdesk_id = category["id"]
+                imported_category["categoryid"] = categories_response.json()[
+                    "categoryid"]
+                imported_category["title"] = categories_response.json()[
+                    "title"]
+                imported_categories.update({freshdesk_id: imported_category})
+            else:
+                logger.warning(f"Failed to create category {category_name}.")
+                print(
+                    f"Failed to create category. Status code: {categories_response.status_code}")
+
+            try:
+                print(categories_response.json())
+            except json.JSONDecodeError:
+                print("No JSON response body.")
+
+        except Exception as e:
+            logger.error(f"Error creating category {category_name}: {str(e)}")
+            print(f"Error creating category {category_name}: {str(e)}")
+
+
+# Update knowledgearticle_category function
+@measured_phase("category_bind")
+def update_category(freshdesk_article_id, dynamics_article_id, dynamics_category_id, api_session, max_retries=3):
+    # URLs to update the knowledge article categories
+    related_category_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_article_id})/knowledgearticle_category/$ref"
+    custom_lookup_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_article_id})"
+
+    # Log the IDs being used
+    logger.info(
+        f"Updating category for article {freshdesk_article_id}, dynamics ID: {dynamics_article_id}, category ID: {dynamics_category_id}")
+
+    success = False
+    retries = 0
+
+    while not success and retries < max_retries:
+        try:
+            # Update custom category lookup field
+            lookup_data = {
+                "revops_category@odata.bind": f"/categories({dynamics_category_id})"
+            }
+            update_lookup_response = make_api_call(
+                api_session, custom_lookup_url, "PATCH", lookup_data)
+
+            # Update related category
+            category_data = {
+                "@odata.id": f"{dynamics_url}api/data/v9.2/categories({dynamics_category_id})"
+            }
+            update_category_response = make_api_call(
+                api_session, related_category_url, "POST", category_data)
+
+            logger.info(
+                f"Knowledge category updated successfully for {freshdesk_article_id}.")
+            print(
+                f"Knowledge category updated successfully for article {freshdesk_article_id}")
+            success = True
+            return True
+
+        except Exception as err:
+            logger.error(
+                f"Knowledge category update failed for {freshdesk_article_id}: {str(err)}")
+            print(
+                f"Knowledge category update failed for {freshdesk_article_id}: {str(err)}")
+            retries += 1
+
+            if retries < max_retries:
+                logger.warning(
+                    f"Retrying category update for {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds... (Attempt {retries+1}/{max_retries})")
+                print(
+                    f"Retrying category update for {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds... (Attempt {retries+1}/{max_retries})")
+                recorded_sleep("category_retry", RETRY_WAIT_SECONDS)
+
+    return False  # All retries failed
+
+
+# Query the article numbers of many articles with one request per ARTICLE_NUMBER_BATCH_SIZE IDs
+@measured_phase("number_poll")
+def query_article_numbers(api_session, knowledgearticleids):
+    """
+    Returns:
+        Dict of article numbers keyed by knowledgearticleid, for the articles
+        whose number has been generated
+    """
+    article_numbers = {}
+    knowledgearticleids = list(knowledgearticleids)
+
+    for i in range(0, len(knowledgearticleids), ARTICLE_NUMBER_BATCH_SIZE):
+        id_values = ",".join(
+            f"'{knowledgearticleid}'" for knowledgearticleid in knowledgearticleids[i:i + ARTICLE_NUMBER_BATCH_SIZE])
+        article_numbers_url = (
+            f"{dynamics_url}api/data/v9.2/knowledgearticles?$select=knowledgearticleid,articlepublicnumber"
+            f"&$filter=Microsoft.Dynamics.CRM.In(PropertyName='knowledgearticleid',PropertyValues=[{id_values}])")
+
+        article_numbers_response = make_api_call(
+            api_session, article_numbers_url, "GET")
+        for item in article_numbers_response.json().get("value", []):
+            if item.get("articlepublicnumber"):
+                article_numbers[item["knowledgearticleid"]
+                                ] = item["articlepublicnumber"]
+
+    return article_numbers
+
+
+# Article numbers waiting to be resolved, keyed by knowledgearticleid
+pending_article_numbers = {}
+article_number_condition = threading.Condition(state_lock)
+article_number_resolver = None
+
+
+# Queue an article for background article number resolution
+def queue_article_number(freshdesk_article_id, knowledgearticleid, number_field):
+    """
+    Args:
+        freshdesk_article_id: Key of the article in migrated_articles
+        knowledgearticleid: Dynamics ID of the article or translation
+        number_field: "en_articlenumber" or "fr_articlenumber"
+    """
+    global article_number_resolver
+
+    with article_number_condition:
+        pending_article_numbers[knowledgearticleid] = (
+            freshdesk_article_id, number_field)
+
+        if article_number_resolver is None or not article_number_resolver.is_alive():
+            article_number_resolver = threading.Thread(
+                target=resolve_article_numbers, name="article-number-resolver", daemon=True)
+            article_number_resolver.start()
+
+        article_number_condition.notify_all()
+
+
+# Journal step recorded when an article number is resolved
+def get_number_step(number_field):
+    return "number" if number_field == "en_articlenumber" else "fr_number"
+
+
+# Background resolver that fills in article numbers as Dataverse generates them
+def resolve_article_numbers():
+    set_default_phase("number_poll")
+
+    while True:
+        with article_number_condition:
+            while not pending_article_numbers:
+                article_number_condition.wait()
+            knowledgearticleids = list(pending_article_numbers)
+            polled_article_ids = [pending_article_numbers[knowledgearticleid][0]
+                                  for knowledgearticleid in knowledgearticleids]
+
+        try:
+            with trace_articles(polled_article_ids, "resolve_article_numbers",
+                                {"articles.polled": len(knowledgearticleids)}):
+                article_numbers = query_article_numbers(
+                    get_worker_session(), knowledgearticleids)
+        except Exception as err:
+            logger.error(f"Error retrieving article numbers: {err}")
+            print(f"Error retrieving article numbers: {err}")
+            article_numbers = {}
+
+        with article_number_condition:
+            for knowledgearticleid, article_number in article_numbers.items():
+                freshdesk_article_id, number_field = pending_article_numbers.pop(
+                    knowledgearticleid)
+                if freshdesk_article_id in migrated_articles:
+                    migrated_articles[freshdesk_article_id][number_field] = article_number
+                    record_step(freshdesk_article_id, get_number_step(number_field),
+                                {number_field: article_number})
+                logger.info(
+                    f"Resolved {number_field} for article {freshdesk_article_id}: {article_number}")
+            article_number_condition.notify_all()
+
+        if len(article_numbers) < len(knowledgearticleids):
+            # Some numbers are still being generated
+            waiting_article_ids = [freshdesk_article_id for knowledgearticleid, freshdesk_article_id
+                                   in zip(knowledgearticleids, polled_article_ids)
+                                   if knowledgearticleid not in article_numbers]
+            with trace_articles(waiting_article_ids, "wait_article_numbers"):
+                recorded_sleep("article_number_poll", ARTICLE_NUMBER_POLL_SECONDS)
+
+
+# Wait until the background resolver has found every queued article number
+def wait_for_article_numbers(timeout=ARTICLE_NUMBER_TIMEOUT_SECONDS, freshdesk_article_ids=None):
+    """
+    Args:
+        freshdesk_article_ids: Only wait for the numbers of these articles
+            (all queued numbers by default)
+
+    Returns:
+        Number of article numbers still pending after the wait
+    """
+    def count_pending():
+        return sum(1 for pending_article_id, number_field in pending_article_numbers.values()
+                   if freshdesk_article_ids is None or pending_article_id in freshdesk_article_ids)
+
+    with article_number_condition:
+        article_number_condition.wait_for(
+            lambda: not count_pending(), timeout=timeout)
+        still_pending = count_pending()
+
+    if still_pending:
+        logger.warning(
+            f"{still_pending} article numbers still pending after {timeout} seconds")
+        print(
+            f"{still_pending} article numbers still pending after {timeout} seconds")
+
+    return still_pending
+
+
+# Update article numbers for all migrated articles
+def update_article_numbers(api_session=None):
+    """
+    Update article numbers for all migrated articles that don't have them,
+    with one bulk query per ARTICLE_NUMBER_BATCH_SIZE articles
+    """
+    global migrated_articles
+
+    if api_session is None:
+        api_session = create_api_session()
+
+    missing_numbers = {}
+
+    with state_lock:
+        for fd_article_id, article_data in migrated_articles.items():
+            # Check English article
+            if not article_data.get("en_articlenumber"):
+                missing_numbers[article_data["en_knowledgearticleid"]] = (
+                    fd_article_id, "en_articlenumber")
+
+            # Check French article if exists
+            if "fr_knowledgearticleid" in article_data and not article_data.get("fr_articlenumber"):
+                missing_numbers[article_data["fr_knowledgearticleid"]] = (
+                    fd_article_id, "fr_articlenumber")
+
+    updated_count = 0
+
+    if missing_numbers:
+        try:
+            with trace_articles([fd_article_id for fd_article_id, _ in missing_numbers.values()],
+                                "update_article_numbers"):
+                article_numbers = query_article_numbers(
+                    api_session, missing_numbers)
+        except Exception as err:
+            logger.error(f"Error retrieving article numbers: {err}")
+            print(f"Error retrieving article numbers: {err}")
+            article_numbers = {}
+
+        with state_lock:
+            for knowledgearticleid, article_number in article_numbers.items():
+                fd_article_id, number_field = missing_numbers[knowledgearticleid]
+                migrated_articles[fd_article_id][number_field] = article_number
+                record_step(fd_article_id, get_number_step(number_field),
+                            {number_field: article_number})
+                updated_count += 1
+                logger.info(
+                    f"Updated {number_field} for article {fd_article_id}: {article_number}")
+                print(
+                    f"Updated {number_field} for article {fd_article_id}: {article_number}")
+
+    logger.info(f"Updated {updated_count} article numbers")
+    print(f"Updated {updated_count} article numbers")
+    return updated_count
+
+
+# Write a stream of articles to an on-disk spool as they arrive
+def spool_freshdesk_articles(article_stream, spool_path):
+    """
+    Only a small summary of each article stays in memory: enough to plan
+    the migration order, find the article in the spool, and set the delta
+    sync high-water marks.
+
+    Returns:
+        List of article summaries with id, freshdesk_folder_id, updated_at,
+        referenced_article_ids and spool_offset
+    """
+    article_summaries = []
+
+    with open(spool_path, "wb") as spool_file:
+        for article in article_stream:
+            referenced_article_ids = {get_referenced_article_id(url)
+                                      for url in LINK_HREF_PATTERN.findall(article.get("description") or "")}
+            referenced_article_ids.discard(None)
+
+            article_summaries.append({
+                "id": int(article["id"]),
+                "freshdesk_folder_id": article.get("freshdesk_folder_id"),
+                "updated_at": article.get("updated_at", ""),
+                "referenced_article_ids": sorted(referenced_article_ids),
+                "spool_offset": spool_file.tell()
+            })
+            spool_file.write(serialize_json_line(article))
+
+    return article_summaries
+
+
+# Read spooled articles back one at a time, in the order of their summaries
+def read_spooled_articles(spool_path, article_summaries):
+    """
+    Yields:
+        Articles, with the reference_level of their summary if it has one
+    """
+    with open(spool_path, "rb") as spool_file:
+        for article_summary in article_summaries:
+            spool_file.seek(article_summary["spool_offset"])
+            article = deserialize_json_line(spool_file.readline())
+            if "reference_level" in article_summary:
+                article["reference_level"] = article_summary["reference_level"]
+            yield article
+
+
+# Function to get articles from Freshdesk and save locally
+@measured_phase("freshdesk_crawl")
+def download_freshdesk_articles(kb_folder):
+    """
+    Articles are spooled to disk as the crawl finds them; articles holds
+    their summaries and articles_spool_path the spool to read them from.
+
+    Args:
+        kb_folder: Folder records, or a crawl_freshdesk_folders stream whose
+            folders are listed as they are found
+    """
+    global articles, articles_spool_path
+    article_download_datetime = get_utc_datetime()
+
+    articles_spool_path = f"./data/freshdesk_articles_{article_download_datetime}.jsonl"
+    articles = spool_freshdesk_articles(
+        crawl_freshdesk_articles(kb_folder), articles_spool_path)
+
+    print("Freshdesk data saved.")
+
+
+# Functions to migrate Freshdesk articles to Dataverse
+def replace_image_urls(html_document, images):
+    dynamics_image_urls = {value["aws_url"]: value["dynamics_image_url"]
+                           for value in images.values()}
+
+    for img in html_document["img_tags"]:
+        dynamics_image_url = dynamics_image_urls.get(img.get("src"))
+        if dynamics_image_url:
+            img["src"] = dynamics_image_url
+
+
+# Upload the images of an article and return its HTML pointing at the web resources
+def prepare_article_content(article, api_session, language="en"):
+    # The article is parsed once; the same tags are read and rewritten in place
+    html_document = parse_article_html(article["description"])
+    images = get_images_and_internal_references(article, html_document)
+
+    with trace_span("html_rewrite"):
+        replace_image_urls(html_document, images)
+        link_references_at_creation(article["id"], html_document, language)
+
+    return render_article_html(html_document)
+
+
+# Map the Freshdesk article status to Dynamics statecode and statuscode
+def get_dynamics_status(article):
+    freshdesk_article_id = int(article["id"])
+
+    # In Freshdesk: status 1 = Draft, status 2 = Published
+    # In Dynamics: statecode 0 = Draft, statecode 3 = Published
+    if article.get("status", 0) == 1:
+        logger.info(
+            f"Article {freshdesk_article_id} is in draft status in Freshdesk, will keep as draft in Dynamics")
+        print(
+            f"Article {freshdesk_article_id} is in draft status in Freshdesk, will keep as draft in Dynamics")
+        return 0, 2  # Draft
+
+    # Published in Freshdesk or any other status
+    return 3, 7  # Published
+
+
+# Look up the translation of a Freshdesk article in one locale
+def fetch_article_translation(freshdesk_article_id, locale):
+    """
+    Returns:
+        The translated article, or None if there is no translation. Other
+        errors are raised, so a failed lookup isn't taken for a missing translation
+    """
+    response = freshdesk_request(
+        f"{freshdesk_url}solutions/articles/{freshdesk_article_id}/{locale}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+
+    return response.json()
+
+
+# Get the translation of an article, as prefetched by the crawl unless its folder listing failed
+def get_article_translation(article, locale="fr"):
+    freshdesk_article_id = int(article["id"])
+
+    translations = article.get("translations", {})
+    if locale in translations:
+        translation = translations[locale]
+    else:
+        translation = fetch_article_translation(freshdesk_article_id, locale)
+
+    if translation:
+        logger.info(f"{locale} translation found for {freshdesk_article_id}.")
+        print(f"{locale} translation found for {freshdesk_article_id}.")
+    return translation
+
+
+# Record a created English article in migrated_articles
+def record_migrated_article(article, dynamics_knowledgearticleid, article_number, dynamics_statecode, dynamics_statuscode,
+                            commit_journal_entry=True):
+    global migrated_articles
+
+    freshdesk_article_id = int(article["id"])
+    with state_lock:
+        migrated_articles[freshdesk_article_id] = {
+            "en_knowledgearticleid": dynamics_knowledgearticleid,
+            "en_title": article["title"],
+            "en_articlenumber": article_number,
+            "fd_status": article.get("status", 0),
+            "dynamics_statecode": dynamics_statecode,
+            "dynamics_statuscode": dynamics_statuscode,
+            "attachment_count": len(article["attachments"]),
+            "attachments": article["attachments"],
+            "internal_references": internal_articles_refs_dict.get(freshdesk_article_id, []),
+            # Links written before the record existed, or while it was only a delta sync link target
+            "linked_references": sorted(creation_linked_references.pop(freshdesk_article_id, set()) | set(
+                migrated_articles.get(freshdesk_article_id, {}).get("linked_references", [])))
+        }
+        record_step(freshdesk_article_id, "created",
+                    migrated_articles[freshdesk_article_id], commit=commit_journal_entry)
+
+
+# Migrate the French translation of an article one call at a time
+@measured_phase("fr_translation")
+def migrate_french_translation(freshdesk_article_id, french_translation, dynamics_knowledgearticleid, dynamics_category_id,
+                               dynamics_statecode, dynamics_statuscode, api_session, translated_article_id=None,
+                               fr_content=None, completed_steps=None):
+    global migrated_articles
+
+    # Steps already recorded in the migration journal are skipped
+    completed_steps = completed_steps or {}
+    if translated_article_id is None and "fr_created" in completed_steps:
+        translated_article_id = completed_steps["fr_created"]["fr_knowledgearticleid"]
+
+    fr_title = french_translation["title"]
+
+    if translated_article_id is None:
+        # Use French - France locale (adjust based on your needs)
+        fr_fr_languagelocaleid = language_dict["French - France"]
+
+        translation_data = {
+            "Source": {
+                "@odata.type": "Microsoft.Dynamics.CRM.knowledgearticle",
+                "knowledgearticleid": dynamics_knowledgearticleid
+            },
+            "Language": {
+                "@odata.type": "Microsoft.Dynamics.CRM.languagelocale",
+                "languagelocaleid": fr_fr_languagelocaleid
+            },
+            "IsMajor": True
+        }
+
+        create_translation_url = f"{dynamics_url}api/data/v9.2/CreateKnowledgeArticleTranslation"
+
+        retries = 0
+        success = False
+        while not success and retries < 3:
+            try:
+                translation_response = make_api_call(
+                    api_session, create_translation_url, "POST", translation_data)
+                success = True
+            except requests.exceptions.HTTPError as err:
+                logger.error(f"Error: {err}")
+                print(f"Error: {err}")
+                retries += 1
+                if retries < 3:
+                    logger.warning(
+                        f"Retrying {freshdesk_article_id} create FR translation after {RETRY_WAIT_SECONDS} seconds...")
+                    print(
+                        f"Retrying {freshdesk_article_id} create FR translation after {RETRY_WAIT_SECONDS} seconds...")
+                    # Wait before retrying
+                    recorded_sleep("fr_create_retry", RETRY_WAIT_SECONDS)
+            except Exception as err:
+                if not is_outcome_unknown(err):
+                    raise
+                logger.error(f"Error: {err}")
+                print(f"Error: {err}")
+                # The translation may have been created; look for it before sending the create again
+                translated_article_id = find_french_translation(
+                    api_session, dynamics_knowledgearticleid)
+                if translated_article_id is not None:
+                    logger.info(
+                        f"French translation of {freshdesk_article_id} was created by the request that failed")
+                    print(
+                        f"French translation of {freshdesk_article_id} was created by the request that failed")
+                    break
+                retries += 1
+                if retries < 3:
+                    logger.warning(
+                        f"Retrying {freshdesk_article_id} create FR translation after {RETRY_WAIT_SECONDS} seconds...")
+                    print(
+                        f"Retrying {freshdesk_article_id} create FR translation after {RETRY_WAIT_SECONDS} seconds...")
+                    recorded_sleep("fr_create_retry", RETRY_WAIT_SECONDS)
+
+        if not success and translated_article_id is None:
+            logger.error(
+                f"Failed to create French translation for article {freshdesk_article_id} after all retries")
+            print(
+                f"Failed to create French translation for article {freshdesk_article_id} after all retries")
+            return
+
+        if translated_article_id is None:
+            translated_article_id = translation_response.json()[
+                "knowledgearticleid"]
+
+        # Add French article info to migrated_articles; the article number is
+        # filled in by the background resolver
+        with state_lock:
+            fr_article_data = {
+                "fr_knowledgearticleid": translated_article_id,
+                "fr_title": fr_title,
+                "fr_articlenumber": None
+            }
+            migrated_articles[freshdesk_article_id].update(fr_article_data)
+            record_step(freshdesk_article_id, "fr_created",
+                        fr_article_data, commit=True)
+        queue_article_number(freshdesk_article_id,
+                             translated_article_id, "fr_articlenumber")
+
+    fr_article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({translated_article_id})"
+
+    if "fr_content" not in completed_steps:
+        if fr_content is None:
+            fr_content = prepare_article_content(
+                french_translation, api_session, "fr")
+
+        french_data = {
+            "content": fr_content,
+            "title": fr_title
+        }
+
+        retries = 0
+        success = False
+        while not success and retries < 3:
             try:
-                print(categories_response.json())
-            except json.JSONDecodeError:
-                print("No JSON response body.")
+                update_fr_content_response = make_api_call(
+                    api_session, fr_article_url, "PATCH", french_data)
+                success = True
+                fr_count = increment_article_count() + 1
+                record_step(freshdesk_article_id, "fr_content")
+                store_article_content(translated_article_id, fr_content,
+                                      get_response_etag(update_fr_content_response))
+            except Exception as err:
+                logger.error(
+                    f"French article update failed for {freshdesk_article_id}: {err}")
+                print(
+                    f"French article update failed for {freshdesk_article_id}: {err}")
+                retries += 1
+                if retries < 3:
+                    logger.warning(
+                        f"Retrying {freshdesk_article_id} FR after {RETRY_WAIT_SECONDS} seconds...")
+                    print(
+                        f"Retrying {freshdesk_article_id} FR after {RETRY_WAIT_SECONDS} seconds...")
+                    # Wait before retrying
+                    recorded_sleep("fr_update_retry", RETRY_WAIT_SECONDS)
 
-        except Exception as e:
-            logger.error(f"Error creating category {category_name}: {str(e)}")
-            print(f"Error creating category {category_name}: {str(e)}")
+        if not success:
+            # The translation stays a draft without content; --resume continues from fr_created
+            logger.error(
+                f"Failed to update French content for article {freshdesk_article_id} after all retries")
+            print(
+                f"Failed to update French content for article {freshdesk_article_id} after all retries")
+            return
 
+        logger.info(
+            f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {fr_count}.")
+        print(
+            f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {fr_count}.")
+
+    if "fr_category" not in completed_steps:
+        # Add delay before updating category for French article
+        recorded_sleep("fr_category_delay", 5)  # 5 seconds delay
+
+        # Update category for French article
+        fr_category_update_success = update_category(
+            freshdesk_article_id, translated_article_id, dynamics_category_id, api_session)
+        if fr_category_update_success:
+            record_step(freshdesk_article_id, "fr_category")
+        else:
+            logger.warning(
+                f"Failed to update category for French article {freshdesk_article_id} after all retries")
+            print(
+                f"Failed to update category for French article {freshdesk_article_id} after all retries")
 
-# Update knowledgearticle_category function
-def update_category(freshdesk_article_id, dynamics_article_id, dynamics_category_id, api_session, max_retries=3):
-    global access_token
+    if "fr_published" in completed_steps:
+        return
 
-    # URLs to update the knowledge article categories
-    related_category_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_article_id})/knowledgearticle_category/$ref"
-    custom_lookup_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_article_id})"
+    # Set the French article state based on the Freshdesk status
+    fr_publish_data = {
+        "statecode": dynamics_statecode,    # 0 for Draft, 3 for Published
+        "statuscode": dynamics_statuscode   # 2 for Draft, 7 for Published
+    }
 
-    # Log the IDs being used
-    logger.info(
-        f"Updating category for article {freshdesk_article_id}, dynamics ID: {dynamics_article_id}, category ID: {dynamics_category_id}")
+    retries = 0
+    fr_publish_success = False
+    while not fr_publish_success and retries < 3:
+        try:
+            fr_publish_response = make_api_call(
+                api_session, fr_article_url, "PATCH", fr_publish_data)
+            fr_publish_success = True
+            record_step(freshdesk_article_id, "fr_published")
+            set_article_content_etag(
+                translated_article_id, get_response_etag(fr_publish_response))
+            if dynamics_statecode == 3:
+                logger.info(
+                    f"French translation for article {freshdesk_article_id} successfully published")
+                print(
+                    f"French translation for article {freshdesk_article_id} successfully published")
+            else:
+                logger.info(
+                    f"French translation for article {freshdesk_article_id} set to draft status")
+                print(
+                    f"French translation for article {freshdesk_article_id} set to draft status")
+        except Exception as err:
+            logger.error(
+                f"Failed to set status for French article {freshdesk_article_id}: {err}")
+            print(
+                f"Failed to set status for French article {freshdesk_article_id}: {err}")
+            retries += 1
+            if retries < 3:
+                logger.warning(
+                    f"Retrying status update for French article {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                print(
+                    f"Retrying status update for French article {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                recorded_sleep("fr_status_retry", RETRY_WAIT_SECONDS)
+
+
+# Create the English knowledge article and record it in migrated_articles
+@measured_phase("article_post")
+def create_knowledge_article(article, api_session, content):
+    """
+    Returns:
+        knowledgearticleid of the new article, or None if it couldn't be created
+    """
+    kb_url = f"{dynamics_url}api/data/v9.2/knowledgearticles"
+
+    freshdesk_article_id = int(article["id"])
+    dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+
+    # Create article without statecode/statuscode initially
+    article_data = {
+        "title": article["title"],
+        "revops_freshdeskarticleid": freshdesk_article_id,
+        "content": content,
+        "isinternal": article["dynamics_isinternal"],
+        "publishon": article["created_at"]
+        # Removed statecode and statuscode from initial creation
+    }
 
-    success = False
     retries = 0
+    success = False
+    existing_article = None
+    while not success and retries < 3:
+        try:
+            dynamics_article_response = make_api_call(
+                api_session, kb_url, "POST", article_data)
+            success = True
+        except requests.exceptions.HTTPError as err:
+            logger.error(f"HTTP error occurred: {err}")
+            print(f"HTTP error occurred: {err}")
+            retries += 1
+            if retries < 3:
+                logger.warning(
+                    f"Retrying {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                print(
+                    f"Retrying {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                recorded_sleep("create_retry", RETRY_WAIT_SECONDS)  # Wait before retrying
+        except Exception as err:
+            logger.error(f"Other error occurred: {err}")
+            print(f"Other error occurred: {err}")
+            if is_outcome_unknown(err):
+                # The create may have been committed; if the lookup fails too, the article is left for --resume
+                existing_article = find_existing_articles(
+                    api_session, [freshdesk_article_id]).get(freshdesk_article_id)
+                if existing_article is not None:
+                    logger.info(
+                        f"Article {freshdesk_article_id} was created by the request that failed")
+                    print(
+                        f"Article {freshdesk_article_id} was created by the request that failed")
+                    break
+            retries += 1
+            if retries < 3:
+                logger.warning(
+                    f"Retrying {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                print(
+                    f"Retrying {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                recorded_sleep("create_retry", RETRY_WAIT_SECONDS)  # Wait before retrying
 
-    while not success and retries < max_retries:
+    if existing_article is not None:
+        dynamics_knowledgearticleid = existing_article["knowledgearticleid"]
+        count = increment_article_count()
+        logger.info(
+            f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+        print(
+            f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+        record_migrated_article(article, dynamics_knowledgearticleid, existing_article.get("articlepublicnumber"),
+                                dynamics_statecode, dynamics_statuscode)
+        if not existing_article.get("articlepublicnumber"):
+            queue_article_number(freshdesk_article_id,
+                                 dynamics_knowledgearticleid, "en_articlenumber")
+        store_article_content(dynamics_knowledgearticleid, content)
+        return dynamics_knowledgearticleid
+
+    if not success or dynamics_article_response.status_code not in [201, 204]:
+        logging.error(
+            f"An error occurred: {dynamics_article_response.content if 'dynamics_article_response' in locals() else 'No response'}")
+        print(
+            f"Failed to create knowledge article: {dynamics_article_response.content if 'dynamics_article_response' in locals() else 'No response'}")
         try:
-            # Update custom category lookup field
-            lookup_data = {
-                "revops_category@odata.bind": f"/categories({dynamics_category_id})"
-            }
-            update_lookup_response = make_api_call(
-                api_session, custom_lookup_url, "PATCH", lookup_data)
+            if 'dynamics_article_response' in locals():
+                print(dynamics_article_response.json())
+        except json.JSONDecodeError:
+            print("No JSON response body.")
+        return None
 
-            # Update related category
-            category_data = {
-                "@odata.id": f"{dynamics_url}api/data/v9.2/categories({dynamics_category_id})"
+    count = increment_article_count()
+    logger.info(
+        f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+    print(
+        f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+
+    dynamics_knowledgearticleid = dynamics_article_response.json()[
+        "knowledgearticleid"]
+
+    # Store in migrated_articles with status; the article number is
+    # filled in by the background resolver
+    record_migrated_article(article, dynamics_knowledgearticleid, None,
+                            dynamics_statecode, dynamics_statuscode)
+    queue_article_number(freshdesk_article_id,
+                         dynamics_knowledgearticleid, "en_articlenumber")
+    store_article_content(dynamics_knowledgearticleid, content,
+                          get_response_etag(dynamics_article_response))
+
+    return dynamics_knowledgearticleid
+
+
+# Migrate a single article one call at a time
+def migrate_article(article, api_session, content=None, completed_steps=None):
+    global migrated_articles
+
+    freshdesk_article_id = int(article["id"])
+    dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+
+    # Steps already recorded in the migration journal are skipped
+    completed_steps = completed_steps or {}
+
+    if "created" in completed_steps:
+        logger.info(
+            f"Resuming article {freshdesk_article_id} from the migration journal")
+        print(
+            f"Resuming article {freshdesk_article_id} from the migration journal")
+        with state_lock:
+            dynamics_knowledgearticleid = migrated_articles[freshdesk_article_id]["en_knowledgearticleid"]
+    else:
+        logger.info(f"Migrating article {freshdesk_article_id}")
+        print(f"Migrating article {freshdesk_article_id}")
+
+        if content is None:
+            content = prepare_article_content(article, api_session)
+
+        dynamics_knowledgearticleid = create_knowledge_article(
+            article, api_session, content)
+        if dynamics_knowledgearticleid is None:
+            return
+
+    # Update article category in Dynamics
+    dynamics_category_id = article["dynamics_category_id"]
+
+    if "category" not in completed_steps:
+        # Add a small delay before updating category to ensure article is fully created
+        recorded_sleep("category_delay", 5)  # 5 seconds delay
+
+        # Call update_category with retry logic and check the result
+        category_update_success = update_category(
+            freshdesk_article_id, dynamics_knowledgearticleid, dynamics_category_id, api_session)
+
+        # Add a check for category update success
+        if category_update_success:
+            record_step(freshdesk_article_id, "category")
+        else:
+            logger.warning(
+                f"Failed to update category for article {freshdesk_article_id} after all retries")
+            print(
+                f"Failed to update category for article {freshdesk_article_id} after all retries")
+
+    if "published" not in completed_steps:
+        # Set the article state based on the Freshdesk status
+        publish_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_knowledgearticleid})"
+        publish_data = {
+            "statecode": dynamics_statecode,    # 0 for Draft, 3 for Published
+            "statuscode": dynamics_statuscode   # 2 for Draft, 7 for Published
+        }
+
+        with measure_phase("publish_patch"):
+            retries = 0
+            publish_success = False
+            while not publish_success and retries < 3:
+                try:
+                    publish_response = make_api_call(
+                        api_session, publish_url, "PATCH", publish_data)
+                    publish_success = True
+                    record_step(freshdesk_article_id, "published")
+                    set_article_content_etag(
+                        dynamics_knowledgearticleid, get_response_etag(publish_response))
+                    if dynamics_statecode == 3:
+                        logger.info(
+                            f"Article {freshdesk_article_id} successfully published")
+                        print(
+                            f"Article {freshdesk_article_id} successfully published")
+                    else:
+                        logger.info(
+                            f"Article {freshdesk_article_id} set to draft status")
+                        print(
+                            f"Article {freshdesk_article_id} set to draft status")
+                except Exception as err:
+                    logger.error(
+                        f"Failed to set status for article {freshdesk_article_id}: {err}")
+                    print(
+                        f"Failed to set status for article {freshdesk_article_id}: {err}")
+                    retries += 1
+                    if retries < 3:
+                        logger.warning(
+                            f"Retrying status update for {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                        print(
+                            f"Retrying status update for {freshdesk_article_id} after {RETRY_WAIT_SECONDS} seconds...")
+                        recorded_sleep("status_retry", RETRY_WAIT_SECONDS)
+
+    if "fr_missing" in completed_steps or "fr_published" in completed_steps:
+        return
+
+    # Check for French article
+    try:
+        french_translation = get_article_translation(article, "fr")
+
+        # Create French translation if French article exists
+        if french_translation:
+            migrate_french_translation(
+                freshdesk_article_id, french_translation, dynamics_knowledgearticleid, dynamics_category_id,
+                dynamics_statecode, dynamics_statuscode, api_session, completed_steps=completed_steps)
+        else:
+            record_step(freshdesk_article_id, "fr_missing")
+
+    except Exception as err:
+        logger.warning(
+            f"French article migration failed for {freshdesk_article_id}: {err}")
+        print(
+            f"French article migration failed for {freshdesk_article_id}: {err}")
+
+
+# Build the change set that creates, categorises and publishes one article
+def build_article_changeset(article, content, content_id):
+    """
+    Build the $batch operations that create an article, bind its category and
+    set its state, all in one change set.
+
+    The create is sent first with Content-ID content_id, so the category and
+    state operations can address the new article as $<content_id>.
+    """
+    freshdesk_article_id = int(article["id"])
+    dynamics_category_id = article["dynamics_category_id"]
+    dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+
+    article_data = {
+        "title": article["title"],
+        "revops_freshdeskarticleid": freshdesk_article_id,
+        "content": content,
+        "isinternal": article["dynamics_isinternal"],
+        "publishon": article["created_at"],
+        # The custom category lookup can be bound on create
+        "revops_category@odata.bind": f"/categories({dynamics_category_id})"
+    }
+
+    return [
+        {
+            "method": "POST",
+            "url": f"{dynamics_url}api/data/v9.2/knowledgearticles?$select=knowledgearticleid,articlepublicnumber",
+            "json": article_data,
+            "headers": {"Prefer": "return=representation"},
+            "content_id": content_id,
+            "changeset": freshdesk_article_id
+        },
+        {
+            "method": "POST",
+            "url": f"${content_id}/knowledgearticle_category/$ref",
+            "json": {"@odata.id": f"{dynamics_url}api/data/v9.2/categories({dynamics_category_id})"},
+            "content_id": content_id + 1,
+            "changeset": freshdesk_article_id
+        },
+        {
+            "method": "PATCH",
+            "url": f"${content_id}",
+            "json": {"statecode": dynamics_statecode, "statuscode": dynamics_statuscode},
+            "content_id": content_id + 2,
+            "changeset": freshdesk_article_id
+        }
+    ]
+
+
+# Record a French translation created for migrate_french_translations_batched
+def record_batched_translation(translation, translated_article_id, fr_articlenumber):
+    freshdesk_article_id = translation["freshdesk_article_id"]
+    translation["translated_article_id"] = translated_article_id
+
+    with state_lock:
+        fr_article_data = {
+            "fr_knowledgearticleid": translated_article_id,
+            "fr_title": translation["french_translation"]["title"],
+            "fr_articlenumber": fr_articlenumber
+        }
+        migrated_articles[freshdesk_article_id].update(fr_article_data)
+        record_step(freshdesk_article_id, "fr_created", fr_article_data)
+    if not fr_articlenumber:
+        queue_article_number(freshdesk_article_id,
+                             translated_article_id, "fr_articlenumber")
+
+
+# Migrate the French translations of a batch of articles with two $batch requests
+@measured_phase("fr_translation")
+def migrate_french_translations_batched(translations, api_session):
+    """
+    Args:
+        translations: List of dicts with the Freshdesk article ID, the French
+            Freshdesk article and the English Dynamics article details
+
+    Returns:
+        List of translations that need to be migrated one call at a time
+    """
+    global migrated_articles
+
+    fallback_translations = []
+    if not translations:
+        return fallback_translations
+
+    # First request: create the translations
+    fr_fr_languagelocaleid = language_dict["French - France"]
+    create_translation_url = f"{dynamics_url}api/data/v9.2/CreateKnowledgeArticleTranslation"
+    operations = []
+
+    for index, translation in enumerate(translations, start=1):
+        operations.append({
+            "method": "POST",
+            "url": create_translation_url,
+            "json": {
+                "Source": {
+                    "@odata.type": "Microsoft.Dynamics.CRM.knowledgearticle",
+                    "knowledgearticleid": translation["en_knowledgearticleid"]
+                },
+                "Language": {
+                    "@odata.type": "Microsoft.Dynamics.CRM.languagelocale",
+                    "languagelocaleid": fr_fr_languagelocaleid
+                },
+                "IsMajor": True
+            },
+            "content_id": index,
+            "changeset": translation["freshdesk_article_id"]
+        })
+
+    try:
+        batch_results = execute_batch(api_session, operations)
+    except Exception as err:
+        logger.error(f"French translation $batch request failed: {err}")
+        print(f"French translation $batch request failed: {err}")
+        # The translations may have been created before the request failed, such as on a read timeout
+        try:
+            for translation in translations:
+                translated_article_id = find_french_translation(
+                    api_session, translation["en_knowledgearticleid"])
+                if translated_article_id is not None:
+                    record_batched_translation(translation, translated_article_id, None)
+        except Exception as lookup_err:
+            # Creating them again could duplicate them; a --resume run looks them up
+            logger.error(
+                f"Could not check which French translations were created, leaving them for --resume: {lookup_err}")
+            print(
+                f"Could not check which French translations were created, leaving them for --resume: {lookup_err}")
+            return []
+        return translations
+
+    created_translations = []
+    for translation, batch_result in zip(translations, batch_results):
+        freshdesk_article_id = translation["freshdesk_article_id"]
+
+        if not batch_group_succeeded(batch_result):
+            logger.warning(
+                f"Batched French translation failed for {freshdesk_article_id}: {batch_result['responses'][0]['text']}")
+            fallback_translations.append(translation)
+            continue
+
+        record_batched_translation(
+            translation, batch_result["responses"][0]["json"]["knowledgearticleid"],
+            batch_result["responses"][0]["json"].get("articlepublicnumber"))
+        created_translations.append(translation)
+
+    flush_journal()
+
+    # Second request: content, category and state of each translation
+    operations = []
+    content_id = 1
+
+    for translation in created_translations:
+        freshdesk_article_id = translation["freshdesk_article_id"]
+        translated_article_id = translation["translated_article_id"]
+        with trace_span("prepare_fr_content", freshdesk_article_ids=[freshdesk_article_id]):
+            translation["fr_content"] = prepare_article_content(
+                translation["french_translation"], api_session, "fr")
+        fr_article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({translated_article_id})"
+
+        operations.extend([
+            {
+                "method": "PATCH",
+                "url": fr_article_url,
+                "json": {
+                    "content": translation["fr_content"],
+                    "title": translation["french_translation"]["title"],
+                    "revops_category@odata.bind": f"/categories({translation['dynamics_category_id']})"
+                },
+                "content_id": content_id,
+                "changeset": freshdesk_article_id
+            },
+            {
+                "method": "POST",
+                "url": f"{fr_article_url}/knowledgearticle_category/$ref",
+                "json": {"@odata.id": f"{dynamics_url}api/data/v9.2/categories({translation['dynamics_category_id']})"},
+                "content_id": content_id + 1,
+                "changeset": freshdesk_article_id
+            },
+            {
+                "method": "PATCH",
+                "url": fr_article_url,
+                "json": {
+                    "statecode": translation["dynamics_statecode"],
+                    "statuscode": translation["dynamics_statuscode"]
+                },
+                "content_id": content_id + 2,
+                "changeset": freshdesk_article_id
             }
-            update_category_response = make_api_call(
-                api_session, related_category_url, "POST", category_data)
+        ])
+        content_id += 3
+
+    if not operations:
+        return fallback_translations
+
+    try:
+        batch_results = execute_batch(api_session, operations)
+    except Exception as err:
+        logger.error(f"French content $batch request failed: {err}")
+        print(f"French content $batch request failed: {err}")
+        return fallback_translations + created_translations
+
+    stored_article_ids = []
+    for translation, batch_result in zip(created_translations, batch_results):
+        freshdesk_article_id = translation["freshdesk_article_id"]
+
+        if not batch_group_succeeded(batch_result):
+            logger.warning(
+                f"Batched French content update failed for {freshdesk_article_id}: {batch_result['responses'][0]['text']}")
+            fallback_translations.append(translation)
+            continue
 
-            logger.info(
-                f"Knowledge category updated successfully for {freshdesk_article_id}.")
+        fr_count = increment_article_count() + 1
+        for step in ["fr_content", "fr_category", "fr_published"]:
+            record_step(freshdesk_article_id, step)
+        store_article_content(
+            translation["translated_article_id"], translation["fr_content"])
+        stored_article_ids.append(translation["translated_article_id"])
+        logger.info(
+            f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {fr_count}.")
+        print(
+            f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {fr_count}.")
+
+    # The change sets don't return the ETag of the finished translations
+    refresh_stored_etags(api_session, stored_article_ids)
+
+    return fallback_translations
+
+
+# Split the articles of a failed $batch request into those Dataverse created anyway and those still missing
+def recover_failed_batch(batch_articles, contents, api_session):
+    """
+    A change set creates, categorises and publishes an article atomically,
+    so an article found in Dynamics only needs its French translation.
+
+    Returns:
+        List of (article, content, completed_steps) tuples to migrate or
+        finish one call at a time
+    """
+    try:
+        existing_articles = find_existing_articles(
+            api_session, [int(article["id"]) for article in batch_articles])
+    except Exception as err:
+        # Creating them again could duplicate them; a --resume run looks them up
+        logger.error(
+            f"Could not check which articles of the failed $batch request were created, leaving them for --resume: {err}")
+        print(
+            f"Could not check which articles of the failed $batch request were created, leaving them for --resume: {err}")
+        return []
+
+    recovered_articles = []
+    for article in batch_articles:
+        freshdesk_article_id = int(article["id"])
+        existing_article = existing_articles.get(freshdesk_article_id)
+        if existing_article is None:
+            recovered_articles.append(
+                (article, contents[freshdesk_article_id], None))
+            continue
+
+        logger.info(
+            f"Article {freshdesk_article_id} was created by the failed $batch request")
+        print(
+            f"Article {freshdesk_article_id} was created by the failed $batch request")
+        dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+        record_migrated_article(article, existing_article["knowledgearticleid"],
+                                existing_article.get("articlepublicnumber"),
+                                dynamics_statecode, dynamics_statuscode)
+        record_step(freshdesk_article_id, "category")
+        record_step(freshdesk_article_id, "published")
+        store_article_content(
+            existing_article["knowledgearticleid"], contents[freshdesk_article_id])
+        if not existing_article.get("articlepublicnumber"):
+            queue_article_number(freshdesk_article_id,
+                                 existing_article["knowledgearticleid"], "en_articlenumber")
+        count = increment_article_count()
+        logger.info(
+            f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+
+        with state_lock:
+            completed_steps = {"created": migrated_articles[freshdesk_article_id],
+                               "category": None, "published": None}
+        recovered_articles.append(
+            (article, contents[freshdesk_article_id], completed_steps))
+
+    return recovered_articles
+
+
+# Migrate one batch of articles with a single $batch request
+def migrate_article_batch(batch_articles, contents, api_session):
+    """
+    Migrate a batch of articles through Dataverse $batch requests.
+
+    Each article is created, categorised and published in its own change set,
+    so a failure only rolls back that article. French translations are created
+    and updated with two further $batch requests. Article numbers missing from
+    the create responses are resolved in the background.
+
+    Args:
+        batch_articles: Articles to migrate
+        contents: Prepared article HTML keyed by Freshdesk article ID
+        api_session: Dataverse session
+
+    Returns:
+        List of (article, content, completed_steps) tuples whose change set
+        failed, or whose $batch request failed, and that need to be migrated
+        or finished one call at a time
+    """
+    fallback_articles = []
+    operations = []
+
+    for index, article in enumerate(batch_articles):
+        operations.extend(build_article_changeset(
+            article, contents[int(article["id"])], index * 3 + 1))
+
+    logger.info(
+        f"Migrating {len(batch_articles)} articles in one $batch request")
+    print(f"Migrating {len(batch_articles)} articles in one $batch request")
+
+    try:
+        with trace_articles([article["id"] for article in batch_articles], "migrate_batch",
+                            {"batch.size": len(batch_articles)}), measure_phase("article_batch"):
+            batch_results = execute_batch(api_session, operations)
+    except Exception as err:
+        logger.error(f"Article $batch request failed: {err}")
+        print(f"Article $batch request failed: {err}")
+        # The change sets may have been committed before the request failed, such as on a read timeout
+        return recover_failed_batch(batch_articles, contents, api_session)
+
+    translations = []
+    stored_article_ids = []
+    for article, batch_result in zip(batch_articles, batch_results):
+        freshdesk_article_id = int(article["id"])
+
+        if not batch_group_succeeded(batch_result):
+            logger.warning(
+                f"Batched migration failed for {freshdesk_article_id}, retrying one call at a time: {batch_result['responses'][0]['text']}")
             print(
-                f"Knowledge category updated successfully for article {freshdesk_article_id}")
-            success = True
-            return True
+                f"Batched migration failed for {freshdesk_article_id}, retrying one call at a time")
+            fallback_articles.append((article, contents[freshdesk_article_id], None))
+            continue
+
+        created_article = batch_result["responses"][0]["json"]
+        dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+        record_migrated_article(article, created_article["knowledgearticleid"],
+                                created_article.get("articlepublicnumber"),
+                                dynamics_statecode, dynamics_statuscode, commit_journal_entry=False)
+        # The change set bound the category and set the state with the create
+        record_step(freshdesk_article_id, "category")
+        record_step(freshdesk_article_id, "published")
+        store_article_content(
+            created_article["knowledgearticleid"], contents[freshdesk_article_id])
+        stored_article_ids.append(created_article["knowledgearticleid"])
+        if not created_article.get("articlepublicnumber"):
+            queue_article_number(freshdesk_article_id,
+                                 created_article["knowledgearticleid"], "en_articlenumber")
+
+        count = increment_article_count()
+        logger.info(
+            f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
+        print(
+            f"Knowledge article created successfully for {freshdesk_article_id} - Count: {count}.")
 
+        try:
+            with trace_articles([freshdesk_article_id], "fr_lookup"):
+                french_translation = get_article_translation(article, "fr")
         except Exception as err:
-            logger.error(
-                f"Knowledge category update failed for {freshdesk_article_id}: {str(err)}")
+            # Left without fr_missing, so a resumed run looks again
+            logger.warning(
+                f"French translation lookup failed for {freshdesk_article_id}: {err}")
             print(
-                f"Knowledge category update failed for {freshdesk_article_id}: {str(err)}")
-            retries += 1
+                f"French translation lookup failed for {freshdesk_article_id}: {err}")
+            continue
 
-            if retries < max_retries:
-                logger.warning(
-                    f"Retrying category update for {freshdesk_article_id} after 30 seconds... (Attempt {retries+1}/{max_retries})")
-                print(
-                    f"Retrying category update for {freshdesk_article_id} after 30 seconds... (Attempt {retries+1}/{max_retries})")
-                time.sleep(30)  # Shorter wait time for category updates
+        if not french_translation:
+            record_step(freshdesk_article_id, "fr_missing")
+        else:
+            translations.append({
+                "freshdesk_article_id": freshdesk_article_id,
+                "french_translation": french_translation,
+                "en_knowledgearticleid": created_article["knowledgearticleid"],
+                "dynamics_category_id": article["dynamics_category_id"],
+                "dynamics_statecode": dynamics_statecode,
+                "dynamics_statuscode": dynamics_statuscode
+            })
+
+    flush_journal()
+
+    # The state PATCH ran after the create, so the create response's ETag is stale
+    refresh_stored_etags(api_session, stored_article_ids)
+
+    with trace_articles([translation["freshdesk_article_id"] for translation in translations],
+                        "migrate_fr_batch", {"batch.size": len(translations)}):
+        batched_translations = migrate_french_translations_batched(
+            translations, api_session)
+
+    for translation in batched_translations:
+        try:
+            with trace_articles([translation["freshdesk_article_id"]], "migrate_fr_translation"):
+                migrate_french_translation(
+                    translation["freshdesk_article_id"], translation["french_translation"],
+                    translation["en_knowledgearticleid"], translation["dynamics_category_id"],
+                    translation["dynamics_statecode"], translation["dynamics_statuscode"], api_session,
+                    translated_article_id=translation.get("translated_article_id"),
+                    fr_content=translation.get("fr_content"))
+        except Exception as err:
+            logger.warning(
+                f"French article migration failed for {translation['freshdesk_article_id']}: {err}")
+            print(
+                f"French article migration failed for {translation['freshdesk_article_id']}: {err}")
+
+    return fallback_articles
+
+
+# Migrate articles with one $batch request per BATCH_MAX_ARTICLES articles
+def migrate_articles_batched(articles, batch_size=BATCH_MAX_ARTICLES, max_workers=MAX_WORKERS):
+    """
+    Prepare the articles and send their $batch requests with a pool of workers.
+
+    Articles are handled one reference level (see plan_article_order) at a
+    time, so the articles they link to are created, with their numbers,
+    before their content is built and the links can be written straight in.
+
+    Returns:
+        List of (article, content, completed_steps) tuples that need to be
+        migrated or finished one call at a time
+    """
+    fallback_articles = []
+    reference_levels = group_reference_levels(articles)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for level_index, level_articles in enumerate(reference_levels):
+            batches = [level_articles[i:i + batch_size]
+                       for i in range(0, len(level_articles), batch_size)]
+
+            # Upload the images and build the HTML of every article concurrently
+            prepared_contents = executor.map(prepare_article_worker, level_articles)
+            contents = {int(article["id"]): content
+                        for article, content in zip(level_articles, prepared_contents)}
+
+            for batch_fallback_articles in executor.map(
+                    lambda batch_articles: migrate_article_batch(batch_articles, contents, get_worker_session()), batches):
+                fallback_articles.extend(batch_fallback_articles)
+
+            if level_index < len(reference_levels) - 1:
+                wait_for_level_numbers(level_articles)
+
+    return fallback_articles
+
+
+# Group articles by their reference level (see plan_article_order)
+def group_reference_levels(articles):
+    """
+    Returns:
+        Lists of articles, one per reference level, in level order
+    """
+    articles_by_level = {}
+    for article in articles:
+        articles_by_level.setdefault(
+            article.get("reference_level", 0), []).append(article)
+
+    return [articles_by_level[level] for level in sorted(articles_by_level)]
+
+
+# Wait for the numbers of a reference level's articles, which the next level links to
+def wait_for_level_numbers(level_articles):
+    with trace_articles([article["id"] for article in level_articles], "wait_level_numbers"):
+        wait_for_article_numbers(
+            freshdesk_article_ids={int(article["id"]) for article in level_articles})
+
+
+# Worker that uploads the images of one article and builds its HTML
+def prepare_article_worker(article):
+    with trace_articles([article["id"]], "prepare_content"):
+        return prepare_article_content(article, get_worker_session())
+
+
+# Worker that migrates one article one call at a time
+def migrate_article_worker(article, content=None, completed_steps=None):
+    try:
+        with trace_articles([article["id"]], "migrate_article", {"resumed": bool(completed_steps)}):
+            migrate_article(article, get_worker_session(),
+                            content, completed_steps)
+    except Exception as err:
+        logger.error(f"Failed to migrate article {article['id']}: {err}")
+        print(f"Failed to migrate article {article['id']}: {err}")
+
+
+# Find the Dynamics articles of Freshdesk articles, such as those created by a run that stopped before journalling them
+def find_existing_articles(api_session, freshdesk_article_ids):
+    """
+    Returns:
+        Dict of {"knowledgearticleid", "articlepublicnumber", "statecode",
+        "statuscode", "_revops_category_value"} keyed by Freshdesk article ID,
+        for the articles that already exist in Dynamics
+    """
+    existing_articles = {}
+    freshdesk_article_ids = list(freshdesk_article_ids)
 
-                # Consider refreshing token between retries if needed
-                if retries == max_retries - 1:  # Last attempt, try with fresh token
-                    logger.info(
-                        f"Refreshing token for final category update attempt on article {freshdesk_article_id}")
-                    new_access_token()
-                    api_session = create_api_session()
+    for i in range(0, len(freshdesk_article_ids), ARTICLE_NUMBER_BATCH_SIZE):
+        id_values = ",".join(
+            f"'{freshdesk_article_id}'" for freshdesk_article_id in freshdesk_article_ids[i:i + ARTICLE_NUMBER_BATCH_SIZE])
+        existing_articles_url = (
+            f"{dynamics_url}api/data/v9.2/knowledgearticles?$select=knowledgearticleid,articlepublicnumber,revops_freshdeskarticleid,"
+            f"statecode,statuscode,_revops_category_value"
+            f"&$filter=_parentarticlecontentid_value eq null and "
+            f"Microsoft.Dynamics.CRM.In(PropertyName='revops_freshdeskarticleid',PropertyValues=[{id_values}])")
 
-    return False  # All retries failed
+        existing_articles_response = make_api_call(
+            api_session, existing_articles_url, "GET")
+        for item in existing_articles_response.json().get("value", []):
+            existing_articles[int(item["revops_freshdeskarticleid"])] = item
+
+    return existing_articles
 
 
-# Get article number with retry logic
-def get_article_number_with_retry(api_session, dynamics_knowledgearticleid, max_retries=5):
+# Split a chunk into new, partly migrated and finished articles using the migration journal
+def plan_resumed_articles(articles, api_session):
     """
-    Retrieve article number with retry logic, as it may be generated asynchronously
+    Returns:
+        Tuple of (articles to migrate from scratch, list of (article,
+        completed_steps) tuples to finish one call at a time)
     """
-    article_details_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_knowledgearticleid})?$select=articlepublicnumber,title"
+    new_articles = []
+    resumed_articles = []
+    finished_count = 0
 
-    for attempt in range(max_retries):
-        try:
-            article_details_response = make_api_call(
-                api_session, article_details_url, "GET")
-            article_details = article_details_response.json()
-            article_number = article_details.get("articlepublicnumber")
-
-            if article_number:
-                logger.info(
-                    f"Retrieved article number {article_number} on attempt {attempt + 1}")
-                print(
-                    f"Retrieved article number {article_number} on attempt {attempt + 1}")
-                return article_number
-            else:
-                # Article number not yet generated
-                if attempt < max_retries - 1:
-                    wait_time = 5 * (attempt + 1)  # 5, 10, 15, 20, 25 seconds
-                    logger.info(
-                        f"Article number not yet available, waiting {wait_time} seconds...")
-                    print(
-                        f"Article number not yet available, waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
+    for article in articles:
+        completed_steps = journal_steps.get(int(article["id"]), {})
+        if is_article_complete(completed_steps):
+            finished_count += 1
+        elif completed_steps:
+            resumed_articles.append((article, completed_steps))
+        else:
+            new_articles.append(article)
+
+    # The journal commits in groups, so check that the rest weren't created just before the last run stopped
+    if new_articles:
+        existing_articles = find_existing_articles(
+            api_session, [int(article["id"]) for article in new_articles])
+        unjournalled_articles = [article for article in new_articles
+                                 if int(article["id"]) in existing_articles]
+
+        for article in unjournalled_articles:
+            existing_article = existing_articles[int(article["id"])]
+            dynamics_statecode, dynamics_statuscode = get_dynamics_status(
+                article)
+            record_migrated_article(article, existing_article["knowledgearticleid"],
+                                    existing_article.get(
+                                        "articlepublicnumber"),
+                                    dynamics_statecode, dynamics_statuscode)
+            resumed_articles.append(
+                (article, {"created": migrated_articles[int(article["id"])]}))
+
+        new_articles = [article for article in new_articles
+                        if int(article["id"]) not in existing_articles]
 
-        except Exception as err:
-            logger.error(f"Error retrieving article number: {err}")
-            print(f"Error retrieving article number: {err}")
-            if attempt < max_retries - 1:
-                time.sleep(5)
+    logger.info(
+        f"Journal: {finished_count} articles already migrated, {len(resumed_articles)} to resume, {len(new_articles)} to migrate")
+    print(
+        f"Journal: {finished_count} articles already migrated, {len(resumed_articles)} to resume, {len(new_articles)} to migrate")
 
-    logger.warning(
-        f"Could not retrieve article number after {max_retries} attempts")
-    return None  # Article number couldn't be retrieved
+    return new_articles, resumed_articles
 
 
-# Update article numbers for all migrated articles
-def update_article_numbers(api_session=None):
+def migrate_to_dynamics(articles, use_batch=USE_BATCH_REQUESTS, max_workers=MAX_WORKERS, resume=False):
     """
-    Update article numbers for all migrated articles that don't have them
+    Migrate articles to Dynamics with up to max_workers articles (or $batch
+    requests) in flight at the same time.
+
+    With resume, articles the migration journal shows as finished are skipped
+    and partly migrated articles continue from their last completed step.
     """
     global migrated_articles
 
-    if api_session is None:
-        if not "access_token" in globals() or not access_token:
-            new_access_token()
-        api_session = create_api_session()
+    # Initialize migrated_articles if not already defined
+    if "migrated_articles" not in globals():
+        migrated_articles = {}
 
-    updated_count = 0
+    sequential_articles = []
+    if resume:
+        articles, resumed_articles = plan_resumed_articles(
+            articles, create_api_session())
+        sequential_articles.extend(
+            (article, None, completed_steps) for article, completed_steps in resumed_articles)
 
-    for fd_article_id, article_data in migrated_articles.items():
-        # Check English article
-        if not article_data.get("en_articlenumber"):
-            en_id = article_data["en_knowledgearticleid"]
-            article_number = get_article_number_with_retry(api_session, en_id)
+    if use_batch:
+        # Articles whose change set failed are migrated one call at a time
+        sequential_articles.extend(
+            migrate_articles_batched(articles, max_workers=max_workers))
 
-            if article_number:
-                article_data["en_articlenumber"] = article_number
-                updated_count += 1
-                logger.info(
-                    f"Updated article number for English article {fd_article_id}: {article_number}")
-                print(
-                    f"Updated article number for English article {fd_article_id}: {article_number}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda item: migrate_article_worker(*item), sequential_articles))
 
-        # Check French article if exists
-        if "fr_knowledgearticleid" in article_data and not article_data.get("fr_articlenumber"):
-            fr_id = article_data["fr_knowledgearticleid"]
-            fr_article_number = get_article_number_with_retry(
-                api_session, fr_id)
+        if not use_batch:
+            # One reference level at a time, like migrate_articles_batched
+            reference_levels = group_reference_levels(articles)
+            for level_index, level_articles in enumerate(reference_levels):
+                list(executor.map(migrate_article_worker, level_articles))
+                if level_index < len(reference_levels) - 1:
+                    wait_for_level_numbers(level_articles)
 
-            if fr_article_number:
-                article_data["fr_articlenumber"] = fr_article_number
-                updated_count += 1
-                logger.info(
-                    f"Updated article number for French article {fd_article_id}: {fr_article_number}")
-                print(
-                    f"Updated article number for French article {fd_article_id}: {fr_article_number}")
+    flush_journal()
 
-    logger.info(f"Updated {updated_count} article numbers")
-    print(f"Updated {updated_count} article numbers")
-    return updated_count
+    saved_count = save_state_log()
+    print(f"Migrated article data saved ({saved_count} changed records).")
 
 
-# Function to get articles from Freshdesk and save locally
-def download_freshdesk_articles(kb_folder):
-    global articles
-    articles = []
-    article_download_datetime = get_utc_datetime()
+# Normalise a link to a Freshdesk article so every form of it gives the same key
+def normalize_freshdesk_article_url(url):
+    """
+    Trailing slashes, query strings, fragments, locale prefixes (/en/, /fr/)
+    and the slug of /solutions/articles/{id}-slug are all ignored.
 
-    for folder in kb_folder:
-        print(folder["name"])
-        freshdesk_category_id = folder["id"]
-        dynamics_category_id = imported_categories[freshdesk_category_id]["categoryid"]
-        category_visibility = folder["visibility"]
-        # In FD, visibility == 1 is external; 2 is logged in users; 3 is internal
-        # In Dynamics, isinternal == 1 means it is internal; 0 means external
-        dynamics_isinternal = False if category_visibility == 1 else True
+    Returns:
+        "{helpdesk domain}/solutions/articles/{id}", or None if the URL isn't
+        a link to a Freshdesk article
+    """
+    parsed_url = urlparse(url.strip())
+    host = parsed_url.netloc.lower()
 
-        articles_in_folder_url = f"{freshdesk_url}solutions/folders/{freshdesk_category_id}/articles"
-        articles_in_folder = freshdesk_get(articles_in_folder_url)
+    # Relative links are resolved against the helpdesk
+    if host and host != freshdesk_portal_domain and not host.endswith(f".{freshdesk_portal_domain}"):
+        return None
 
-        for article in articles_in_folder:
-            article["dynamics_category_id"] = dynamics_category_id
-            article["dynamics_isinternal"] = dynamics_isinternal
+    article_match = FRESHDESK_ARTICLE_PATH.search(parsed_url.path)
+    if not article_match:
+        return None
 
-            articles.append(article)
+    return f"{freshdesk_portal_domain}/solutions/articles/{int(article_match.group(1))}"
 
-    with open(f"./data/freshdesk_articles_{article_download_datetime}.json", "w") as freshdesk_data_file:
-        json.dump(articles, freshdesk_data_file, indent=4)
 
-    print("Freshdesk data saved.")
+# Rewrite the links of a parsed article that point at migrated Freshdesk articles
+def rewrite_internal_links(html_document, link_index, draft_note, article_label):
+    """
+    Walk the a tags of the article once, resolving each href in link_index.
 
+    Args:
+        html_document: Article parsed by parse_article_html
+        link_index: Dicts with the Dynamics url and is_published, keyed by
+            normalised Freshdesk article URL
+        draft_note: Link title added when the target article is a draft
+        article_label: Article name for the log
+
+    Returns:
+        Set of the Freshdesk article IDs whose links were rewritten
+    """
+    rewritten_article_ids = set()
 
-# Functions to migrate Freshdesk articles to Dataverse
-def replace_image_urls(soup):
-    global images
-    for key, value in images.items():
-        aws_url = value["aws_url"]
-        dynamics_image_url = value["dynamics_image_url"]
-        for img in soup.find_all("img", src=aws_url):
-            img["src"] = dynamics_image_url
+    for a_tag in html_document["a_tags"]:
+        old_url = a_tag.get("href")
+        if not old_url:
+            continue
 
+        normalized_url = normalize_freshdesk_article_url(old_url)
+        new_url_data = link_index.get(normalized_url) if normalized_url else None
+        if not new_url_data:
+            continue
 
-def migrate_to_dynamics(articles):
-    global access_token, article_count, images, migrated_articles, update_category_response
+        new_url = new_url_data['url']
+        is_published = new_url_data['is_published']
 
-    # Ensure we have a valid token
-    if not "access_token" in globals() or not access_token:
-        new_access_token()
+        # Keep the anchor of links to a section of the article
+        fragment = urlparse(old_url).fragment
+        a_tag['href'] = f"{new_url}#{fragment}" if fragment else new_url
 
-    # Create a session
-    api_session = create_api_session()
+        # Add a note in the link title if it's a draft
+        if not is_published:
+            # Preserve existing title if any
+            existing_title = a_tag.get('title', '')
+            if existing_title:
+                a_tag['title'] = f"{existing_title} ({draft_note})"
+            else:
+                a_tag['title'] = draft_note
 
-    kb_url = f"{dynamics_url}api/data/v9.2/knowledgearticles"
+        rewritten_article_ids.add(get_referenced_article_id(old_url))
+        status_note = "published" if is_published else "draft"
+        logger.info(
+            f"Updated link in {article_label} from {old_url} to {a_tag['href']} (status: {status_note})")
 
-    # Initialize migrated_articles if not already defined
-    if "migrated_articles" not in globals():
-        migrated_articles = {}
+    return rewritten_article_ids
 
-    migrate_articles_datetime = get_utc_datetime()
 
-    for article in articles:
-        images = {}
-        get_images_and_internal_references(article, api_session)
+# Reverse reference index: referencing Freshdesk article IDs keyed by the
+# Freshdesk article ID they link to, for links not rewritten yet
+pending_link_references = {}
 
-        html_content = article["description"]
-        soup = BeautifulSoup(html_content, "html.parser")
-        replace_image_urls(soup)
+# Links written into the content of articles not created yet, keyed by Freshdesk article ID
+creation_linked_references = {}
 
-        freshdesk_article_id = int(article["id"])
-        article_title = article["title"]
-
-        # Check the status of the Freshdesk article
-        # In Freshdesk: status 1 = Draft, status 2 = Published
-        freshdesk_article_status = article.get("status", 0)
-
-        # Map Freshdesk status to Dynamics status
-        # In Dynamics: statecode 0 = Draft, statecode 3 = Published
-        if freshdesk_article_status == 1:
-            # Draft in Freshdesk
-            dynamics_statecode = 0  # Draft
-            dynamics_statuscode = 2  # Draft
-            logger.info(
-                f"Article {freshdesk_article_id} is in draft status in Freshdesk, will keep as draft in Dynamics")
-            print(
-                f"Article {freshdesk_article_id} is in draft status in Freshdesk, will keep as draft in Dynamics")
-        else:
-            # Published in Freshdesk or any other status
-            dynamics_statecode = 3  # Published
-            dynamics_statuscode = 7  # Published
-
-        # Create article without statecode/statuscode initially
-        article_data = {
-            "title": article_title,
-            "revops_freshdeskarticleid": freshdesk_article_id,
-            "content": f"{soup}",
-            "isinternal": article["dynamics_isinternal"],
-            "publishon": article["created_at"]
-            # Removed statecode and statuscode from initial creation
-        }
 
-        logger.info(f"Migrating article {freshdesk_article_id}")
-        print(f"Migrating article {freshdesk_article_id}")
+# Get the Freshdesk article ID a link points at, or None
+def get_referenced_article_id(url):
+    normalized_url = normalize_freshdesk_article_url(url)
+    return int(normalized_url.rsplit("/", 1)[1]) if normalized_url else None
 
-        retries = 0
-        success = False
-        while not success and retries < 3:
-            try:
-                dynamics_article_response = make_api_call(
-                    api_session, kb_url, "POST", article_data)
-                success = True
-            except requests.exceptions.HTTPError as err:
-                logger.error(f"HTTP error occurred: {err}")
-                print(f"HTTP error occurred: {err}")
-                retries += 1
-                if retries < 3:
-                    logger.warning(
-                        f"Retrying {freshdesk_article_id} after 6 minutes...")
-                    print(
-                        f"Retrying {freshdesk_article_id} after 6 minutes...")
-                    time.sleep(360)  # Wait for 6 minutes before retrying
 
-                    # Refresh token and session before retry
-                    new_access_token()
-                    api_session = create_api_session()
-            except Exception as err:
-                logger.error(f"Other error occurred: {err}")
-                print(f"Other error occurred: {err}")
-                retries += 1
-                if retries < 3:
-                    logger.warning(
-                        f"Retrying {freshdesk_article_id} after 6 minutes...")
-                    print(
-                        f"Retrying {freshdesk_article_id} after 6 minutes...")
-                    time.sleep(360)  # Wait for 6 minutes before retrying
+# Record the internal references of an article and add its unresolved links to the reverse index
+def register_internal_references(freshdesk_article_id, internal_articles_refs):
+    global internal_articles_refs_dict
 
-                    # Refresh token and session before retry
-                    new_access_token()
-                    api_session = create_api_session()
+    freshdesk_article_id = int(freshdesk_article_id)
 
-        if success and dynamics_article_response.status_code in [201, 204]:
-            logger.info(
-                f"Knowledge article created successfully for {freshdesk_article_id} - Count: {article_count}.")
-            print(
-                f"Knowledge article created successfully for {freshdesk_article_id} - Count: {article_count}.")
-            article_count += 1
+    with state_lock:
+        internal_articles_refs_dict[freshdesk_article_id] = internal_articles_refs
 
-            dynamics_knowledgearticleid = dynamics_article_response.json()[
-                "knowledgearticleid"]
+        linked_references = set(migrated_articles.get(
+            freshdesk_article_id, {}).get("linked_references", []))
+        linked_references |= creation_linked_references.get(
+            freshdesk_article_id, set())
+        for url in internal_articles_refs:
+            referenced_article_id = get_referenced_article_id(url)
+            if referenced_article_id is not None and referenced_article_id not in linked_references:
+                pending_link_references.setdefault(
+                    referenced_article_id, set()).add(freshdesk_article_id)
 
-            # Add delay before retrieving article number
-            time.sleep(10)  # Give time for article number to be generated
 
-            # Get the article number using retry logic
-            article_number = get_article_number_with_retry(
-                api_session, dynamics_knowledgearticleid)
+# Get the articles with links that can now be rewritten, and the articles those links point at
+def get_relinkable_articles(link_index):
+    """
+    Returns:
+        Dict of sets of referenced Freshdesk article IDs, keyed by the
+        Freshdesk article ID of the migrated article that links to them
+    """
+    relinkable_articles = {}
+
+    with state_lock:
+        for referenced_article_id, referencing_article_ids in pending_link_references.items():
+            if normalize_freshdesk_article_url(f"/solutions/articles/{referenced_article_id}") not in link_index:
+                continue
+
+            for referencing_article_id in referencing_article_ids:
+                # The referencing article must exist in Dynamics before it can be patched
+                if referencing_article_id in migrated_articles:
+                    relinkable_articles.setdefault(
+                        referencing_article_id, set()).add(referenced_article_id)
+
+    return relinkable_articles
+
+
+# Take the rewritten links of an article out of the reverse index
+def mark_references_linked(freshdesk_article_id, referenced_article_ids):
+    with state_lock:
+        for referenced_article_id in referenced_article_ids:
+            referencing_article_ids = pending_link_references.get(
+                referenced_article_id, set())
+            referencing_article_ids.discard(freshdesk_article_id)
+            if not referencing_article_ids:
+                pending_link_references.pop(referenced_article_id, None)
+
+        article_data = migrated_articles.get(freshdesk_article_id)
+        if article_data is None:
+            # Linked while building a new article; saved with its migrated_articles record
+            creation_linked_references.setdefault(
+                freshdesk_article_id, set()).update(referenced_article_ids)
+            return
+
+        article_data["linked_references"] = sorted(
+            set(article_data.get("linked_references", [])) | set(referenced_article_ids))
+        record_step(freshdesk_article_id, "links", {
+                    "linked_references": article_data["linked_references"]})
+
+
+# Write the links to articles that already exist in Dynamics into the content of a new article
+def link_references_at_creation(freshdesk_article_id, html_document, language="en"):
+    referenced_article_ids = {get_referenced_article_id(a_tag["href"])
+                              for a_tag in html_document["a_tags"] if a_tag.get("href")}
+    referenced_article_ids.discard(None)
+    if not referenced_article_ids:
+        return
+
+    link_index = build_internal_link_index(referenced_article_ids)
+    linked_article_ids = rewrite_internal_links(
+        html_document, link_index, DRAFT_LINK_NOTES[language], f"new article {freshdesk_article_id}")
+    # The reverse index is per article: a translation created after the English
+    # version doesn't clear the links still pending in it
+    if linked_article_ids and language == "en":
+        mark_references_linked(int(freshdesk_article_id), linked_article_ids)
+
+
+# Find the strongly connected components of the reference graph, iteratively (Tarjan)
+def find_reference_components(dependencies):
+    """
+    Args:
+        dependencies: Sets of linked Freshdesk article IDs, keyed by Freshdesk article ID
 
-            if not article_number:
-                logger.warning(
-                    f"Could not retrieve article number for article {freshdesk_article_id}")
-                print(
-                    f"Could not retrieve article number for article {freshdesk_article_id}")
-
-            # Store in migrated_articles with article number and status
-            migrated_articles[freshdesk_article_id] = {
-                "en_knowledgearticleid": dynamics_knowledgearticleid,
-                "en_title": article_title,
-                "en_articlenumber": article_number,
-                "fd_status": freshdesk_article_status,
-                "dynamics_statecode": dynamics_statecode,
-                "dynamics_statuscode": dynamics_statuscode,
-                "attachment_count": len(article["attachments"]),
-                "attachments": article["attachments"],
-                "internal_references": internal_articles_refs_dict.get(freshdesk_article_id, [])
-            }
+    Returns:
+        List of components (lists of Freshdesk article IDs), each listed
+        after every component it links to
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root_article_id in sorted(dependencies):
+        if root_article_id in index:
+            continue
 
-            # Add a small delay before updating category to ensure article is fully created
-            time.sleep(5)  # 5 seconds delay
+        index[root_article_id] = lowlink[root_article_id] = len(index)
+        stack.append(root_article_id)
+        on_stack.add(root_article_id)
+        work = [(root_article_id, iter(sorted(dependencies[root_article_id])))]
+
+        while work:
+            freshdesk_article_id, referenced_article_ids = work[-1]
+            for referenced_article_id in referenced_article_ids:
+                if referenced_article_id not in index:
+                    index[referenced_article_id] = lowlink[referenced_article_id] = len(index)
+                    stack.append(referenced_article_id)
+                    on_stack.add(referenced_article_id)
+                    work.append((referenced_article_id, iter(
+                        sorted(dependencies[referenced_article_id]))))
+                    break
+                if referenced_article_id in on_stack:
+                    lowlink[freshdesk_article_id] = min(
+                        lowlink[freshdesk_article_id], index[referenced_article_id])
+            else:
+                work.pop()
+                if work:
+                    parent_article_id = work[-1][0]
+                    lowlink[parent_article_id] = min(
+                        lowlink[parent_article_id], lowlink[freshdesk_article_id])
+
+                if lowlink[freshdesk_article_id] == index[freshdesk_article_id]:
+                    component = []
+                    while True:
+                        member_article_id = stack.pop()
+                        on_stack.discard(member_article_id)
+                        component.append(member_article_id)
+                        if member_article_id == freshdesk_article_id:
+                            break
+                    components.append(component)
+
+    return components
+
+
+# Order articles so the articles they link to are migrated before them
+def plan_article_order(articles):
+    """
+    Build the reference graph of the articles from the links in their HTML
+    and sort it topologically into levels. Articles in a level only link to
+    articles in earlier levels, to articles already migrated, or to articles
+    outside this set.
 
-            # Update article category in Dynamics
-            dynamics_category_id = article["dynamics_category_id"]
+    Each cycle of links is broken at the article with the fewest links into
+    the cycle, which goes first; its links to the rest of the cycle are left
+    to the relink pass. The rest of the cycle is sorted again the same way,
+    so the cycles left in it are broken in turn.
 
-            # Call update_category with retry logic and check the result
-            category_update_success = update_category(
-                freshdesk_article_id, dynamics_knowledgearticleid, dynamics_category_id, api_session)
+    Args:
+        articles: Articles, or spooled article summaries
 
-            # Add a check for category update success
-            if not category_update_success:
-                logger.warning(
-                    f"Failed to update category for article {freshdesk_article_id} after all retries")
-                print(
-                    f"Failed to update category for article {freshdesk_article_id} after all retries")
+    Returns:
+        The articles in migration order, each with a "reference_level"
+    """
+    articles_by_id = {int(article["id"]): article for article in articles}
+
+    with state_lock:
+        migrated_article_ids = set(migrated_articles)
+
+    # Links from each article to articles in this set that still need migrating
+    dependencies = {}
+    for freshdesk_article_id, article in articles_by_id.items():
+        # Spooled article summaries carry their links; full articles are scanned
+        referenced_article_ids = article.get("referenced_article_ids")
+        if referenced_article_ids is None:
+            referenced_article_ids = {get_referenced_article_id(url)
+                                      for url in LINK_HREF_PATTERN.findall(article.get("description") or "")}
+        dependencies[freshdesk_article_id] = {
+            referenced_article_id for referenced_article_id in referenced_article_ids
+            if referenced_article_id in articles_by_id and referenced_article_id != freshdesk_article_id
+            and referenced_article_id not in migrated_article_ids}
+
+    reference_levels = {}
+    cycles_broken = 0
+
+    # Components still to place, the next one last; the rest of a broken cycle
+    # is placed before the components after it
+    pending_components = find_reference_components(dependencies)[::-1]
+
+    while pending_components:
+        component = pending_components.pop()
+        members = set(component)
+
+        # Every article this component links to outside it is already placed
+        level = max((reference_levels[referenced_article_id] + 1
+                     for member_article_id in component
+                     for referenced_article_id in dependencies[member_article_id]
+                     if referenced_article_id not in members), default=0)
+
+        if len(component) == 1:
+            reference_levels[component[0]] = level
+            continue
 
-            # Set the article state based on the Freshdesk status
-            publish_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_knowledgearticleid})"
-            publish_data = {
-                "statecode": dynamics_statecode,    # 0 for Draft, 3 for Published
-                "statuscode": dynamics_statuscode   # 2 for Draft, 7 for Published
-            }
+        cycle_breaker = min(component, key=lambda member_article_id: (
+            len(dependencies[member_article_id] & members), member_article_id))
+        reference_levels[cycle_breaker] = level
+        cycles_broken += 1
 
-            retries = 0
-            publish_success = False
-            while not publish_success and retries < 3:
-                try:
-                    publish_response = make_api_call(
-                        api_session, publish_url, "PATCH", publish_data)
-                    publish_success = True
-                    if dynamics_statecode == 3:
-                        logger.info(
-                            f"Article {freshdesk_article_id} successfully published")
-                        print(
-                            f"Article {freshdesk_article_id} successfully published")
-                    else:
-                        logger.info(
-                            f"Article {freshdesk_article_id} set to draft status")
-                        print(
-                            f"Article {freshdesk_article_id} set to draft status")
-                except Exception as err:
-                    logger.error(
-                        f"Failed to set status for article {freshdesk_article_id}: {err}")
-                    print(
-                        f"Failed to set status for article {freshdesk_article_id}: {err}")
-                    retries += 1
-                    if retries < 3:
-                        logger.warning(
-                            f"Retrying status update for {freshdesk_article_id} after 30 seconds...")
-                        print(
-                            f"Retrying status update for {freshdesk_article_id} after 30 seconds...")
-                        time.sleep(30)
+        members.discard(cycle_breaker)
+        pending_components.extend(find_reference_components(
+            {member_article_id: dependencies[member_article_id] & members
+             for member_article_id in members})[::-1])
 
-                        # Refresh token if needed
-                        if retries == 2:  # Last retry attempt
-                            new_access_token()
-                            api_session = create_api_session()
+    ordered_articles = sorted(articles, key=lambda article: (
+        reference_levels[int(article["id"])], int(article["id"])))
+    for article in ordered_articles:
+        article["reference_level"] = reference_levels[int(article["id"])]
 
-            # Check for French article
-            try:
-                french_translation_url = f"{freshdesk_url}solutions/articles/{freshdesk_article_id}/fr"
-                french_translation = freshdesk_get(french_translation_url)
-                logger.info(
-                    f"French article found for {freshdesk_article_id}.")
-                print(f"French article found for {freshdesk_article_id}.")
-
-                # Use French - France locale (adjust based on your needs)
-                fr_fr_languagelocaleid = language_dict["French - France"]
-
-                translation_data = {
-                    "Source": {
-                        "@odata.type": "Microsoft.Dynamics.CRM.knowledgearticle",
-                        "knowledgearticleid": dynamics_knowledgearticleid
-                    },
-                    "Language": {
-                        "@odata.type": "Microsoft.Dynamics.CRM.languagelocale",
-                        "languagelocaleid": fr_fr_languagelocaleid
-                    },
-                    "IsMajor": True
-                }
+    level_count = max(reference_levels.values(), default=-1) + 1
+    logger.info(
+        f"Planned {len(ordered_articles)} articles in {level_count} reference levels ({cycles_broken} cycles broken)")
+    print(
+        f"Planned {len(ordered_articles)} articles in {level_count} reference levels ({cycles_broken} cycles broken)")
 
-                # Create French translation if French article exists
-                if french_translation:
-                    create_translation_url = f"{dynamics_url}api/data/v9.2/CreateKnowledgeArticleTranslation"
-
-                    retries = 0
-                    success = False
-                    while not success and retries < 3:
-                        try:
-                            translation_response = make_api_call(
-                                api_session, create_translation_url, "POST", translation_data)
-                            success = True
-                        except requests.exceptions.HTTPError as err:
-                            logger.error(f"Error: {err}")
-                            print(f"Error: {err}")
-                            retries += 1
-                            if retries < 3:
-                                logger.warning(
-                                    f"Retrying {freshdesk_article_id} create FR translation after 6 minutes...")
-                                print(
-                                    f"Retrying {freshdesk_article_id} create FR translation after 6 minutes...")
-                                # Wait for 6 minutes before retrying
-                                time.sleep(360)
-
-                                # Refresh token and session before retry
-                                new_access_token()
-                                api_session = create_api_session()
-
-                    images = {}
-                    get_images_and_internal_references(
-                        french_translation, api_session)
-
-                    fr_content = french_translation["description"]
-                    soup = BeautifulSoup(fr_content, "html.parser")
-                    replace_image_urls(soup)
-
-                    fr_title = french_translation["title"]
-                    translated_article_id = translation_response.json()[
-                        "knowledgearticleid"]
-                    fr_article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({translated_article_id})"
-
-                    french_data = {
-                        "content": f"{soup}",
-                        "title": fr_title
-                    }
-
-                    retries = 0
-                    success = False
-                    while not success and retries < 3:
-                        try:
-                            update_fr_content_response = make_api_call(
-                                api_session, fr_article_url, "PATCH", french_data)
-                            success = True
-                            article_count += 1
-                        except Exception as err:
-                            logger.error(
-                                f"French article update failed for {freshdesk_article_id}: {err}")
-                            print(
-                                f"French article update failed for {freshdesk_article_id}: {err}")
-                            retries += 1
-                            if retries < 3:
-                                logger.warning(
-                                    f"Retrying {freshdesk_article_id} FR after 6 minutes...")
-                                print(
-                                    f"Retrying {freshdesk_article_id} FR after 6 minutes...")
-                                # Wait for 6 minutes before retrying
-                                time.sleep(360)
-
-                                # Refresh token and session before retry
-                                new_access_token()
-                                api_session = create_api_session()
-
-                    # Add delay before retrieving French article number
-                    time.sleep(10)
-
-                    # Get the French article number using retry logic
-                    fr_article_number = get_article_number_with_retry(
-                        api_session, translated_article_id)
-
-                    if not fr_article_number:
-                        logger.warning(
-                            f"Could not retrieve French article number for article {freshdesk_article_id}")
-                        print(
-                            f"Could not retrieve French article number for article {freshdesk_article_id}")
-
-                    # Add French article info to migrated_articles
-                    migrated_articles[freshdesk_article_id].update({
-                        "fr_knowledgearticleid": translated_article_id,
-                        "fr_title": fr_title,
-                        "fr_articlenumber": fr_article_number
-                    })
-                    logger.info(
-                        f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {article_count}.")
-                    print(
-                        f"Knowledge article French content updated successfully for {freshdesk_article_id} - Count: {article_count}.")
+    return ordered_articles
 
-                    # Add delay before updating category for French article
-                    time.sleep(5)  # 5 seconds delay
 
-                    # Update category for French article
-                    fr_category_update_success = update_category(
-                        freshdesk_article_id, translated_article_id, dynamics_category_id, api_session)
-                    if not fr_category_update_success:
-                        logger.warning(
-                            f"Failed to update category for French article {freshdesk_article_id} after all retries")
-                        print(
-                            f"Failed to update category for French article {freshdesk_article_id} after all retries")
-
-                    # Set the French article state based on the Freshdesk status
-                    fr_publish_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({translated_article_id})"
-                    fr_publish_data = {
-                        "statecode": dynamics_statecode,    # 0 for Draft, 3 for Published
-                        "statuscode": dynamics_statuscode   # 2 for Draft, 7 for Published
-                    }
-
-                    retries = 0
-                    fr_publish_success = False
-                    while not fr_publish_success and retries < 3:
-                        try:
-                            fr_publish_response = make_api_call(
-                                api_session, fr_publish_url, "PATCH", fr_publish_data)
-                            fr_publish_success = True
-                            if dynamics_statecode == 3:
-                                logger.info(
-                                    f"French translation for article {freshdesk_article_id} successfully published")
-                                print(
-                                    f"French translation for article {freshdesk_article_id} successfully published")
-                            else:
-                                logger.info(
-                                    f"French translation for article {freshdesk_article_id} set to draft status")
-                                print(
-                                    f"French translation for article {freshdesk_article_id} set to draft status")
-                        except Exception as err:
-                            logger.error(
-                                f"Failed to set status for French article {freshdesk_article_id}: {err}")
-                            print(
-                                f"Failed to set status for French article {freshdesk_article_id}: {err}")
-                            retries += 1
-                            if retries < 3:
-                                logger.warning(
-                                    f"Retrying status update for French article {freshdesk_article_id} after 30 seconds...")
-                                print(
-                                    f"Retrying status update for French article {freshdesk_article_id} after 30 seconds...")
-                                time.sleep(30)
-
-                                # Refresh token if needed
-                                if retries == 2:  # Last retry attempt
-                                    new_access_token()
-                                    api_session = create_api_session()
+# Build the hash index of migrated Freshdesk articles used to rewrite links
+def build_internal_link_index(referenced_article_ids=None):
+    """
+    Args:
+        referenced_article_ids: Only index these Freshdesk articles (all
+            migrated articles by default)
 
-            except Exception as err:
-                logger.warning(
-                    f"No French article found for {freshdesk_article_id}: {err}")
-                print(
-                    f"No French article found for {freshdesk_article_id}: {err}")
+    Returns:
+        Dicts with the Dynamics portal url and is_published, keyed by
+        normalised Freshdesk article URL
+    """
+    # Extract the base portal URL from the Dynamics URL
+    # Usually portal URL is something like: https://[org]-[env].powerappsportals.com/
+    portal_base_url = dynamics_url.replace(
+        "crm3.dynamics.com/", "powerappsportals.com/")
+
+    link_index = {}
 
+    with state_lock:
+        if referenced_article_ids is None:
+            indexed_articles = migrated_articles.items()
         else:
-            logging.error(
-                f"An error occurred: {dynamics_article_response.content if 'dynamics_article_response' in locals() else 'No response'}")
-            print(
-                f"Failed to create knowledge article: {dynamics_article_response.content if 'dynamics_article_response' in locals() else 'No response'}")
-            try:
-                if 'dynamics_article_response' in locals():
-                    print(dynamics_article_response.json())
-            except json.JSONDecodeError:
-                print("No JSON response body.")
+            indexed_articles = [(fd_article_id, migrated_articles[fd_article_id])
+                                for fd_article_id in referenced_article_ids if fd_article_id in migrated_articles]
+
+        for fd_article_id, article_data in indexed_articles:
+            # Use the article number for the portal URL
+            ref_article_number = article_data.get('en_articlenumber')
+            if not ref_article_number:
+                continue
+
+            link_index[normalize_freshdesk_article_url(f"/solutions/articles/{fd_article_id}")] = {
+                # Create the portal URL for the article
+                'url': f"{portal_base_url}knowledgebase/article/{ref_article_number}/",
+                # Check if the referenced article is published
+                'is_published': article_data.get('dynamics_statecode') == 3
+            }
 
-    migrate_articles_datetime = get_utc_datetime()
+    return link_index
 
-    with open(f"./data/migrated_articles_{env}_{migrate_articles_datetime}.json", "w") as migrated_data_file:
-        json.dump(migrated_articles, migrated_data_file, indent=4)
 
-    print("Migrated article data saved.")
+@measured_phase("relink")
+def update_internal_links(api_session=None):
+    """
+    Update internal links in migrated articles using the current mappings.
 
+    Each article's links are walked once and looked up in a hash index of
+    normalised Freshdesk article URLs, so the cost grows with the number of
+    links rather than with articles times mapped URLs.
 
-def update_internal_links(api_session=None):
-    """Update internal links in migrated articles using the current mappings"""
+    Only articles in the reverse reference index whose links have become
+    resolvable since the last call are fetched and patched; articles with
+    nothing pending are never touched again.
+    """
     global migrated_articles, internal_articles_refs_dict
 
-    # Ensure we have a valid session
     if api_session is None:
-        if "access_token" not in globals() or not access_token:
-            new_access_token()
         api_session = create_api_session()
 
-    # Create a mapping of Freshdesk URLs to Dynamics URLs
-    url_mapping = {}
-
     logger.info("Building URL mapping for internal article references")
     print("Building URL mapping for internal article references")
 
-    # Extract the base portal URL from the Dynamics URL
-    # Usually portal URL is something like: https://[org]-[env].powerappsportals.com/
-    portal_base_url = dynamics_url.replace(
-        "crm3.dynamics.com/", "powerappsportals.com/")
-
-    # For each migrated article, find its internal references
-    for fd_article_id, article_data in migrated_articles.items():
-        # Skip if this article doesn't have internal references
-        if str(fd_article_id) not in internal_articles_refs_dict:
-            continue
-
-        # For each reference URL in this article
-        for url in internal_articles_refs_dict[str(fd_article_id)]:
-            # Try to extract the Freshdesk article ID from the URL
-            fd_id_match = re.search(r'articles/(\d+)', url)
-            if fd_id_match:
-                ref_fd_id = int(fd_id_match.group(1))
-                # If this referenced article has been migrated
-                if ref_fd_id in migrated_articles:
-                    # Use the article number for the portal URL
-                    ref_article_number = migrated_articles[ref_fd_id].get(
-                        'en_articlenumber')
-                    # Check if the referenced article is published
-                    ref_is_published = migrated_articles[ref_fd_id].get(
-                        'dynamics_statecode') == 3
-
-                    if ref_article_number:
-                        # Create the portal URL for the article
-                        ref_dynamics_url = f"{portal_base_url}knowledgebase/article/{ref_article_number}/"
-
-                        # Add to mapping with a note if it's a draft
-                        url_mapping[url] = {
-                            'url': ref_dynamics_url,
-                            'is_published': ref_is_published
-                        }
+    link_index = build_internal_link_index()
 
-                        status_note = "published" if ref_is_published else "draft"
-                        logger.info(
-                            f"Mapped Freshdesk URL {url} to Dynamics URL {ref_dynamics_url} (status: {status_note})")
+    relinkable_articles = get_relinkable_articles(link_index)
 
-    # Now update all migrated articles with the new URLs
-    logger.info(f"Found {len(url_mapping)} internal URLs to update")
-    print(f"Found {len(url_mapping)} internal URLs to update")
+    logger.info(
+        f"Found {len(link_index)} migrated articles to link to and {len(relinkable_articles)} articles to relink")
+    print(
+        f"Found {len(link_index)} migrated articles to link to and {len(relinkable_articles)} articles to relink")
 
     updated_count = 0
 
-    # For each migrated article
-    for fd_article_id, article_data in migrated_articles.items():
-        # English article
-        en_article_id = article_data['en_knowledgearticleid']
-        article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({en_article_id})"
+    # For each article with links to resolve, English then French
+    for fd_article_id, referenced_article_ids in relinkable_articles.items():
+        with state_lock:
+            article_data = dict(migrated_articles[fd_article_id])
+
+        article_versions = [
+            (article_data['en_knowledgearticleid'], f"article {fd_article_id}",
+             DRAFT_LINK_NOTES["en"])
+        ]
+        # Check for French translation
+        if "fr_knowledgearticleid" in article_data:
+            article_versions.append(
+                (article_data["fr_knowledgearticleid"], f"French article {fd_article_id}",
+                 DRAFT_LINK_NOTES["fr"]))
 
         try:
-            # Get current content
-            article_response = make_api_call(api_session, article_url, "GET")
-            article_content = article_response.json().get("content", "")
-
-            # Parse content with BeautifulSoup
-            soup = BeautifulSoup(article_content, "html.parser")
-
-            # Track if we made any changes to this article
-            article_updated = False
-
-            # For each link in the mapping
-            for old_url, new_url_data in url_mapping.items():
-                new_url = new_url_data['url']
-                is_published = new_url_data['is_published']
-
-                # Find all links with this URL
-                for a_tag in soup.find_all("a", href=old_url):
-                    a_tag['href'] = new_url
-
-                    # Add a note in the link title if it's a draft
-                    if not is_published:
-                        # Preserve existing title if any
-                        existing_title = a_tag.get('title', '')
-                        if existing_title:
-                            a_tag['title'] = f"{existing_title} (Note: This article is currently in draft status)"
-                        else:
-                            a_tag['title'] = "Note: This article is currently in draft status"
+            with trace_articles([fd_article_id], "relink_article",
+                                {"references.resolvable": len(referenced_article_ids)}):
+                for knowledgearticleid, article_label, draft_note in article_versions:
+                    article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({knowledgearticleid})"
 
-                    article_updated = True
-                    status_note = "published" if is_published else "draft"
-                    logger.info(
-                        f"Updated link in article {fd_article_id} from {old_url} to {new_url} (status: {status_note})")
+                    # Get current content, from the content store unless the server copy changed
+                    article_content = get_article_content(
+                        api_session, knowledgearticleid)
 
-            # If we updated any links, save the content
-            if article_updated:
-                update_data = {
-                    "content": str(soup)
-                }
+                    html_document = parse_article_html(article_content)
 
-                update_response = make_api_call(
-                    api_session, article_url, "PATCH", update_data)
+                    with trace_span("html_rewrite"):
+                        links_rewritten = rewrite_internal_links(
+                            html_document, link_index, draft_note, article_label)
 
-                if update_response.status_code in [204, 200]:
-                    updated_count += 1
-                    logger.info(
-                        f"Successfully updated links in article {fd_article_id}")
-                    print(
-                        f"Successfully updated links in article {fd_article_id}")
-                else:
-                    logger.warning(
-                        f"Failed to update links in article {fd_article_id}")
-                    print(f"Failed to update links in article {fd_article_id}")
-
-            # Check for French translation
-            if "fr_knowledgearticleid" in article_data:
-                fr_article_id = article_data["fr_knowledgearticleid"]
-                fr_article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({fr_article_id})"
-
-                # Get French content
-                fr_article_response = make_api_call(
-                    api_session, fr_article_url, "GET")
-                fr_article_content = fr_article_response.json().get("content", "")
-
-                # Parse French content
-                fr_soup = BeautifulSoup(fr_article_content, "html.parser")
-
-                # Track if we made any changes
-                fr_article_updated = False
-
-                # Update French links
-                for old_url, new_url_data in url_mapping.items():
-                    new_url = new_url_data['url']
-                    is_published = new_url_data['is_published']
-
-                    for a_tag in fr_soup.find_all("a", href=old_url):
-                        a_tag['href'] = new_url
-
-                        # Add a note in the link title if it's a draft (in French)
-                        if not is_published:
-                            # Preserve existing title if any
-                            existing_title = a_tag.get('title', '')
-                            if existing_title:
-                                a_tag['title'] = f"{existing_title} (Remarque: Cet article est actuellement à l'état de brouillon)"
-                            else:
-                                a_tag['title'] = "Remarque: Cet article est actuellement à l'état de brouillon"
-
-                        fr_article_updated = True
-                        status_note = "published" if is_published else "draft"
-                        logger.info(
-                            f"Updated link in French article {fd_article_id} from {old_url} to {new_url} (status: {status_note})")
+                    # If we updated any links, save the content
+                    if links_rewritten:
+                        update_data = {
+                            "content": render_article_html(html_document)
+                        }
 
-                # If we updated any links, save the content
-                if fr_article_updated:
-                    fr_update_data = {
-                        "content": str(fr_soup)
-                    }
+                        update_response = make_api_call(
+                            api_session, article_url, "PATCH", update_data)
 
-                    fr_update_response = make_api_call(
-                        api_session, fr_article_url, "PATCH", fr_update_data)
+                        if update_response.status_code in [204, 200]:
+                            updated_count += 1
+                            store_article_content(knowledgearticleid, update_data["content"],
+                                                  get_response_etag(update_response))
+                            logger.info(
+                                f"Successfully updated links in {article_label}")
+                            print(f"Successfully updated links in {article_label}")
+                        else:
+                            logger.warning(
+                                f"Failed to update links in {article_label}")
+                            print(f"Failed to update links in {article_label}")
+                            # Leave the links pending so the next chunk retries them
+                            raise Exception(
+                                f"Link update returned status code {update_response.status_code}")
 
-                    if fr_update_response.status_code in [204, 200]:
-                        updated_count += 1
-                        logger.info(
-                            f"Successfully updated links in French article {fd_article_id}")
-                        print(
-                            f"Successfully updated links in French article {fd_article_id}")
-                    else:
-                        logger.warning(
-                            f"Failed to update links in French article {fd_article_id}")
-                        print(
-                            f"Failed to update links in French article {fd_article_id}")
+                mark_references_linked(fd_article_id, referenced_article_ids)
 
         except Exception as err:
             logger.error(
@@ -1350,23 +4752,28 @@ def update_internal_links(api_session=None):
 
 
 # Function to process articles in chunks
-def process_articles_in_chunks(articles, chunk_size=50):
+def process_articles_in_chunks(articles, chunk_size=50, max_workers=MAX_WORKERS, resume=False, spool_path=None):
     """
     Process articles in chunks with automatic session management.
 
     Args:
-        articles: List of articles to process
+        articles: List of articles to process, or of article summaries if
+            spool_path is given
+        spool_path: Spool written by spool_freshdesk_articles; each chunk is
+            read from it when its turn comes, so one chunk is in memory at a time
         chunk_size: Number of articles to process in each chunk
+        max_workers: Number of articles (or $batch requests) migrated concurrently
+        resume: Skip the steps the migration journal shows as finished
     """
-    global access_token, chunk, migrated_articles
+    global chunk, migrated_articles
     chunk_number = 1
 
     # Initialize migrated_articles if not already defined
     if "migrated_articles" not in globals():
         migrated_articles = {}
 
-    # Ensure we have a valid token
-    new_access_token()
+    # Migrate the articles that others link to first, so most links are written at creation
+    articles = plan_article_order(articles)
 
     # Process all articles in chunks
     for i in range(0, len(articles), chunk_size):
@@ -1376,25 +4783,29 @@ def process_articles_in_chunks(articles, chunk_size=50):
 
         # Get the current chunk of articles
         chunk = articles[i:i + chunk_size]
+        if spool_path is not None:
+            chunk = list(read_spooled_articles(spool_path, chunk))
 
         # Process the current chunk
-        migrate_to_dynamics(chunk)
+        migrate_to_dynamics(chunk, max_workers=max_workers, resume=resume)
 
         # Create session for post-processing
         api_session = create_api_session()
 
-        # Update article numbers for articles that don't have them
+        # Let the background resolver finish, then pick up any stragglers
         logger.info("Checking for missing article numbers...")
         print("Checking for missing article numbers...")
-        update_article_numbers(api_session)
+        if wait_for_article_numbers():
+            update_article_numbers(api_session)
 
         # Update internal links after each chunk
         update_internal_links(api_session)
+        flush_journal()
 
-        # Save the current state of migrated_articles after each chunk
-        migrate_articles_datetime = get_utc_datetime()
-        with open(f"./data/migrated_articles_{env}_{migrate_articles_datetime}.json", "w") as migrated_data_file:
-            json.dump(migrated_articles, migrated_data_file, indent=4)
+        # Save the records changed by this chunk, such as links and article numbers
+        save_state_log()
+        write_metrics_summary(chunk_number)
+        write_article_traces()
 
         # Increment the chunk counter
         chunk_number += 1
@@ -1406,131 +4817,485 @@ def process_articles_in_chunks(articles, chunk_size=50):
             f"Total processing time: {total_elapsed_minutes:.2f} minutes")
         print(f"Total processing time: {total_elapsed_minutes:.2f} minutes")
 
-        # Refresh token between chunks to ensure we have a fresh session
-        new_access_token()
+        freshdesk_rate_status = get_freshdesk_rate_status()
+        logger.info(
+            f"Freshdesk API spend: {freshdesk_rate_status['requests_per_minute']} requests in the last minute (limit {freshdesk_rate_status['limit_per_minute']:.0f}/minute)")
 
 
-# Get Freshdesk categories as categories
-categories_url = f"{freshdesk_url}solutions/categories/"
-categories = freshdesk_get(categories_url)
+# Add the unchanged Dynamics articles that changed articles link to, so their links are written
+def load_link_targets(api_session, articles, existing_articles):
+    """
+    A delta sync only migrates changed articles, so the articles they link
+    to are looked up in Dynamics and added to migrated_articles as link
+    targets.
+
+    Args:
+        articles: Changed Freshdesk articles, or their spooled summaries
+        existing_articles: Dynamics articles of the changed articles, from find_existing_articles
+    """
+    global migrated_articles
 
-top_level_categories = []
+    link_targets = dict(existing_articles)
 
-for category in categories:
-    top_level_categories.append(category["id"])
-    category["is_top_level"] = 1
+    referenced_article_ids = set()
+    for article in articles:
+        if "referenced_article_ids" in article:
+            referenced_article_ids.update(article["referenced_article_ids"])
+            continue
 
+        for url in LINK_HREF_PATTERN.findall(article.get("description") or ""):
+            referenced_article_id = get_referenced_article_id(url)
+            if referenced_article_id is not None:
+                referenced_article_ids.add(referenced_article_id)
+
+    with state_lock:
+        referenced_article_ids = {referenced_article_id for referenced_article_id in referenced_article_ids
+                                  if referenced_article_id not in migrated_articles
+                                  and referenced_article_id not in link_targets}
+    if referenced_article_ids:
+        link_targets.update(find_existing_articles(
+            api_session, referenced_article_ids))
+
+    with state_lock:
+        for freshdesk_article_id, existing_article in link_targets.items():
+            migrated_articles.setdefault(freshdesk_article_id, {
+                "en_knowledgearticleid": existing_article["knowledgearticleid"],
+                "en_articlenumber": existing_article.get("articlepublicnumber"),
+                "dynamics_statecode": existing_article.get("statecode"),
+                "dynamics_statuscode": existing_article.get("statuscode"),
+                "link_target_only": True
+            })
+
+
+# Find the French translation of a Dynamics article
+def find_french_translation(api_session, dynamics_knowledgearticleid):
+    """
+    Returns:
+        knowledgearticleid of the French translation, or None if there isn't one
+    """
+    translation_url = (
+        f"{dynamics_url}api/data/v9.2/knowledgearticles?$select=knowledgearticleid"
+        f"&$filter=_parentarticlecontentid_value eq {dynamics_knowledgearticleid} and "
+        f"_languagelocaleid_value eq {language_dict['French - France']}")
 
-new_access_token()
+    translations = make_api_call(
+        api_session, translation_url, "GET").json().get("value", [])
 
+    return translations[0]["knowledgearticleid"] if translations else None
 
-# Get categories from Dynamics
-global access_token, dynamics_categories_dict
 
-# Ensure we have a valid token
-if not "access_token" in globals() or not access_token:
-    new_access_token()
+# Bring an article that already exists in Dynamics up to date with its changed Freshdesk version
+@measured_phase("article_update")
+def update_existing_article(article, existing_article, api_session):
+    """
+    PATCH the content of the existing Dynamics article instead of creating a
+    new one. The category and state steps only run if the folder or the
+    status changed; images are taken from the image cache unless they are new.
 
-# Create a session
-api_session = create_api_session()
+    Returns:
+        True if the English article was updated
+    """
+    freshdesk_article_id = int(article["id"])
+    dynamics_knowledgearticleid = existing_article["knowledgearticleid"]
+    dynamics_category_id = article["dynamics_category_id"]
+    dynamics_statecode, dynamics_statuscode = get_dynamics_status(article)
+    article_url = f"{dynamics_url}api/data/v9.2/knowledgearticles({dynamics_knowledgearticleid})"
 
-dynamics_categories_url = f"{dynamics_url}api/data/v9.2/categories"
+    logger.info(
+        f"Updating article {freshdesk_article_id} in Dynamics ({dynamics_knowledgearticleid})")
+    print(
+        f"Updating article {freshdesk_article_id} in Dynamics ({dynamics_knowledgearticleid})")
+
+    content = prepare_article_content(article, api_session)
+    update_data = {
+        "title": article["title"],
+        "content": content,
+        "isinternal": article["dynamics_isinternal"]
+    }
 
-try:
-    dynamics_categories_response = make_api_call(
-        api_session, dynamics_categories_url, "GET")
+    try:
+        update_response = make_api_call(
+            api_session, article_url, "PATCH", update_data)
+    except Exception as err:
+        logger.error(
+            f"Failed to update article {freshdesk_article_id}: {err}")
+        print(f"Failed to update article {freshdesk_article_id}: {err}")
+        return False
+
+    store_article_content(dynamics_knowledgearticleid, content,
+                          get_response_etag(update_response))
+    record_migrated_article(article, dynamics_knowledgearticleid, existing_article.get("articlepublicnumber"),
+                            dynamics_statecode, dynamics_statuscode)
+
+    count = increment_article_count()
+    logger.info(
+        f"Knowledge article updated successfully for {freshdesk_article_id} - Count: {count}.")
+    print(
+        f"Knowledge article updated successfully for {freshdesk_article_id} - Count: {count}.")
+
+    # Move the article to its new category if it changed folders
+    previous_category_id = existing_article.get("_revops_category_value")
+    category_changed = previous_category_id != dynamics_category_id
+    if category_changed:
+        if previous_category_id:
+            try:
+                make_api_call(
+                    api_session, f"{article_url}/knowledgearticle_category({previous_category_id})/$ref", "DELETE")
+            except Exception as err:
+                logger.warning(
+                    f"Failed to remove the previous category of article {freshdesk_article_id}: {err}")
+                print(
+                    f"Failed to remove the previous category of article {freshdesk_article_id}: {err}")
 
-    dynamics_categories = [item for item in dynamics_categories_response.json()[
-        "value"]]
+        if not update_category(freshdesk_article_id, dynamics_knowledgearticleid, dynamics_category_id, api_session):
+            return False
 
-    dynamics_categories_dict = {}
+    # Update the state only if the Freshdesk status changed
+    if (existing_article.get("statecode"), existing_article.get("statuscode")) != (dynamics_statecode, dynamics_statuscode):
+        publish_data = {
+            "statecode": dynamics_statecode,    # 0 for Draft, 3 for Published
+            "statuscode": dynamics_statuscode   # 2 for Draft, 7 for Published
+        }
+
+        try:
+            publish_response = make_api_call(
+                api_session, article_url, "PATCH", publish_data)
+            set_article_content_etag(
+                dynamics_knowledgearticleid, get_response_etag(publish_response))
+        except Exception as err:
+            logger.error(
+                f"Failed to set status for article {freshdesk_article_id}: {err}")
+            print(
+                f"Failed to set status for article {freshdesk_article_id}: {err}")
+            return False
+
+    french_translation = get_article_translation(article, "fr")
+    if not french_translation:
+        return True
+
+    translated_article_id = find_french_translation(
+        api_session, dynamics_knowledgearticleid)
+    completed_steps = {}
+    if translated_article_id is not None:
+        with state_lock:
+            fr_article_data = {
+                "fr_knowledgearticleid": translated_article_id,
+                "fr_title": french_translation["title"],
+                "fr_articlenumber": None
+            }
+            migrated_articles[freshdesk_article_id].update(fr_article_data)
+            record_step(freshdesk_article_id, "fr_created", fr_article_data)
+        queue_article_number(freshdesk_article_id,
+                             translated_article_id, "fr_articlenumber")
+        if not category_changed:
+            completed_steps["fr_category"] = {}
+
+    migrate_french_translation(
+        freshdesk_article_id, french_translation, dynamics_knowledgearticleid, dynamics_category_id,
+        dynamics_statecode, dynamics_statuscode, api_session, translated_article_id=translated_article_id,
+        completed_steps=completed_steps)
 
-    for item in dynamics_categories:
-        dynamics_categories_dict.update({item["revops_freshdeskcategoryid"]: {
-            "title": item["title"],
-            "categoryid": item["categoryid"],
-            "parent_category_id": item["_parentcategoryid_value"],
-            "category_number": item["categorynumber"]
-        }})
+    return True
 
-except Exception as e:
-    logger.error(f"Failed to get categories: {str(e)}")
-    print(f"Failed to get categories: {str(e)}")
 
+# Worker that creates or updates one changed article
+def sync_article_worker(article, existing_article=None):
+    """
+    Returns:
+        True if the article is in sync with Freshdesk
+    """
+    try:
+        with trace_articles([article["id"]], "sync_article", {"existing": existing_article is not None}):
+            if existing_article is None:
+                migrate_article(article, get_worker_session())
+                with state_lock:
+                    return int(article["id"]) in migrated_articles
 
-# Save categories
-env = re.search(r"-(.*?).crm3", dynamics_url).group(1)
+            return update_existing_article(article, existing_article, get_worker_session())
 
-dyn_category_query_datetime = get_utc_datetime()
-with open(f"./data/imported_categories_{dyn_category_query_datetime}_{env}_env.json", "w") as json_file:
-    json.dump(dynamics_categories_dict, json_file)
+    except Exception as err:
+        logger.error(f"Failed to sync article {article['id']}: {err}")
+        print(f"Failed to sync article {article['id']}: {err}")
+        return False
 
 
-# Add categories to dynamics
-global imported_categories
-imported_categories = {}
+# Pass on the articles updated after the high-water mark of their folder, noting every article seen
+def filter_changed_articles(article_stream, sync_marks, synced_articles):
+    """
+    Args:
+        sync_marks: Freshdesk updated_at strings keyed by Freshdesk folder ID
+        synced_articles: List that gets the id, folder and updated_at of every article
+    """
+    for article in article_stream:
+        synced_articles.append({key: article[key] for key in ("id", "freshdesk_folder_id", "updated_at")})
+        if article["updated_at"] > sync_marks.get(article["freshdesk_folder_id"], ""):
+            yield article
+
+
+# Sync the articles of a category changed since the last sync
+def sync_category_changes(category, chunk_size=50, max_workers=MAX_WORKERS):
+    """
+    Freshdesk can't filter the article listings by updated_at, so the
+    folders are still listed, but only articles updated after the
+    high-water mark of their folder are migrated. Articles that already
+    exist in Dynamics are updated in place; new articles are created.
+    Changed articles are spooled to disk and read back chunk_size at a time.
+
+    The high-water mark of a folder moves forward only once every changed
+    article in it is synced, so failed articles are retried by the next run.
+    """
+    global migrated_articles
+
+    sync_marks = get_sync_marks()
+    synced_articles = []
+
+    spool_path = f"./data/freshdesk_changed_articles_{get_utc_datetime()}.jsonl"
+    with measure_phase("freshdesk_crawl"):
+        changed_articles = spool_freshdesk_articles(
+            filter_changed_articles(crawl_freshdesk_articles(crawl_freshdesk_folders(category), max_workers),
+                                    sync_marks, synced_articles),
+            spool_path)
+
+    logger.info(
+        f"Delta sync: {len(changed_articles)} of {len(synced_articles)} articles changed since the last sync")
+    print(
+        f"Delta sync: {len(changed_articles)} of {len(synced_articles)} articles changed since the last sync")
+
+    failed_article_ids = set()
+    if changed_articles:
+        api_session = create_api_session()
+        existing_articles = find_existing_articles(
+            api_session, [int(article["id"]) for article in changed_articles])
+        load_link_targets(api_session, changed_articles, existing_articles)
+
+        # New articles that others link to are created first, level by level
+        changed_articles = plan_article_order(changed_articles)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            reference_levels = group_reference_levels(changed_articles)
+            for level_index, level_summaries in enumerate(reference_levels):
+                for i in range(0, len(level_summaries), chunk_size):
+                    level_articles = list(read_spooled_articles(
+                        spool_path, level_summaries[i:i + chunk_size]))
+                    results = executor.map(
+                        lambda article: sync_article_worker(article, existing_articles.get(int(article["id"]))),
+                        level_articles)
+                    failed_article_ids.update(int(article["id"]) for article, synced in zip(level_articles, results)
+                                              if not synced)
+
+                if level_index < len(reference_levels) - 1:
+                    wait_for_level_numbers(level_summaries)
+
+        if wait_for_article_numbers():
+            update_article_numbers(api_session)
+        update_internal_links(api_session)
+        flush_journal()
+        save_state_log()
+        write_metrics_summary(f"delta {category['id']}")
+        write_article_traces()
+
+    if failed_article_ids:
+        logger.warning(
+            f"Delta sync: {len(failed_article_ids)} articles failed; their folders will be synced again by the next run")
+        print(
+            f"Delta sync: {len(failed_article_ids)} articles failed; their folders will be synced again by the next run")
+
+    save_sync_marks(get_high_water_marks(synced_articles, failed_article_ids))
+
+
+# Parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Migrate Freshdesk knowledge articles to Dynamics 365.")
+    parser.add_argument("--env", choices=sorted(DYNAMICS_ENVIRONMENTS),
+                        help='"d" for Dev, "e" for DevPortal, "s" for Staging or "p" for Production (prompted if omitted)')
+    parser.add_argument("--import-categories", choices=["y", "n"],
+                        help="Import the Freshdesk categories into Dynamics (prompted if omitted)")
+    run_mode = parser.add_mutually_exclusive_group()
+    run_mode.add_argument("--resume", action="store_true",
+                          help="Continue the last run from the migration journal, skipping finished steps")
+    run_mode.add_argument("--delta", action="store_true",
+                          help="Sync only the articles updated in Freshdesk since the last run")
+    parser.add_argument("--html-parser", choices=["html.parser", "lxml", "html5lib"],
+                        help=f"Parser for article HTML (default: {HTML_PARSER})")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Also write a full migrated_articles JSON snapshot at the end of the run")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this local port while the migration runs")
+    parser.add_argument("--trace", action="store_true", default=TRACE_ARTICLES,
+                        help="Write one trace per Freshdesk article to ./data/traces_{env}.jsonl (OTLP JSON)")
+    return parser.parse_args()
+
+
+# Get Freshdesk categories as categories
+def get_freshdesk_categories():
+    categories_url = f"{freshdesk_url}solutions/categories/"
+    categories = list(freshdesk_iter(categories_url))
 
-import_categories_prompt = input("Import Freshdesk categories? (y/n): ")
-if import_categories_prompt.lower() == "y":
-    import_categories_to_dynamics(categories)
     for category in categories:
-        get_freshdesk_folders(category)
-        import_categories_to_dynamics(kb_folders)
-else:
-    print("No categories were added.")
-    imported_categories = dynamics_categories_dict
+        category["is_top_level"] = 1
 
+    return categories
 
-# Get languages
 
-# Ensure we have a valid token
-if not "access_token" in globals() or not access_token:
-    new_access_token()
+# Get categories from Dynamics
+def get_dynamics_categories():
+    # Create a session
+    api_session = create_api_session()
+
+    dynamics_categories_url = f"{dynamics_url}api/data/v9.2/categories"
 
-# Create a session
-api_session = create_api_session()
+    dynamics_categories_dict = {}
 
-languages_url = f"{dynamics_url}api/data/v9.2/languagelocale"
+    try:
+        dynamics_categories_response = make_api_call(
+            api_session, dynamics_categories_url, "GET")
 
-try:
-    response = make_api_call(api_session, languages_url, "GET")
+        dynamics_categories = [item for item in dynamics_categories_response.json()[
+            "value"]]
 
-    languages = response.json().get("value", [])
-    language_dict = {}
-    for language in languages:
-        language_dict[language["name"]] = language["languagelocaleid"]
+        for item in dynamics_categories:
+            dynamics_categories_dict.update({item["revops_freshdeskcategoryid"]: {
+                "title": item["title"],
+                "categoryid": item["categoryid"],
+                "parent_category_id": item["_parentcategoryid_value"],
+                "category_number": item["categorynumber"]
+            }})
 
-except Exception as e:
-    logger.error(f"Failed to retrieve languages: {str(e)}")
-    print(f"Failed to retrieve languages: {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to get categories: {str(e)}")
+        print(f"Failed to get categories: {str(e)}")
 
+    # Save categories
+    dyn_category_query_datetime = get_utc_datetime()
+    with open(f"./data/imported_categories_{dyn_category_query_datetime}_{env}_env.json", "w") as json_file:
+        json.dump(dynamics_categories_dict, json_file)
 
-# Run full import to Dynamics
-article_count = 1
+    return dynamics_categories_dict
 
-# Start with a fresh token
-new_access_token()
 
-for category in categories:
-    # Create a session for this category's processing
+# Get languages
+def get_languages():
+    # Create a session
     api_session = create_api_session()
 
-    # Get all folders for this category
-    get_freshdesk_folders(category)
-    print(f"Found {len(kb_folders)} folders in category")
+    languages_url = f"{dynamics_url}api/data/v9.2/languagelocale"
+
+    languages_by_name = {}
+
+    try:
+        response = make_api_call(api_session, languages_url, "GET")
+
+        languages = response.json().get("value", [])
+        for language in languages:
+            languages_by_name[language["name"]] = language["languagelocaleid"]
+
+    except Exception as e:
+        logger.error(f"Failed to retrieve languages: {str(e)}")
+        print(f"Failed to retrieve languages: {str(e)}")
+
+    return languages_by_name
+
+
+# Choose a run option from the command line, the journal of the resumed run or a prompt
+def get_run_option(name, value, resume, prompt):
+    saved_value = get_run_setting(name) if resume else None
+
+    if value and saved_value and value.lower() != saved_value:
+        raise SystemExit(
+            f"--{name.replace('_', '-')} {value} doesn't match the resumed run ({saved_value})")
+
+    value = (value or saved_value or input(prompt)).lower()
+    save_run_setting(name, value)
+    return value
+
+
+def main():
+    global imported_categories, language_dict, HTML_PARSER, TRACE_ARTICLES
+
+    args = parse_arguments()
+    if args.html_parser:
+        HTML_PARSER = args.html_parser
+    TRACE_ARTICLES = args.trace
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    open_journal(resume=args.resume)
+
+    environment_choice = get_run_option(
+        "env", args.env, args.resume,
+        'Please enter "d" for Dev, "e" for DevPortal, "s" for Staging, or "p" for Production environment: ')
+    configure_environment(environment_choice)
+    open_state_log()
+    load_client_secret()
+    open_image_cache()
+    open_content_store()
+    open_sync_state()
+    load_freshdesk_api_key()
+
+    categories = get_freshdesk_categories()
+    dynamics_categories_dict = get_dynamics_categories()
+
+    # Add categories to dynamics
+    imported_categories = {}
+
+    import_categories_prompt = get_run_option(
+        "import_categories", args.import_categories, args.resume, "Import Freshdesk categories? (y/n): ")
+    if import_categories_prompt == "y" and get_run_setting("categories_imported"):
+        # A resumed run reuses the categories imported by the first attempt
+        print("Categories were imported by the resumed run.")
+        imported_categories = dynamics_categories_dict
+    elif import_categories_prompt == "y":
+        import_categories_to_dynamics(categories)
+        for category in categories:
+            get_freshdesk_folders(category)
+            import_categories_to_dynamics(kb_folders)
+        save_run_setting("categories_imported", "y")
+    else:
+        print("No categories were added.")
+        imported_categories = dynamics_categories_dict
+
+    language_dict = get_languages()
+
+    if args.resume:
+        journal_steps.update(load_journal())
+        restore_from_journal(journal_steps)
+        # Pick up the article numbers the last run didn't get to
+        update_article_numbers(create_api_session())
+
+    # Run full import (or delta sync) to Dynamics
+    for category in categories:
+        if args.delta:
+            # Create or update only the articles changed since the last sync
+            sync_category_changes(category)
+            save_internal_references_to_json()
+            continue
+
+        # Crawl the folders of this category and download their articles as each folder is found
+        download_freshdesk_articles(crawl_freshdesk_folders(category))
+        print(f"Downloaded {len(articles)} articles")
 
-    # Download articles from Freshdesk
-    download_freshdesk_articles(kb_folders)
-    print(f"Downloaded {len(articles)} articles")
+        # Process all articles in chunks (the token manager keeps the token fresh)
+        process_articles_in_chunks(
+            articles, resume=args.resume, spool_path=articles_spool_path)
 
-    # Process all articles in chunks with automatic token refresh
-    process_articles_in_chunks(articles)
+        # Start later delta syncs from this run, except in folders with articles that failed
+        with state_lock:
+            failed_article_ids = {int(article["id"]) for article in articles
+                                  if int(article["id"]) not in migrated_articles}
+        save_sync_marks(get_high_water_marks(articles, failed_article_ids))
 
-    # Save internal article references
-    save_internal_references_to_json()
+        # Save internal article references
+        save_internal_references_to_json()
 
-    # Refresh token after completing a full category
-    new_access_token()
+    flush_journal()
+    flush_saved_images()
+    save_state_log()
+    write_metrics_summary("final")
+    write_article_traces()
+    if args.snapshot:
+        write_state_snapshot()
+
+    logger.info("Migration complete.")
+    print("Migration complete.")
 
 
 # FINAL ARTICLE NUMBER UPDATE - Run this if you still have articles without article numbers
@@ -1587,7 +5352,6 @@ for category in categories:
 # Uncomment and run if you need to update missing article numbers after migration
 # final_article_number_update()
 
-print("Migration script loaded successfully!")
-print("To run migration:")
-print("1. Ensure your variables.py and parameters.json are configured")
-print("2. Run the script")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Local stand-in for Freshdesk that posts synthetic article webhooks to the webhook sync service
+#
+# Sends bursts of events for random articles, honours Retry-After on 503
+# like Freshdesk does, then reports what the service accepted.
+#
+# Usage:
+#   python freshdesk_webhook_sync.py --dry-run &
+#   python stubs/freshdesk_webhook_stand_in.py --events 2000 --rate 200
+
+import time
+import random
+import argparse
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+EVENT_NAMES = ["article_created", "article_updated", "article_deleted"]
+
+
+# Build the synthetic events: bursts of updates per article, with some creates and deletes
+def generate_events(event_count, article_count, burst_size, delete_ratio, seed=0):
+    rng = random.Random(seed)
+    events = []
+
+    while len(events) < event_count:
+        article_id = rng.randint(1, article_count)
+        burst = ["article_updated"] * rng.randint(1, burst_size)
+        if rng.random() < 0.1:
+            burst.insert(0, "article_created")
+        if rng.random() < delete_ratio:
+            burst.append("article_deleted")
+
+        events.extend({"event": event_name, "article_id": article_id} for event_name in burst)
+
+    return events[:event_count]
+
+
+# Post one event, retrying after the Retry-After of a 503
+def post_event(session, url, event, token=None, max_retries=3, max_retry_wait=5):
+    """
+    Returns:
+        Tuple of (final status code, number of 503 responses)
+    """
+    headers = {"X-Webhook-Token": token} if token else {}
+    rejected_count = 0
+
+    for attempt in range(max_retries + 1):
+        response = session.post(url, json=event, headers=headers, timeout=30)
+        if response.status_code != 503:
+            return response.status_code, rejected_count
+
+        rejected_count += 1
+        if attempt < max_retries:
+            time.sleep(min(float(response.headers.get("Retry-After", 1)), max_retry_wait))
+
+    return response.status_code, rejected_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post synthetic Freshdesk article webhooks to the webhook sync service.")
+    parser.add_argument("--url", default="http://127.0.0.1:8765/freshdesk/webhook", help="Webhook endpoint")
+    parser.add_argument("--events", type=int, default=1000, help="Events to post (default: 1000)")
+    parser.add_argument("--articles", type=int, default=200, help="Article IDs the events are spread over (default: 200)")
+    parser.add_argument("--burst", type=int, default=5, help="Most updates in one article's burst (default: 5)")
+    parser.add_argument("--delete-ratio", type=float, default=0.02, help="Share of bursts ending in a delete (default: 0.02)")
+    parser.add_argument("--rate", type=float, default=100, help="Events posted per second (default: 100)")
+    parser.add_argument("--senders", type=int, default=8, help="Concurrent senders (default: 8)")
+    parser.add_argument("--token", help="X-Webhook-Token to send")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    events = generate_events(args.events, args.articles, args.burst, args.delete_ratio, args.seed)
+    session = requests.Session()
+    status_counts = {}
+    rejected_total = 0
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.senders) as executor:
+        futures = []
+        for index, event in enumerate(events):
+            # Pace the events at the requested rate
+            delay = start_time + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(post_event, session, args.url, event, args.token))
+
+        for future in futures:
+            status_code, rejected_count = future.result()
+            status_counts[status_code] = status_counts.get(status_code, 0) + 1
+            rejected_total += rejected_count
+    elapsed_seconds = time.perf_counter() - start_time
+
+    distinct_articles = len({event["article_id"] for event in events})
+    print(f"Posted {len(events)} events for {distinct_articles} articles in {elapsed_seconds:.1f} seconds")
+    print(f"Final status codes: {dict(sorted(status_counts.items()))}")
+    print(f"503 responses retried: {rejected_total}")
+
+    health = session.get(args.url.rsplit("/", 2)[0] + "/health", timeout=10)
+    if health.ok:
+        print(f"Service queue: {health.json()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,701 @@
+# Local stand-ins for the Freshdesk API, the Freshdesk image CDN and the Dataverse Web API
+#
+# Serve a synthetic knowledge base over HTTP with configurable latency, so the
+# migration can run end to end offline. Faults (expired tokens, 429s, 5xx,
+# hung and dropped requests, slow article numbers) can be injected at
+# configurable rates. Used by benchmarks/migration_benchmark.py.
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+from urllib.parse import urlparse, parse_qsl, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DATAVERSE_API_PATH = "/api/data/v9.2/"
+FRESHDESK_API_PATH = "/api/v2/"
+FRESHDESK_RATE_LIMIT_TOTAL = 1000000  # X-RateLimit-Total reported to the migration's token bucket
+
+IN_FILTER_PATTERN = re.compile(r"Microsoft\.Dynamics\.CRM\.In\(PropertyName='([^']+)',PropertyValues=\[([^\]]*)\]\)")
+EQ_FILTER_PATTERN = re.compile(r"^(\w+) eq (.+)$")
+
+# Faults injected into any request, in the order their rates are rolled
+REQUEST_FAULTS = ["429", "5xx", "timeout", "drop"]
+
+# Fault rates (share of requests, or of created articles for slow_number) and their settings
+DEFAULT_FAULTS = {
+    "401": 0.0,  # Dataverse only: the token presented is expired, until the client refreshes it
+    "429": 0.0,  # Throttled with Retry-After
+    "5xx": 0.0,  # 500, 502 or 503 without Retry-After
+    "timeout": 0.0,  # Held for timeout_seconds (longer than the client's read timeout), then closed without a response
+    "drop": 0.0,  # Closed without a response
+    "slow_number": 0.0,  # Dataverse only: article number generated slow_number_seconds late
+    "retry_after_seconds": 2,
+    "timeout_seconds": 30,
+    "slow_number_seconds": 30
+}
+
+HTTP_REASONS = {200: "OK", 201: "Created", 204: "No Content", 304: "Not Modified", 400: "Bad Request",
+                401: "Unauthorized", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+                502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+# Build a synthetic knowledge base
+def generate_knowledge_base(categories=2, folders_per_category=3, subfolders_per_folder=1, articles_per_folder=20,
+                            images_per_article=2, shared_image_ratio=0.2, link_density=2, fr_ratio=0.5,
+                            draft_ratio=0.1, article_kb=8, image_kb=32, portal_domain="helpdesk.yourcompany.com",
+                            seed=0):
+    """
+    Args:
+        link_density: Internal links per article, to random articles of the knowledge base
+        shared_image_ratio: Share of images reused from a small pool, as logos and icons are
+        fr_ratio: Share of articles with a French translation
+
+    Returns:
+        Dict with categories, folders, articles, translations and image sizes,
+        keyed the way the stand-in servers look them up
+    """
+    rng = random.Random(seed)
+    words = ["account", "billing", "password", "reset", "invoice", "customer", "portal", "settings",
+             "click", "select", "the", "and", "to", "your", "from", "menu", "report", "export"]
+
+    knowledge_base = {
+        "categories": [],
+        "category_folders": {},
+        "subfolders": {},
+        "folders": {},
+        "folder_articles": {},
+        "articles": {},
+        "translations": {"fr": {}},
+        "images": {},
+        "portal_domain": portal_domain,
+        "image_cdn_url": None  # Set by start_stand_in_servers
+    }
+
+    shared_images = [f"shared_{index}.png" for index in range(10)]
+    for image_name in shared_images:
+        knowledge_base["images"][image_name] = image_kb * 1024
+
+    folder_ids = []
+    next_folder_id = 1000
+    for category_index in range(categories):
+        category_id = 100 + category_index
+        knowledge_base["categories"].append({
+            "id": category_id, "name": f"Category {category_index}", "description": "", "visibility_in_portals": []})
+        knowledge_base["category_folders"][category_id] = []
+
+        for folder_index in range(folders_per_category):
+            folder_id = next_folder_id
+            next_folder_id += 1
+            knowledge_base["category_folders"][category_id].append(folder_id)
+            knowledge_base["folders"][folder_id] = {
+                "id": folder_id, "name": f"Folder {folder_id}", "description": "",
+                "visibility": rng.choice([1, 1, 2, 3]), "sub_folders_count": subfolders_per_folder,
+                "hierarchy": [{"level": 0, "type": "category", "data": {"id": category_id}}]}
+            knowledge_base["subfolders"][folder_id] = []
+            folder_ids.append(folder_id)
+
+            for _ in range(subfolders_per_folder):
+                subfolder_id = next_folder_id
+                next_folder_id += 1
+                knowledge_base["subfolders"][folder_id].append(subfolder_id)
+                knowledge_base["subfolders"][subfolder_id] = []
+                knowledge_base["folders"][subfolder_id] = {
+                    "id": subfolder_id, "name": f"Folder {subfolder_id}", "description": "",
+                    "visibility": 1, "sub_folders_count": 0, "parent_folder_id": folder_id}
+                folder_ids.append(subfolder_id)
+
+    article_ids = [10000 + index for index in range(len(folder_ids) * articles_per_folder)]
+    image_index = 0
+
+    for folder_position, folder_id in enumerate(folder_ids):
+        folder_article_ids = article_ids[folder_position * articles_per_folder:(folder_position + 1) * articles_per_folder]
+        knowledge_base["folder_articles"][folder_id] = folder_article_ids
+        knowledge_base["folders"][folder_id]["articles_count"] = len(folder_article_ids)
+
+        for article_id in folder_article_ids:
+            image_names = []
+            for _ in range(images_per_article):
+                if rng.random() < shared_image_ratio:
+                    image_names.append(rng.choice(shared_images))
+                else:
+                    image_name = f"image_{image_index}.png"
+                    image_index += 1
+                    knowledge_base["images"][image_name] = image_kb * 1024
+                    image_names.append(image_name)
+
+            linked_article_ids = [rng.choice(article_ids) for _ in range(link_density)]
+
+            for locale in ["en", "fr"]:
+                if locale == "fr" and rng.random() >= fr_ratio:
+                    break
+
+                parts = []
+                while sum(len(part) for part in parts) < article_kb * 1024:
+                    parts.append(f"<p>{' '.join(rng.choice(words) for _ in range(20)).capitalize()}.</p>")
+                for image_name in image_names:
+                    parts.insert(rng.randrange(len(parts) + 1),
+                                 f'<p><img src="{{image_cdn_url}}/images/{image_name}?X-Amz-Signature={rng.getrandbits(64):x}" '
+                                 f'alt="{image_name}"></p>')
+                for linked_article_id in linked_article_ids:
+                    parts.insert(rng.randrange(len(parts) + 1),
+                                 f'<p>See <a href="https://{portal_domain}/support/solutions/articles/{linked_article_id}-related">'
+                                 f'article {linked_article_id}</a>.</p>')
+
+                article = {
+                    "id": article_id, "title": f"Article {article_id} ({locale})", "description": "".join(parts),
+                    "status": 1 if rng.random() < draft_ratio else 2, "folder_id": folder_id,
+                    "category_id": None, "attachments": [], "created_at": "2024-01-01T00:00:00Z",
+                    "updated_at": f"2024-01-{rng.randint(1, 28):02d}T00:00:00Z", "language": locale}
+
+                if locale == "en":
+                    knowledge_base["articles"][article_id] = article
+                else:
+                    knowledge_base["translations"]["fr"][article_id] = article
+
+    return knowledge_base
+
+
+# Count the requests a stand-in server receives
+def count_request(server, route):
+    with server.stand_in["lock"]:
+        server.stand_in["request_counts"][route] = server.stand_in["request_counts"].get(route, 0) + 1
+
+
+# Sleep for the configured latency of a stand-in server
+def simulate_latency(server):
+    latency_ms = server.stand_in["latency_ms"]
+    if latency_ms:
+        jitter_ms = server.stand_in["jitter_ms"]
+        time.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+
+# Base handler: JSON responses and quiet logging
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_body(self, status_code, body=b"", headers=None):
+        self.send_response(status_code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_json(self, status_code, body, headers=None):
+        response_headers = {"Content-Type": "application/json; charset=utf-8"}
+        response_headers.update(headers or {})
+        self.send_body(status_code, json.dumps(body).encode("utf-8"), response_headers)
+
+    def read_body(self):
+        content_length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(content_length) if content_length else b""
+
+    def inject_fault(self):
+        """
+        Fail the request at the fault rates of the stand-in.
+
+        Returns:
+            True if a fault was injected and the request must not be answered
+        """
+        faults = self.server.stand_in["faults"]
+        roll = random.random()
+
+        for fault_name in REQUEST_FAULTS:
+            if roll >= faults[fault_name]:
+                roll -= faults[fault_name]
+                continue
+
+            count_request(self.server, f"fault {fault_name}")
+            if fault_name == "429":
+                self.send_json(429, {"error": {"message": "Too many requests"}},
+                               {"Retry-After": str(faults["retry_after_seconds"])})
+            elif fault_name == "5xx":
+                self.send_json(random.choice([500, 502, 503]), {"error": {"message": "Injected server error"}})
+            elif fault_name == "timeout":
+                # Nothing is sent: the client gives up at its read timeout, or sees the connection closed
+                time.sleep(faults["timeout_seconds"])
+                self.close_connection = True
+            else:
+                self.close_connection = True
+            return True
+
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Freshdesk API v2 stand-in: categories, folders, subfolders, articles and translations
+class FreshdeskRequestHandler(StandInRequestHandler):
+    def do_GET(self):
+        knowledge_base = self.server.stand_in["knowledge_base"]
+        parsed_url = urlparse(self.path)
+        path = parsed_url.path[len(FRESHDESK_API_PATH):].rstrip("/")
+        query = dict(parse_qsl(parsed_url.query))
+        simulate_latency(self.server)
+        if self.inject_fault():
+            return
+
+        route, items = self.route(knowledge_base, path)
+        count_request(self.server, route)
+
+        if items is None:
+            self.send_json(404, {"code": "not_found"}, self.get_rate_headers())
+        elif isinstance(items, list):
+            self.send_page(items, query)
+        else:
+            self.send_json(200, self.with_image_urls(items), self.get_rate_headers())
+
+    def route(self, knowledge_base, path):
+        """
+        Returns:
+            Tuple of (route name for the request counts, list or item to return, or None for a 404)
+        """
+        parts = path.split("/")
+
+        if parts == ["solutions", "categories"]:
+            return "categories", knowledge_base["categories"]
+        if len(parts) == 4 and parts[1] == "categories" and parts[3] == "folders":
+            return "folders", [knowledge_base["folders"][folder_id]
+                               for folder_id in knowledge_base["category_folders"].get(int(parts[2]), [])]
+        if len(parts) == 4 and parts[1] == "folders" and parts[3] == "subfolders":
+            return "subfolders", [knowledge_base["folders"][folder_id]
+                                  for folder_id in knowledge_base["subfolders"].get(int(parts[2]), [])]
+        if len(parts) == 4 and parts[1] == "folders" and parts[3] == "articles":
+            return "folder_articles", [knowledge_base["articles"][article_id]
+                                       for article_id in knowledge_base["folder_articles"].get(int(parts[2]), [])]
+        if len(parts) == 5 and parts[1] == "folders" and parts[3] == "articles":
+            translations = knowledge_base["translations"].get(parts[4], {})
+            return "folder_translations", [translations[article_id]
+                                           for article_id in knowledge_base["folder_articles"].get(int(parts[2]), [])
+                                           if article_id in translations]
+        if len(parts) == 3 and parts[1] == "folders":
+            return "folder", knowledge_base["folders"].get(int(parts[2]))
+        if len(parts) == 3 and parts[1] == "articles":
+            return "article", knowledge_base["articles"].get(int(parts[2]))
+        if len(parts) == 4 and parts[1] == "articles":
+            return "article_translation", knowledge_base["translations"].get(parts[3], {}).get(int(parts[2]))
+
+        return "unknown", None
+
+    def get_rate_headers(self):
+        return {"X-RateLimit-Total": str(FRESHDESK_RATE_LIMIT_TOTAL),
+                "X-RateLimit-Remaining": str(FRESHDESK_RATE_LIMIT_TOTAL - 1)}
+
+    def with_image_urls(self, item):
+        if "description" not in item:
+            return item
+        return dict(item, description=item["description"].replace(
+            "{image_cdn_url}", self.server.stand_in["knowledge_base"]["image_cdn_url"]))
+
+    def send_page(self, items, query):
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 30))
+        page_items = [self.with_image_urls(item) for item in items[(page - 1) * per_page:page * per_page]]
+
+        headers = self.get_rate_headers()
+        if page * per_page < len(items):
+            next_url = f"http://{self.headers['Host']}{urlparse(self.path).path}?page={page + 1}&per_page={per_page}"
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        self.send_json(200, page_items, headers)
+
+
+# Image CDN stand-in: serves images of the configured sizes
+class ImageCdnRequestHandler(StandInRequestHandler):
+    def do_GET(self):
+        image_name = urlparse(self.path).path.rsplit("/", 1)[-1]
+        image_size = self.server.stand_in["knowledge_base"]["images"].get(image_name)
+        simulate_latency(self.server)
+        if self.inject_fault():
+            return
+        count_request(self.server, "image")
+
+        if image_size is None:
+            self.send_body(404)
+            return
+
+        # Deterministic bytes per image, so identical images hash alike
+        seed = image_name.encode("utf-8")
+        image_content = (seed * (image_size // len(seed) + 1))[:image_size]
+        self.send_body(200, image_content, {"Content-Type": "image/png"})
+
+
+# Dataverse Web API stand-in: knowledge articles, translations, web resources and $batch
+class DataverseRequestHandler(StandInRequestHandler):
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        body = self.read_body()
+        simulate_latency(self.server)
+
+        if urlparse(self.path).path == "/oauth2/v2.0/token":
+            count_request(self.server, "token")
+            self.send_json(200, {"access_token": issue_access_token(self.server),
+                                 "refresh_token": uuid.uuid4().hex, "expires_in": 3600})
+            return
+
+        if self.reject_authorization() or self.inject_fault():
+            return
+
+        if urlparse(self.path).path == f"{DATAVERSE_API_PATH}$batch":
+            count_request(self.server, "$batch")
+            response_body, content_type = execute_dataverse_batch(
+                self.server, body, self.headers.get("Content-Type", ""))
+            self.send_body(200, response_body, {"Content-Type": content_type})
+            return
+
+        status_code, headers, response_json, route = dispatch_dataverse_operation(
+            self.server, method, self.path, dict(self.headers), body)
+        count_request(self.server, route)
+
+        if response_json is None:
+            self.send_body(status_code, b"", headers)
+        else:
+            self.send_json(status_code, response_json, headers)
+
+    def reject_authorization(self):
+        """
+        Tokens expire early at the 401 fault rate, and stay rejected until the
+        client gets a new one from the token endpoint.
+
+        Returns:
+            True if the request was answered with a 401
+        """
+        state = self.server.stand_in
+        access_token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+
+        with state["lock"]:
+            if access_token in state["access_tokens"] and random.random() < state["faults"]["401"]:
+                state["access_tokens"].discard(access_token)
+            authorized = access_token in state["access_tokens"]
+
+        if authorized:
+            return False
+
+        count_request(self.server, "fault 401")
+        self.send_json(401, {"error": {"code": "0x80040220", "message": "The access token has expired"}},
+                       {"WWW-Authenticate": "Bearer"})
+        return True
+
+
+# Issue a Dataverse access token from the stand-in's token endpoint
+def issue_access_token(server):
+    access_token = f"stand-in-{uuid.uuid4().hex}"
+    with server.stand_in["lock"]:
+        server.stand_in["access_tokens"].add(access_token)
+    return access_token
+
+
+# Monotonic time at which the article number of a new article is generated
+def get_article_number_time(state):
+    number_delay = state["article_number_delay_seconds"]
+    if random.random() < state["faults"]["slow_number"]:
+        number_delay += state["faults"]["slow_number_seconds"]
+    return time.monotonic() + number_delay
+
+
+# Public view of a knowledge article, with the article number once it has been "generated"
+def get_dataverse_record(server, record):
+    view = {key: value for key, value in record.items() if not key.startswith("_stand_in")}
+    if time.monotonic() < record["_stand_in_number_at"]:
+        view["articlepublicnumber"] = None
+    view["@odata.etag"] = f'W/"{record["versionnumber"]}"'
+    return view
+
+
+# Check one $filter condition of a knowledge article query
+def matches_filter_condition(record, condition):
+    in_match = IN_FILTER_PATTERN.fullmatch(condition)
+    if in_match:
+        values = {value.strip().strip("'") for value in in_match.group(2).split(",")}
+        return str(record.get(in_match.group(1))) in values
+
+    eq_match = EQ_FILTER_PATTERN.match(condition)
+    if eq_match:
+        value = eq_match.group(2).strip("'")
+        if value == "null":
+            return record.get(eq_match.group(1)) is None
+        return str(record.get(eq_match.group(1))) == value
+
+    return True
+
+
+# Apply one Dataverse Web API operation to the stand-in's records
+def dispatch_dataverse_operation(server, method, url, headers, body):
+    """
+    Returns:
+        Tuple of (status code, response headers, response JSON or None, route name)
+    """
+    state = server.stand_in
+    parsed_url = urlparse(url)
+    path = parsed_url.path[parsed_url.path.index(DATAVERSE_API_PATH) + len(DATAVERSE_API_PATH):] \
+        if DATAVERSE_API_PATH in parsed_url.path else parsed_url.path
+    query = dict(parse_qsl(parsed_url.query))
+    headers = {name.lower(): value for name, value in headers.items()}
+    request_json = json.loads(body) if body else {}
+    return_representation = "return=representation" in headers.get("prefer", "")
+
+    with state["lock"]:
+        records = state["records"]
+
+        if re.fullmatch(r"knowledgearticles\([^)]+\)/knowledgearticle_category(\([^)]+\))?/\$ref", path):
+            return 204, {}, None, f"{method} category $ref"
+
+        record_match = re.fullmatch(r"knowledgearticles\(([^)]+)\)", path)
+        if record_match:
+            record = records.get(record_match.group(1))
+            if record is None:
+                return 404, {}, {"error": {"message": "knowledgearticle not found"}}, f"{method} knowledgearticle"
+
+            if method == "GET":
+                if headers.get("if-none-match") == f'W/"{record["versionnumber"]}"':
+                    return 304, {}, None, "GET knowledgearticle"
+                return 200, {}, get_dataverse_record(server, record), "GET knowledgearticle"
+
+            if method == "PATCH":
+                record.update({key: value for key, value in request_json.items() if "@" not in key})
+                record["versionnumber"] += 1
+                if return_representation:
+                    return 200, {}, get_dataverse_record(server, record), "PATCH knowledgearticle"
+                return 204, {"ETag": f'W/"{record["versionnumber"]}"'}, None, "PATCH knowledgearticle"
+
+        if path == "knowledgearticles" and method == "POST":
+            state["article_number"] += 1
+            knowledgearticleid = str(uuid.uuid4())
+            category_match = re.search(r"\(([^)]+)\)", request_json.get("revops_category@odata.bind", ""))
+            records[knowledgearticleid] = {
+                "knowledgearticleid": knowledgearticleid,
+                "revops_freshdeskarticleid": request_json.get("revops_freshdeskarticleid"),
+                "title": request_json.get("title"),
+                "content": request_json.get("content"),
+                "isinternal": request_json.get("isinternal"),
+                "articlepublicnumber": f"KA-{state['article_number']:06d}",
+                "statecode": 0,
+                "statuscode": 2,
+                "_revops_category_value": category_match.group(1) if category_match else None,
+                "_parentarticlecontentid_value": None,
+                "_languagelocaleid_value": state["english_languagelocaleid"],
+                "versionnumber": 1,
+                "_stand_in_number_at": get_article_number_time(state)
+            }
+            response_headers = {
+                "OData-EntityId": f"{state['base_url']}{DATAVERSE_API_PATH}knowledgearticles({knowledgearticleid})"}
+            if return_representation:
+                return 201, response_headers, get_dataverse_record(server, records[knowledgearticleid]), "POST knowledgearticles"
+            return 204, response_headers, None, "POST knowledgearticles"
+
+        if path == "knowledgearticles" and method == "GET":
+            conditions = unquote(query.get("$filter", "")).split(" and ")
+            values = [get_dataverse_record(server, record) for record in records.values()
+                      if all(matches_filter_condition(record, condition) for condition in conditions if condition)]
+            return 200, {}, {"value": values}, "GET knowledgearticles query"
+
+        if path == "CreateKnowledgeArticleTranslation" and method == "POST":
+            source = records.get(request_json["Source"]["knowledgearticleid"])
+            if source is None:
+                return 404, {}, {"error": {"message": "source article not found"}}, "POST CreateKnowledgeArticleTranslation"
+
+            state["article_number"] += 1
+            knowledgearticleid = str(uuid.uuid4())
+            records[knowledgearticleid] = dict(
+                source, knowledgearticleid=knowledgearticleid,
+                articlepublicnumber=f"KA-{state['article_number']:06d}",
+                statecode=0, statuscode=2, versionnumber=1,
+                _parentarticlecontentid_value=source["knowledgearticleid"],
+                _languagelocaleid_value=request_json["Language"]["languagelocaleid"],
+                _stand_in_number_at=get_article_number_time(state))
+            return 200, {}, get_dataverse_record(server, records[knowledgearticleid]), "POST CreateKnowledgeArticleTranslation"
+
+        if path == "webresourceset" and method == "POST":
+            state["web_resources"][request_json.get("name")] = len(request_json.get("content", ""))
+            return 204, {}, None, "POST webresourceset"
+
+        if path == "webresourceset" and method == "GET":
+            name_match = re.fullmatch(r"name eq '(.*)'", unquote(query.get("$filter", "")))
+            name = name_match.group(1).replace("''", "'") if name_match else None
+            values = [{"webresourceid": str(uuid.uuid5(uuid.NAMESPACE_URL, name)), "name": name}] \
+                if name in state["web_resources"] else []
+            return 200, {}, {"value": values}, "GET webresourceset query"
+
+    return 404, {}, {"error": {"message": f"{method} {path} not supported by the stand-in"}}, "unknown"
+
+
+# Split a multipart body into its parts
+def split_multipart(text, boundary):
+    parts = []
+    for part in text.split(f"--{boundary}")[1:]:
+        if part.startswith("--"):
+            break
+        parts.append(part.strip("\n"))
+    return parts
+
+
+# Format one operation response as an application/http part
+def format_batch_response_part(status_code, headers, response_json, content_id=None):
+    lines = ["Content-Type: application/http", "Content-Transfer-Encoding: binary"]
+    if content_id is not None:
+        lines.append(f"Content-ID: {content_id}")
+    lines.extend(["", f"HTTP/1.1 {status_code} {HTTP_REASONS.get(status_code, '')}"])
+    if response_json is not None:
+        lines.append("Content-Type: application/json; odata.metadata=minimal")
+    for name, value in headers.items():
+        lines.append(f"{name}: {value}")
+    lines.append("")
+    lines.append(json.dumps(response_json) if response_json is not None else "")
+    return lines
+
+
+# Run a Dataverse $batch request against the stand-in's records
+def execute_dataverse_batch(server, body, content_type):
+    """
+    Change sets are applied in order and resolve $<Content-ID> references to
+    articles created earlier in the set. A failing change set is rolled back
+    and answered with the single failing response, as Dataverse does.
+
+    Returns:
+        Tuple of (response body, response Content-Type)
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    text = body.decode("utf-8").replace("\r\n", "\n")
+    response_boundary = f"batchresponse_{uuid.uuid4().hex}"
+    lines = []
+
+    for part in split_multipart(text, boundary):
+        part_headers, _, part_body = part.partition("\n\n")
+        changeset_match = re.search(r'boundary="?([^";\n]+)"?', part_headers)
+
+        if changeset_match:
+            operations = split_multipart(part_body, changeset_match.group(1))
+        else:
+            operations = [part]
+
+        entity_urls = {}
+        created_ids = []
+        responses = []
+        for operation in operations:
+            operation_headers, _, http_request = operation.partition("\n\n")
+            content_id_match = re.search(r"Content-ID: (\S+)", operation_headers)
+            content_id = content_id_match.group(1) if content_id_match else None
+
+            request_head, _, request_body = http_request.partition("\n\n")
+            request_line, *header_lines = request_head.split("\n")
+            method, url, _ = request_line.split(" ")
+            request_headers = dict(line.split(": ", 1) for line in header_lines if ": " in line)
+
+            # $1/... addresses the article created by Content-ID 1 of this change set
+            reference_match = re.match(r"\$(\w+)(.*)", url)
+            if reference_match:
+                url = entity_urls[reference_match.group(1)] + reference_match.group(2)
+
+            time.sleep(server.stand_in["batch_operation_ms"] / 1000)
+            status_code, headers, response_json, route = dispatch_dataverse_operation(
+                server, method, url, request_headers, request_body.strip().encode("utf-8"))
+            count_request(server, f"$batch {route}")
+
+            if "OData-EntityId" in headers:
+                entity_urls[content_id] = headers["OData-EntityId"]
+                created_ids.append(headers["OData-EntityId"].rsplit("(", 1)[1].rstrip(")"))
+            responses.append((status_code, headers, response_json, content_id))
+
+            if status_code >= 400 and changeset_match:
+                with server.stand_in["lock"]:
+                    for knowledgearticleid in created_ids:
+                        server.stand_in["records"].pop(knowledgearticleid, None)
+                responses = [responses[-1]]
+                break
+
+        lines.append(f"--{response_boundary}")
+        if changeset_match:
+            changeset_boundary = f"changesetresponse_{uuid.uuid4().hex}"
+            lines.extend([f"Content-Type: multipart/mixed; boundary={changeset_boundary}", ""])
+            for status_code, headers, response_json, content_id in responses:
+                lines.append(f"--{changeset_boundary}")
+                lines.extend(format_batch_response_part(status_code, headers, response_json, content_id))
+            lines.append(f"--{changeset_boundary}--")
+        else:
+            lines.extend(format_batch_response_part(*responses[0]))
+
+    lines.extend([f"--{response_boundary}--", ""])
+    return "\r\n".join(lines).encode("utf-8"), f"multipart/mixed; boundary={response_boundary}"
+
+
+# Threaded server that doesn't print the connection resets of clients giving up on a request
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# Start one stand-in server on a free port
+def start_stand_in_server(handler_class, stand_in, host="127.0.0.1"):
+    server = StandInServer((host, 0), handler_class)
+    stand_in.setdefault("lock", threading.Lock())
+    stand_in.setdefault("request_counts", {})
+    stand_in.setdefault("jitter_ms", 0)
+    stand_in["faults"] = dict(DEFAULT_FAULTS, **stand_in.get("faults", {}))
+    server.stand_in = stand_in
+    stand_in["base_url"] = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name=f"{handler_class.__name__}-server", daemon=True).start()
+    return server
+
+
+# Start the Freshdesk, image CDN and Dataverse stand-ins for a knowledge base
+def start_stand_in_servers(knowledge_base, freshdesk_latency_ms=0, cdn_latency_ms=0, dataverse_latency_ms=0,
+                           batch_operation_ms=0, article_number_delay_seconds=0, jitter_ms=0,
+                           faults=None, fault_servers=("freshdesk", "cdn", "dataverse")):
+    """
+    The CDN listens on localhost and Freshdesk on 127.0.0.1, so image downloads
+    aren't counted against the Freshdesk API budget. Dataverse access tokens
+    are issued by POST /oauth2/v2.0/token on the Dataverse stand-in.
+
+    Args:
+        faults: Fault rates and settings, as in DEFAULT_FAULTS
+        fault_servers: Servers the faults are injected into
+
+    Returns:
+        Dict of servers keyed by "freshdesk", "cdn" and "dataverse"; each
+        server's stand_in dict has its base_url and request_counts
+    """
+    def get_faults(server_name):
+        return (faults or {}) if server_name in fault_servers else {}
+
+    servers = {
+        "freshdesk": start_stand_in_server(FreshdeskRequestHandler, {
+            "knowledge_base": knowledge_base, "latency_ms": freshdesk_latency_ms, "jitter_ms": jitter_ms,
+            "faults": get_faults("freshdesk")}),
+        "cdn": start_stand_in_server(ImageCdnRequestHandler, {
+            "knowledge_base": knowledge_base, "latency_ms": cdn_latency_ms, "jitter_ms": jitter_ms,
+            "faults": get_faults("cdn")}, host="localhost"),
+        "dataverse": start_stand_in_server(DataverseRequestHandler, {
+            "latency_ms": dataverse_latency_ms, "jitter_ms": jitter_ms, "batch_operation_ms": batch_operation_ms,
+            "article_number_delay_seconds": article_number_delay_seconds, "records": {}, "web_resources": {},
+            "article_number": 0, "english_languagelocaleid": str(uuid.uuid4()), "access_tokens": set(),
+            "faults": get_faults("dataverse")})
+    }
+    knowledge_base["image_cdn_url"] = servers["cdn"].stand_in["base_url"]
+
+    return servers
+
+
+# Stop every stand-in server
+def stop_stand_in_servers(servers):
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()